@@ -22,6 +22,7 @@ from django.utils import simplejson
 from django.db.models import Q	
 from django.core.management import call_command
 from schools.receivers import KLP_user_Perm
+from schools.permissions import KLP_Perm_Changed
 from django.conf import settings
 from subprocess import Popen
 from subprocess import call
@@ -129,6 +130,7 @@ def assignPermission(inst_list, deUserList, permissions, permissionType, assessm
 			if permissionType == 'permissions':
 				# if permission type is permissions set institution level permissions for the user
 				userObj.set_perms(permissions, instObj)
+				KLP_Perm_Changed([userObj.id])
 				if assessmentPerm:
 					# if assessmentPerm is true assign assessment also to the user.
 					sg_list = StudentGroup.objects.filter(institution__id=inst_id).values_list('id', flat=True).distinct()
@@ -299,6 +301,8 @@ def KLP_Revoke_Permissions(request, permissionType):
 				instObj = Institution.objects.get(pk=inst_id)
 				# revoke permission for user
 				userObj.revoke('Acess', instObj)
+			# object permissions are written without signals, clear cached permissions of the user
+			KLP_Perm_Changed([userObj.id])
 		else:
 			# else revoke assessment permissions
 			assignedAsmList = request.POST.getlist('assignedAsm')
@@ -21,6 +21,7 @@ from django.views.generic.simple import direct_to_template
 from django.forms.models import modelformset_factory
 from schools.models import *
 from schools.forms import *
+from schools.permissions import KLP_Perm_Changed
 import datetime
 from django.db import transaction
 class SerializeResponder(object):
@@ -322,6 +323,7 @@ class TemplateResponder(object):
 				        obj = form.save()[0]  # save data				
 					boundaryObj = Boundary.objects.get(pk=request.POST.get('form-0-boundary'))
 					request.user.set_perms(['Acess'], obj)
+					KLP_Perm_Changed([request.user.id])
 					if boundaryObj.boundary_category.boundary_category.lower() == 'circle' and boundaryObj.boundary_type.boundary_type.lower() in ['anganwadi','preschool']:
 						# if boundary category is circle and boundary type is anganwadi create a class with name Anganwadi Class
 						newClass = StudentGroup(name="Anganwadi Class", active=2, institution_id=obj.id,group_type='Class')
@@ -1,2 +1,2 @@
 VERSION = (0,3,0,'final')
-from fullhistory import register_model, get_active_histories
+from fullhistory import register_model, get_active_histories, create_histories
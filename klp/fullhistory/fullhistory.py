@@ -3,6 +3,7 @@ try:
 except ImportError:
     import dummy_thread as thread
 
+from django.conf import settings
 from django.db.models import signals
 from django.core import serializers
 
@@ -13,24 +14,70 @@ from signals import *
 # thread and the list is handled as a stack of values.
 state = {}
 
+# Histories waiting to be written, per thread. Used when FULLHISTORY_BUFFER
+# is set, they are saved with one insert at the end of the request.
+buffers = {}
+
 def get_active_histories():
     '''
     Returns histories that have been created during the current request
     '''
+    flush_histories()
     request, rq = state.get(thread.get_ident(), (None, None))
     if rq is None:
         return FullHistory.objects.none()
     return FullHistory.objects.filter(request=rq)
 
-def prepare_initial(entry):
-    entry._fullhistory = get_all_data(entry)
+# Marks fields which were not loaded (deferred) when the initial values were kept
+NOT_LOADED = object()
+
+def prepare_initial(entry, with_m2m=False):
+    '''
+    Keeps the field values of the entry to compare with when it is saved.
+    Values are only copied here, they are serialized at save time by
+    get_initial_data, so entries which are only read cost nothing.
+    Many to many values need queries, they are kept only with with_m2m
+    (after a save, for adjust_history), otherwise they are read at save time.
+    '''
+    m2m = None
+    if with_m2m:
+        m2m = get_m2m_data(entry)
+    entry._fullhistory = ([entry.__dict__.get(field.attname, NOT_LOADED) for field in entry._meta.fields], m2m)
+
+def get_m2m_data(entry):
+    ret = dict()
+    for field in entry._meta.many_to_many:
+        if field.serialize and field.rel.through._meta.auto_created:
+            ret[field.name] = list(getattr(entry, field.name).values_list('pk', flat=True))
+    return ret
+
+def get_initial_data(entry):
+    '''
+    Returns serialized data of the entry with the values kept by prepare_initial
+    '''
+    if not hasattr(entry, '_fullhistory'):
+        return dict()
+    values, m2m = entry._fullhistory
+    # serialize a copy of the entry holding the initial values
+    initial = entry.__class__.__new__(entry.__class__)
+    initial.__dict__ = entry.__dict__.copy()
+    for field, value in zip(entry._meta.fields, values):
+        if value is not NOT_LOADED and initial.__dict__.get(field.attname, NOT_LOADED) != value:
+            initial.__dict__[field.attname] = value
+            # drop related object cached for the new value
+            initial.__dict__.pop(field.get_cache_name(), None)
+    data = get_all_data(initial)
+    if m2m is not None:
+        data.update(m2m)
+    return data
 
 def get_difference(entry):
     ret = dict()
     newdata = get_all_data(entry)
-    keys = set(newdata.keys()) | set(entry._fullhistory.keys())
+    olddata = get_initial_data(entry)
+    keys = set(newdata.keys()) | set(olddata.keys())
     for key in keys:
-        oldvalue = entry._fullhistory.get(key, None)
+        oldvalue = olddata.get(key, None)
         newvalue = newdata.get(key, None)
         if oldvalue != newvalue:
             ret[key] = (oldvalue, newvalue)
@@ -76,12 +123,70 @@ def create_history(entry, action):
     else:
         data = None
     fh = FullHistory(data=data, content_object=entry, action=action, request=request)
-    fh.save()
+    if is_buffered():
+        buffers.setdefault(thread.get_ident(), []).append((fh, entry))
+    else:
+        fh.save()
     apply_parents(entry, lambda x: create_history(x, action))
-    prepare_initial(entry)
-    post_create.send(sender=type(entry), fullhistory=fh, instance=entry)
+    prepare_initial(entry, action != 'D')
+    if fh.pk:
+        post_create.send(sender=type(entry), fullhistory=fh, instance=entry)
     return fh
 
+def is_buffered():
+    '''
+    Histories are buffered when FULLHISTORY_BUFFER is set and
+    there is a request to flush them at
+    '''
+    if not getattr(settings, 'FULLHISTORY_BUFFER', False):
+        return False
+    request, rq = state.get(thread.get_ident(), (None, None))
+    return request is not None
+
+def flush_histories():
+    '''
+    Writes the buffered histories of the current thread with one bulk insert
+    Revisions are numbered per object by FullHistoryManager.bulk_insert
+    '''
+    pending = buffers.pop(thread.get_ident(), [])
+    if not pending:
+        return []
+    histories = FullHistory.objects.bulk_insert([fh for fh, entry in pending])
+    for fh, entry in pending:
+        post_create.send(sender=type(entry), fullhistory=fh, instance=entry)
+    return histories
+
+def create_histories(entries, action):
+    '''
+    Bulk version of create_history for entries written without save(),
+    records all the histories with a single insert
+    '''
+    if not entries:
+        return []
+    # keep revisions in order with the histories buffered earlier
+    flush_histories()
+    request = get_or_create_request()
+    histories = []
+    for entry in entries:
+        if action == 'U':
+            data = get_difference(entry)
+            if len(data) == 0:
+                data = get_all_data_tuple(entry)
+        elif action == 'C':
+            data = get_all_data_tuple(entry)
+        else:
+            data = None
+        histories.append(FullHistory(data=data, content_object=entry, action=action, request=request))
+    FullHistory.objects.bulk_insert(histories)
+    parents = []
+    for entry in entries:
+        apply_parents(entry, parents.append)
+    create_histories(parents, action)
+    for entry, fh in zip(entries, histories):
+        prepare_initial(entry)
+        post_create.send(sender=type(entry), fullhistory=fh, instance=entry)
+    return histories
+
 def adjust_history(obj, action='U'):
     '''
     Adjusts the latest entry to accomidate any changes not picked up
@@ -105,7 +210,7 @@ def adjust_history(obj, action='U'):
         history.data = data
         history.info = history.create_info()
         history.save()
-        prepare_initial(obj)
+        prepare_initial(obj, True)
         post_adjust.send(sender=type(obj), fullhistory=history, instance=obj)
         return history
     return None
@@ -126,7 +231,18 @@ def save_history_signal(instance, created, **kwargs):
 def delete_history_signal(instance, **kwargs):
     create_history(instance, 'D')
 
-def end_session():
+def discard_histories():
+    '''
+    Drops the buffered histories of the current thread, for requests which
+    failed and whose writes may have been rolled back
+    '''
+    return buffers.pop(thread.get_ident(), [])
+
+def end_session(discard=False):
+    if discard:
+        discard_histories()
+    else:
+        flush_histories()
     state.pop(thread.get_ident(), None)
 
 registered_models = set()
@@ -146,6 +262,11 @@ class FullHistoryMiddleware(object):
         state[thread.get_ident()] = (request, None)
 
     def process_response(self, request, response):
-        end_session()
+        # histories of error responses are not written, redirects are
+        # returned after successful saves
+        end_session(discard=response.status_code >= 400)
         return response
 
+    def process_exception(self, request, exception):
+        end_session(discard=True)
+
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Max
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
@@ -11,6 +12,83 @@ import datetime
 
 encoder = DjangoJSONEncoder()
 
+def next_ids(model, count):
+    '''
+    Takes count ids from the sequence of the model table. Inserts give the
+    ids themselves, because a partitioned table (see partitions.py) returns
+    no row for INSERT ... RETURNING
+    '''
+    cursor = connection.cursor()
+    cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                   [model._meta.db_table, model._meta.pk.column, count])
+    return [row[0] for row in cursor.fetchall()]
+
+def insert_rows(objs):
+    '''
+    Inserts unsaved entries of one model, 500 rows per statement,
+    and sets their primary keys
+    '''
+    if not objs:
+        return objs
+    qn = connection.ops.quote_name
+    model = type(objs[0])
+    opts = model._meta
+    fields = [opts.pk] + [field for field in opts.local_fields if not isinstance(field, models.AutoField)]
+    row_sql = '(%s)' % ', '.join(['%s'] * len(fields))
+    cursor = connection.cursor()
+    for start in range(0, len(objs), 500):
+        chunk = objs[start:start + 500]
+        for obj, pk in zip(chunk, next_ids(model, len(chunk))):
+            obj.pk = pk
+        params = []
+        for obj in chunk:
+            params.extend([field.get_db_prep_save(getattr(obj, field.attname), connection=connection) for field in fields])
+        cursor.execute('INSERT INTO %s (%s) VALUES %s' % (qn(opts.db_table),
+                                                       ', '.join([qn(field.column) for field in fields]),
+                                                       ', '.join([row_sql] * len(chunk))), params)
+    transaction.commit_unless_managed()
+    return objs
+
+def snapshot_every():
+    '''
+    Number of revisions replayed before a snapshot of the object is kept
+    '''
+    from django.conf import settings
+    return getattr(settings, 'FULLHISTORY_SNAPSHOT_EVERY', 50)
+
+class MissingRevisions(Exception):
+    '''
+    Raised when a version of an object can not be rebuilt, because the
+    revisions after its nearest snapshot are not in the database (they
+    were archived, see partitions.archive_partition)
+    '''
+    pass
+
+def check_revisions(content_type, pk, histories, first, last):
+    '''
+    Raises MissingRevisions unless histories are the revisions from first
+    up to last, without gaps
+    '''
+    if last < 0 or [history.revision for history in histories] != range(first, last + 1):
+        raise MissingRevisions('Revisions %s to %s of object %s of content type %s are not in the database' % (first, last, pk, getattr(content_type, 'id', content_type)))
+
+def replay(obj, histories, audit=True):
+    '''
+    Applies the data of history entries (in revision order) to the object dictionary
+    '''
+    for history in histories:
+        if history.data is None:
+            assert history.action == 'D'
+            continue
+        for key, value in history.data.items():
+            if len(value) == 2:
+                if audit:
+                    assert obj[key] == value[0], '%s does not match %s for attr %s' % (obj[key], value[0], key)
+                obj[key] = value[1]
+            else:
+                obj[key] = value[0]
+    return obj
+
 class Request(models.Model):
     user_name = models.CharField(max_length=255, blank=True, null=True)
     user_pk = models.PositiveIntegerField(null=True, db_index=True)
@@ -37,13 +115,64 @@ class FullHistoryManager(models.Manager):
         Retries all revisions for an object
         Requires either entry or model and pk
         '''
-        if entry:
-            pk = entry.pk
-            ct = ContentType.objects.get_for_model(entry)
-        else:
-            ct = ContentType.objects.get_for_model(model)
+        ct, pk = self.object_key(entry, model, pk)
         return self.get_query_set().filter(content_type=ct, object_id=pk).order_by('revision')
 
+    def object_key(self, entry=None, model=None, pk=None):
+        '''
+        Returns content type and pk of an object given as entry or model and pk
+        '''
+        if entry:
+            return ContentType.objects.get_for_model(entry), entry.pk
+        return ContentType.objects.get_for_model(model), pk
+
+    def next_revision(self, content_type_id, object_id):
+        '''
+        Returns the revision number for a new history entry of an object
+        Uses the (content_type, object_id, revision) index instead of counting rows.
+        Snapshots are counted too, they keep the last revision of archived
+        histories (see partitions.archive_partition)
+        '''
+        revisions = [self.get_query_set().filter(content_type__id=content_type_id, object_id=object_id).aggregate(revision=Max('revision'))['revision'],
+                     FullHistorySnapshot.objects.filter(content_type__id=content_type_id, object_id=object_id).aggregate(revision=Max('revision'))['revision']]
+        revisions = [revision for revision in revisions if revision is not None]
+        if not revisions:
+            return 0
+        return max(revisions) + 1
+
+    def bulk_insert(self, histories):
+        '''
+        Saves a list of unsaved history entries with one insert,
+        numbering the revisions with one grouped max per content type
+        (of histories and of snapshots, as in next_revision)
+        '''
+        if not histories:
+            return histories
+        next_revision = dict()
+        for history in histories:
+            key = (history.content_type_id, history.object_id)
+            if key not in next_revision:
+                next_revision[key] = None
+        for ct_id in set([key[0] for key in next_revision]):
+            object_ids = [key[1] for key in next_revision if key[0] == ct_id]
+            for manager in [self, FullHistorySnapshot.objects]:
+                revisions = manager.get_query_set().filter(content_type__id=ct_id, object_id__in=object_ids).values('object_id').annotate(revision=Max('revision'))
+                for row in revisions:
+                    key = (ct_id, row['object_id'])
+                    next_revision[key] = max(next_revision[key], row['revision'] + 1)
+        now = datetime.datetime.now()
+        for history in histories:
+            key = (history.content_type_id, history.object_id)
+            history.revision = next_revision[key] or 0
+            next_revision[key] = history.revision + 1
+            history.action_time = now
+            if not history.info:
+                history.info = history.create_info()
+            history.set_user()
+        insert_rows(histories)
+        FullHistoryChange.objects.record(histories)
+        return histories
+
     def audit(self, entry=None, model=None, pk=None):
         from fullhistory import get_all_data
         obj = self.get_version(entry, model, pk)
@@ -58,27 +187,85 @@ class FullHistoryManager(models.Manager):
     def get_version(self, entry=None, model=None, pk=None, version=None, audit=True):
         '''
         Returns a dictionary representing the object at a given version
+        (after the revisions lower than version, or all revisions)
+        Starts from the nearest snapshot, and saves a new snapshot when
+        FULLHISTORY_SNAPSHOT_EVERY or more revisions had to be replayed.
+        Raises MissingRevisions when the revisions needed were archived
         '''
-        if version is None:
-            histories = self.actions_for_object(entry, model, pk)
-        else:
-            histories = self.actions_for_object(entry, model, pk)[:version]
-        if audit:
-            assert histories[0].action == 'C', 'First action should be create'
+        ct, pk = self.object_key(entry, model, pk)
+        return self.version_of(ct, pk, version, audit)
+
+    def version_of(self, content_type, pk, version=None, audit=True):
+        '''
+        get_version for a content type (or its id) and object id
+        '''
+        ct = content_type
+        histories = self.get_query_set().filter(content_type=ct, object_id=pk).order_by('revision')
+        if version is not None:
+            histories = histories.filter(revision__lt=version)
         obj = dict()
-        for history in histories:
-            if history.data is None:
-                assert history.action == 'D'
-                continue
-            for key, value in history.data.items():
-                if len(value) == 2:
-                    if audit:
-                        assert obj[key] == value[0], '%s does not match %s for attr %s' % (obj[key], value[0], key)
-                    obj[key] = value[1]
-                else:
-                    obj[key] = value[0]
+        snapshot = FullHistorySnapshot.objects.nearest(ct, pk, version)
+        if snapshot is not None:
+            obj = snapshot.data
+            histories = histories.filter(revision__gt=snapshot.revision)
+        histories = list(histories)
+        # the last revision of the version, the revisions replayed must lead to it
+        last = self.next_revision(getattr(ct, 'id', ct), pk) - 1
+        if version is not None:
+            last = min(last, version - 1)
+        first = 0
+        if snapshot is not None:
+            first = snapshot.revision + 1
+        check_revisions(ct, pk, histories, first, last)
+        if audit and snapshot is None:
+            assert histories[0].action == 'C', 'First action should be create'
+        replay(obj, histories, audit)
+        if len(histories) >= snapshot_every():
+            FullHistorySnapshot.objects.take(histories[-1], obj)
         return obj
-    
+
+    def get_versions_at(self, model, pks, when):
+        '''
+        Returns {pk: dictionary representing the object} for the objects
+        of model as they were at datetime when, objects created later or
+        deleted by then are left out. Reads the nearest snapshot of every
+        object and the revisions after it with one query each. Raises
+        MissingRevisions if revisions up to when are archived and not
+        covered by a snapshot
+        '''
+        ct = ContentType.objects.get_for_model(model)
+        snapshots = FullHistorySnapshot.objects.latest_before(ct, pks, when)
+        histories = self.get_query_set().filter(content_type=ct, object_id__in=list(pks), action_time__lte=when)
+        qn = connection.ops.quote_name
+        history_table = qn(self.model._meta.db_table)
+        histories = histories.extra(where=['%s.revision > COALESCE((SELECT max(s.revision) FROM %s s WHERE s.content_type_id = %s.content_type_id AND s.object_id = %s.object_id AND s.action_time <= %%s), -1)' % (history_table, qn(FullHistorySnapshot._meta.db_table), history_table, history_table)], params=[when])
+        objs = dict()
+        actions = dict()
+        # next revision expected for every object
+        expected = dict([(int(pk), 0) for pk in pks])
+        for object_id, snapshot in snapshots.items():
+            objs[object_id] = snapshot.data
+            actions[object_id] = snapshot.action
+            expected[object_id] = snapshot.revision + 1
+        for history in histories.order_by('object_id', 'revision'):
+            check_revisions(ct, history.object_id, [history], expected[history.object_id], expected[history.object_id])
+            replay(objs.setdefault(history.object_id, dict()), [history], False)
+            actions[history.object_id] = history.action
+            expected[history.object_id] = history.revision + 1
+        # the next revision after the replayed ones must be later than when, unless it is missing
+        cursor = connection.cursor()
+        cursor.execute('SELECT v.object_id, v.next, LEAST((SELECT min(h.revision) FROM %s h WHERE h.content_type_id = %%s AND h.object_id = v.object_id AND h.revision >= v.next), '
+                       '(SELECT min(s.revision) FROM %s s WHERE s.content_type_id = %%s AND s.object_id = v.object_id AND s.revision >= v.next)) '
+                       'FROM (SELECT unnest(%%s::integer[]) AS object_id, unnest(%%s::integer[]) AS next) v' % (history_table, qn(FullHistorySnapshot._meta.db_table)),
+                       [ct.id, ct.id, expected.keys(), expected.values()])
+        for object_id, following, found in cursor.fetchall():
+            if found is not None and found != following:
+                check_revisions(ct, object_id, [], following, found - 1)
+        for object_id, action in actions.items():
+            if action == 'D':
+                del objs[object_id]
+        return objs
+
     def rollback(self, entry=None, model=None, pk=None, version=None, commit=True, audit=True):
         '''
         Rollback an object to a certain revision number
@@ -110,6 +297,8 @@ class FullHistory(models.Model):
     action_time = models.DateTimeField(auto_now_add=True)
     _data = models.TextField(db_column='data')
     request = models.ForeignKey(Request, null=True, blank=True)
+    # user of the request, kept here for the (user_pk, action_time) index of the audit trail
+    user_pk = models.PositiveIntegerField(null=True)
     site = models.ForeignKey(Site, default=Site.objects.get_current)
     action = models.CharField(max_length=1, choices=ACTIONS)
     info = models.TextField()
@@ -147,12 +336,38 @@ class FullHistory(models.Model):
                'U':u'%s Updated',
                'D':u'%s Deleted',}[self.action] % user_name
         if self.action == 'U':
-            for key, value in self.data.items():
+            for key, value in (self.data or {}).items():
                 if not isinstance(value, tuple) or len(value) != 2: #fix for old admin
                     continue
                 ret += u'\n"%s" changed from [%s] to [%s]' % (key, unicode(value[0])[:50], unicode(value[1])[:50])
         return ret
     
+    def set_user(self):
+        '''
+        Copies the user of the request to user_pk
+        '''
+        if self.user_pk is None and self.request:
+            self.user_pk = self.request.user_pk
+
+    def get_changes(self):
+        '''
+        Returns unsaved FullHistoryChange entries for the fields changed in this entry
+        Creations, deletes and entries without changed fields give one entry
+        without a field name, so that every history has changes once they are
+        recorded. Values of created objects are only kept in the data
+        '''
+        self.set_user()
+        kwargs = dict(history=self, content_type_id=self.content_type_id, object_id=self.object_id,
+                      action=self.action, user_pk=self.user_pk, action_time=self.action_time)
+        changes = []
+        if self.action == 'U':
+            for key, value in (self.data or {}).items():
+                if len(value) == 2:
+                    changes.append(FullHistoryChange(field_name=key, old_value=change_value(value[0]), new_value=change_value(value[1]), **kwargs))
+        if not changes:
+            changes.append(FullHistoryChange(field_name='', **kwargs))
+        return changes
+
     def previous(self):
         '''
         Retrieves the previous history entry for this object
@@ -178,11 +393,34 @@ class FullHistory(models.Model):
         return FullHistory.objects.none()
 
     def save(self, *args, **kwargs):
-        if not self.pk:
-            self.revision = len(FullHistory.objects.filter(content_type=self.content_type, object_id=self.object_id))
         if not self.info:
             self.info = self.create_info()
-        return super(FullHistory, self).save(*args, **kwargs)
+        self.set_user()
+        if self.pk:
+            ret = super(FullHistory, self).save(*args, **kwargs)
+            # data may have been adjusted, record its changes again
+            self.changes.all().delete()
+            FullHistoryChange.objects.record([self])
+            # and drop snapshots which include it
+            FullHistorySnapshot.objects.filter(content_type=self.content_type_id, object_id=self.object_id, revision__gte=self.revision).delete()
+            return ret
+        # Another request may take the same revision between max() and the
+        # insert, the unique constraint rejects it and the next one is tried
+        kwargs['force_insert'] = True
+        for attempt in range(5):
+            self.revision = FullHistory.objects.next_revision(self.content_type_id, self.object_id)
+            self.pk = next_ids(FullHistory, 1)[0]
+            sid = transaction.savepoint()
+            try:
+                ret = super(FullHistory, self).save(*args, **kwargs)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                self.pk = None
+                continue
+            FullHistoryChange.objects.record([self])
+            return ret
+        raise IntegrityError('Could not get a free revision for %s %s' % (self.content_type, self.object_id))
 
     def __unicode__(self):
         return u'%s %s %s' % (self.content_type, self.object_id, self.action_time)
@@ -192,7 +430,117 @@ class FullHistory(models.Model):
     class Meta:
         verbose_name_plural = _("full histories")
         get_latest_by = "revision"
-        unique_together = (('revision', 'content_type', 'object_id'),)
+        # content type and object first, the unique index then also serves
+        # actions_for_object, previous() and next()
+        unique_together = (('content_type', 'object_id', 'revision'),)
+
+class FullHistoryChangeManager(models.Manager):
+    def record(self, histories):
+        '''
+        Stores the changed fields of saved history entries with one insert
+        '''
+        changes = []
+        for history in histories:
+            changes.extend(history.get_changes())
+        return insert_rows(changes)
+
+class FullHistoryChange(models.Model):
+    '''
+    One changed field of a history entry, so that reports can filter
+    changes (e.g. active changed from 2) with an index instead of
+    searching the data text. Values are stored as text, foreign keys
+    as the related id and None as NULL. Creations and deletes have one
+    entry without a field name
+    '''
+    history = models.ForeignKey(FullHistory, related_name='changes')
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.IntegerField()
+    action = models.CharField(max_length=1, choices=ACTIONS)
+    field_name = models.CharField(max_length=100, blank=True)
+    old_value = models.CharField(max_length=255, null=True, blank=True)
+    new_value = models.CharField(max_length=255, null=True, blank=True)
+    user_pk = models.PositiveIntegerField(null=True)
+    action_time = models.DateTimeField()
+
+    objects = FullHistoryChangeManager()
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.history_id, self.field_name, self.action)
+
+def change_value(value):
+    if value is None:
+        return None
+    return unicode(value)[:255]
+
+class FullHistorySnapshotManager(models.Manager):
+    def nearest(self, content_type, object_id, version=None):
+        '''
+        Returns the latest snapshot of the object below revision version, or None
+        '''
+        snapshots = self.get_query_set().filter(content_type=content_type, object_id=object_id)
+        if version is not None:
+            snapshots = snapshots.filter(revision__lt=version)
+        try:
+            return snapshots.order_by('-revision')[0]
+        except IndexError:
+            return None
+
+    def take(self, history, obj):
+        '''
+        Keeps obj as the state of the object after the history entry,
+        another request may have kept the same snapshot already
+        '''
+        snapshot = FullHistorySnapshot(content_type_id=history.content_type_id, object_id=history.object_id,
+                                       revision=history.revision, action=history.action,
+                                       action_time=history.action_time)
+        snapshot.data = obj
+        sid = transaction.savepoint()
+        try:
+            snapshot.save()
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return None
+        transaction.commit_unless_managed()
+        return snapshot
+
+    def latest_before(self, content_type, pks, when):
+        '''
+        Returns {object_id: latest snapshot taken at or before when} for the objects
+        '''
+        qn = connection.ops.quote_name
+        snapshots = self.raw('SELECT DISTINCT ON (object_id) * FROM %s WHERE content_type_id = %%s AND object_id = ANY(%%s) AND action_time <= %%s ORDER BY object_id, revision DESC' % qn(self.model._meta.db_table),
+                             [content_type.id, [int(pk) for pk in pks], when])
+        return dict([(snapshot.object_id, snapshot) for snapshot in snapshots])
+
+class FullHistorySnapshot(models.Model):
+    '''
+    Full state of an object after a revision, so that a version is rebuilt
+    from the nearest snapshot and the revisions after it instead of all
+    revisions since create
+    '''
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.IntegerField()
+    revision = models.PositiveIntegerField()
+    action = models.CharField(max_length=1, choices=ACTIONS)
+    action_time = models.DateTimeField()
+    _data = models.TextField(db_column='data')
+
+    objects = FullHistorySnapshotManager()
+
+    def set_data(self, val):
+        self._data = encoder.encode(val)
+
+    def get_data(self):
+        return simplejson.loads(self._data)
+
+    data = property(get_data, set_data)
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.content_type_id, self.object_id, self.revision)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'revision'),)
 
 class HistoryField(generic.GenericRelation):
     def __init__(self, **kwargs):
@@ -0,0 +1,237 @@
+'''
+Monthly partitions of the fullhistory table by action_time, and archival of
+old partitions to compressed JSON lines files.
+
+Partitions are child tables (INHERITS) with a CHECK on action_time, so that
+queries filtering on action_time only read the months they need
+(constraint_exclusion). A trigger on the fullhistory table inserts new rows
+in the partition of their month; rows of months without a partition stay in
+the parent table. The trigger returns no row, so history ids are taken from
+the sequence before the insert (see models.next_ids). Revisions are unique
+per partition only.
+'''
+import datetime
+import gzip
+import os
+import sys
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.core.serializers.json import DjangoJSONEncoder, simplejson
+
+from models import FullHistory, FullHistoryChange, FullHistorySnapshot, Request
+
+encoder = DjangoJSONEncoder()
+
+TABLE = FullHistory._meta.db_table
+ROUTING_FUNCTION = '%s_insert' % TABLE
+ROUTING_TRIGGER = '%s_route' % TABLE
+# Columns written for each archived history, user_pk of older rows comes from the request
+ARCHIVE_COLUMNS = ['id', 'content_type_id', 'object_id', 'revision', 'action_time', 'data',
+                   'request_id', 'site_id', 'action', 'info', 'user_pk']
+
+def month_start(day):
+    return datetime.datetime(day.year, day.month, 1)
+
+def add_months(month, count):
+    year, month = divmod(month.year * 12 + month.month - 1 + count, 12)
+    return datetime.datetime(year, month + 1, 1)
+
+def partition_name(month):
+    return '%s_y%04dm%02d' % (TABLE, month.year, month.month)
+
+def partitions():
+    '''
+    Returns the months having a partition, oldest first
+    '''
+    cursor = connection.cursor()
+    cursor.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                   'JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s', [TABLE])
+    months = []
+    for (name,) in cursor.fetchall():
+        suffix = name[len(TABLE):]
+        months.append(datetime.datetime(int(suffix[2:6]), int(suffix[7:9]), 1))
+    return sorted(months)
+
+def create_partition(month):
+    '''
+    Creates the partition of the month with the indexes of the fullhistory
+    table, returns False if it exists already
+    '''
+    month = month_start(month)
+    if month in partitions():
+        return False
+    qn = connection.ops.quote_name
+    name = partition_name(month)
+    cursor = connection.cursor()
+    cursor.execute('CREATE TABLE %s (CHECK (action_time >= %%s AND action_time < %%s)) INHERITS (%s)' % (qn(name), qn(TABLE)),
+                   [month, add_months(month, 1)])
+    cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (id)' % qn(name))
+    cursor.execute('CREATE UNIQUE INDEX %s ON %s (content_type_id, object_id, revision)' % (qn('%s_revision' % name), qn(name)))
+    cursor.execute('CREATE INDEX %s ON %s (action_time)' % (qn('%s_action_time' % name), qn(name)))
+    cursor.execute('CREATE INDEX %s ON %s (request_id)' % (qn('%s_request_id' % name), qn(name)))
+    cursor.execute('CREATE INDEX %s ON %s (user_pk, action_time, id)' % (qn('%s_user_idx' % name), qn(name)))
+    transaction.commit_unless_managed()
+    return True
+
+def install_routing():
+    '''
+    (Re)creates the insert trigger of the fullhistory table for the current
+    partitions, newest month first
+    '''
+    qn = connection.ops.quote_name
+    branches = []
+    for month in reversed(partitions()):
+        branches.append("%s NEW.action_time >= '%s' AND NEW.action_time < '%s' THEN INSERT INTO %s VALUES (NEW.*);" % (
+            branches and 'ELSIF' or 'IF', month.strftime('%Y-%m-%d'), add_months(month, 1).strftime('%Y-%m-%d'), qn(partition_name(month))))
+    body = 'RETURN NEW;'
+    if branches:
+        body = '%s ELSE RETURN NEW; END IF; RETURN NULL;' % ' '.join(branches)
+    cursor = connection.cursor()
+    cursor.execute('CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$ BEGIN %s END; $$ LANGUAGE plpgsql' % (qn(ROUTING_FUNCTION), body))
+    cursor.execute('SELECT 1 FROM pg_trigger WHERE tgname = %s', [ROUTING_TRIGGER])
+    if cursor.fetchone() is None:
+        cursor.execute('CREATE TRIGGER %s BEFORE INSERT ON %s FOR EACH ROW EXECUTE PROCEDURE %s()' % (qn(ROUTING_TRIGGER), qn(TABLE), qn(ROUTING_FUNCTION)))
+    transaction.commit_unless_managed()
+
+def drop_history_references():
+    '''
+    Drops foreign keys to the fullhistory table (history of FullHistoryChange),
+    they do not see rows in partitions. Returns names of the keys dropped
+    '''
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("SELECT c.conname, r.relname FROM pg_constraint c JOIN pg_class r ON r.oid = c.conrelid "
+                   "JOIN pg_class f ON f.oid = c.confrelid WHERE c.contype = 'f' AND f.relname = %s", [TABLE])
+    dropped = []
+    for name, table in cursor.fetchall():
+        cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (qn(table), qn(name)))
+        dropped.append(name)
+    transaction.commit_unless_managed()
+    return dropped
+
+def parent_months():
+    '''
+    Returns the months of the rows kept in the parent table
+    '''
+    cursor = connection.cursor()
+    cursor.execute("SELECT DISTINCT date_trunc('month', action_time) FROM ONLY %s" % connection.ops.quote_name(TABLE))
+    return sorted([row[0] for row in cursor.fetchall()])
+
+def move_rows(month):
+    '''
+    Moves the rows of the month kept in the parent table to its partition,
+    returns count of rows moved
+    '''
+    qn = connection.ops.quote_name
+    month = month_start(month)
+    params = [month, add_months(month, 1)]
+    cursor = connection.cursor()
+    cursor.execute('INSERT INTO %s SELECT * FROM ONLY %s WHERE action_time >= %%s AND action_time < %%s' % (qn(partition_name(month)), qn(TABLE)), params)
+    count = cursor.rowcount
+    cursor.execute('DELETE FROM ONLY %s WHERE action_time >= %%s AND action_time < %%s' % qn(TABLE), params)
+    transaction.commit_unless_managed()
+    return count
+
+def partition_sizes():
+    '''
+    Returns (month, rows, bytes) of the partitions, rows is the estimate of the planner
+    '''
+    sizes = []
+    cursor = connection.cursor()
+    for month in partitions():
+        cursor.execute('SELECT reltuples::bigint, pg_total_relation_size(oid) FROM pg_class WHERE relname = %s', [partition_name(month)])
+        rows, size = cursor.fetchone()
+        sizes.append((month, rows, size))
+    return sizes
+
+def archive_directory(directory=None):
+    '''
+    Returns the directory of archive files, FULLHISTORY_ARCHIVE_DIR or
+    fullhistoryArchive next to the settings of the project
+    '''
+    return directory or getattr(settings, 'FULLHISTORY_ARCHIVE_DIR', '') or \
+        os.path.join(os.path.dirname(os.path.abspath(sys.modules[settings.SETTINGS_MODULE].__file__)), 'fullhistoryArchive')
+
+def archive_file(month, directory=None):
+    return os.path.join(archive_directory(directory), 'fullhistory_%04d_%02d.jsonl.gz' % (month.year, month.month))
+
+def snapshot_partition(month):
+    '''
+    Keeps a snapshot of every object of the partition of the month at its
+    last revision in the partition, so that versions of the object are
+    rebuilt and its revisions numbered on after the partition is archived.
+    Returns count of objects
+    '''
+    qn = connection.ops.quote_name
+    histories = FullHistory.objects.raw('SELECT DISTINCT ON (content_type_id, object_id) * FROM %s ORDER BY content_type_id, object_id, revision DESC' % qn(partition_name(month_start(month))))
+    count = 0
+    for history in histories:
+        obj = FullHistory.objects.version_of(history.content_type_id, history.object_id, history.revision + 1, audit=False)
+        FullHistorySnapshot.objects.take(history, obj)
+        count += 1
+    return count
+
+@transaction.commit_on_success
+def archive_partition(month, directory=None):
+    '''
+    Writes the histories of the partition of the month to a compressed JSON
+    lines file (one history with the user of its request per line), keeps
+    snapshots of its objects (see snapshot_partition), then drops the
+    partition and the changes recorded for its histories.
+    Returns count of histories archived
+    '''
+    qn = connection.ops.quote_name
+    month = month_start(month)
+    name = partition_name(month)
+    path = archive_file(month, directory)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = path + '.tmp'
+    out = gzip.open(tmp_path, 'wb')
+    connection.cursor()
+    # read with a server side cursor, a partition does not fit in memory
+    cursor = connection.connection.cursor('%s_archive' % name)
+    cursor.execute('SELECT h.id, h.content_type_id, h.object_id, h.revision, h.action_time, h.data, h.request_id, '
+                   'h.site_id, h.action, h.info, COALESCE(h.user_pk, r.user_pk) FROM %s h LEFT JOIN %s r ON r.id = h.request_id ORDER BY h.id' % (qn(name), qn(Request._meta.db_table)))
+    count = 0
+    while True:
+        rows = cursor.fetchmany(5000)
+        if not rows:
+            break
+        for row in rows:
+            out.write(encoder.encode(dict(zip(ARCHIVE_COLUMNS, row))) + '\n')
+        count += len(rows)
+    cursor.close()
+    out.close()
+    os.rename(tmp_path, path)
+    snapshot_partition(month)
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE history_id IN (SELECT id FROM %s)' % (qn(FullHistoryChange._meta.db_table), qn(name)))
+    cursor.execute('DROP TABLE %s' % qn(name))
+    install_routing()
+    return count
+
+def search_archive(start, end, user_pk=None, directory=None):
+    '''
+    Yields unsaved FullHistory entries archived with action_time from start
+    up to end (datetimes, end excluded), and of the user if user_pk is given
+    '''
+    time_format = '%s %s' % (encoder.DATE_FORMAT, encoder.TIME_FORMAT)
+    month = month_start(start)
+    while month < end:
+        path = archive_file(month, directory)
+        month = add_months(month, 1)
+        if not os.path.exists(path):
+            continue
+        for line in gzip.open(path, 'rb'):
+            row = simplejson.loads(line)
+            if user_pk is not None and row['user_pk'] != int(user_pk):
+                continue
+            action_time = datetime.datetime.strptime(row['action_time'], time_format)
+            if action_time < start or action_time >= end:
+                continue
+            yield FullHistory(id=row['id'], content_type_id=row['content_type_id'], object_id=row['object_id'],
+                              revision=row['revision'], action_time=action_time, _data=row['data'],
+                              request_id=row['request_id'], user_pk=row['user_pk'], site_id=row['site_id'],
+                              action=row['action'], info=row['info'])
@@ -0,0 +1 @@
+CREATE INDEX fullhistory_fullhistory_user_idx ON fullhistory_fullhistory (user_pk, action_time, id);
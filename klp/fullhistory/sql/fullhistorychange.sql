@@ -0,0 +1,3 @@
+CREATE INDEX fullhistory_fullhistorychange_field_idx ON fullhistory_fullhistorychange (field_name, old_value, action_time);
+CREATE INDEX fullhistory_fullhistorychange_object_idx ON fullhistory_fullhistorychange (content_type_id, object_id);
+CREATE INDEX fullhistory_fullhistorychange_user_idx ON fullhistory_fullhistorychange (user_pk, action_time);
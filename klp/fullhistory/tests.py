@@ -1,4 +1,5 @@
 import unittest
+import datetime
 
 from django.test import TestCase
 from django.test.client import Client
@@ -196,6 +197,190 @@ class FullHistoryTest(TestCase):
                 self.assertEquals(first.pk, last.pk)
                 break
     
+    def test_create_histories(self):
+        fullhistory.end_session()
+        t3a = Test3Model(field1="test1", field2=5)
+        t3a.save()
+        t3b = Test3Model(field1="test2", field2=6)
+        t3b.save()
+        t3a.field2 = 7
+        t3b.field2 = 8
+        Test3Model.objects.filter(pk=t3a.pk).update(field2=7)
+        Test3Model.objects.filter(pk=t3b.pk).update(field2=8)
+        histories = fullhistory.create_histories([t3a, t3b], 'U')
+        self.assertEqual(2, len(histories))
+        for t3, history in zip([t3a, t3b], histories):
+            self.assertNotEqual(None, history.pk)
+            self.assertEqual(1, history.revision)
+            self.assertEqual('U', history.action)
+            self.assertEqual(2, len(FullHistory.objects.actions_for_object(t3)))
+            FullHistory.objects.audit(t3)
+        self.assertEqual([], fullhistory.create_histories([], 'C'))
+
+    def test_changes(self):
+        fullhistory.end_session()
+        t3 = Test3Model(field1="test1", field2=2)
+        t3.save()
+        t3.field2 = 1
+        t3.save()
+        changes = FullHistoryChange.objects.filter(object_id=t3.pk, content_type=ContentType.objects.get_for_model(t3))
+        # a creation has one change without field name, values are in the data
+        self.assertEqual([''], [change.field_name for change in changes.filter(action='C')])
+        change = changes.get(action='U', field_name='field2')
+        self.assertEqual(('2', '1'), (change.old_value, change.new_value))
+        self.assertEqual(1, change.history.revision)
+        pk = t3.pk
+        t3.delete()
+        self.assertEqual(1, changes.filter(object_id=pk, action='D').count())
+
+    def test_lazy_initial(self):
+        fullhistory.end_session()
+        t3 = Test3Model(field1="test1", field2=5)
+        t3.save()
+        t3 = Test3Model.objects.get(pk=t3.pk)
+        # only field values are kept when an object is loaded
+        self.assertEqual(None, t3._fullhistory[1])
+        t3.field2 = 6
+        t3.save()
+        history = FullHistory.objects.actions_for_object(t3)[1]
+        self.assertEqual((5, 6), tuple(history.data['field2']))
+        self.assertFalse('field1' in history.data)
+        FullHistory.objects.audit(t3)
+
+    def test_snapshots(self):
+        from django.conf import settings
+        old_every = getattr(settings, 'FULLHISTORY_SNAPSHOT_EVERY', 50)
+        settings.FULLHISTORY_SNAPSHOT_EVERY = 2
+        try:
+            fullhistory.end_session()
+            t3 = Test3Model(field1="test1", field2=1)
+            t3.save()
+            for value in range(2, 6):
+                t3.field2 = value
+                t3.save()
+            when = datetime.datetime.now()
+            FullHistory.objects.audit(t3)
+            snapshot = FullHistorySnapshot.objects.nearest(ContentType.objects.get_for_model(t3), t3.pk)
+            self.assertEqual(4, snapshot.revision)
+            self.assertEqual(5, snapshot.data['field2'])
+            # older versions are rebuilt from older snapshots or from create
+            self.assertEqual(2, FullHistory.objects.get_version(t3, version=2)['field2'])
+            self.assertEqual(5, FullHistory.objects.audit(t3)['field2'])
+            t3.field2 = 6
+            t3.save()
+            versions = FullHistory.objects.get_versions_at(Test3Model, [t3.pk], when)
+            self.assertEqual(5, versions[t3.pk]['field2'])
+            pk = t3.pk
+            t3.delete()
+            self.assertEqual({}, FullHistory.objects.get_versions_at(Test3Model, [pk], datetime.datetime.now()))
+        finally:
+            settings.FULLHISTORY_SNAPSHOT_EVERY = old_every
+            fullhistory.end_session()
+
+    def test_archive(self):
+        import shutil
+        import tempfile
+        from partitions import month_start, create_partition, install_routing, drop_history_references, move_rows, archive_partition, search_archive
+        fullhistory.end_session()
+        t3 = Test3Model(field1="test1", field2=1)
+        t3.save()
+        t3.field2 = 2
+        t3.save()
+        ct = ContentType.objects.get_for_model(t3)
+        month = month_start(datetime.datetime.now())
+        directory = tempfile.mkdtemp()
+        try:
+            drop_history_references()
+            create_partition(month)
+            install_routing()
+            move_rows(month)
+            archive_partition(month, directory)
+            self.assertEqual(0, FullHistory.objects.filter(content_type=ct, object_id=t3.pk).count())
+            archived = [history for history in search_archive(month, datetime.datetime.now() + datetime.timedelta(days=1), directory=directory) if history.content_type_id == ct.id and history.object_id == t3.pk]
+            self.assertEqual([0, 1], sorted([history.revision for history in archived]))
+            # the version is rebuilt from the snapshot of the archived revisions
+            self.assertEqual(2, FullHistory.objects.audit(t3)['field2'])
+            # versions before the snapshot can not be rebuilt any more
+            self.assertRaises(MissingRevisions, FullHistory.objects.get_version, t3, version=1)
+            self.assertRaises(MissingRevisions, FullHistory.objects.get_versions_at, Test3Model, [t3.pk], min([history.action_time for history in archived]))
+            self.assertRaises(MissingRevisions, FullHistory.objects.get_version, model=Test3Model, pk=t3.pk + 1000)
+            t3.field2 = 3
+            t3.save()
+            self.assertEqual([2], [history.revision for history in FullHistory.objects.actions_for_object(t3)])
+            self.assertEqual(3, FullHistory.objects.audit(t3)['field2'])
+        finally:
+            shutil.rmtree(directory)
+            fullhistory.end_session()
+
+    def test_buffered_histories(self):
+        from django.conf import settings
+        from django.http import HttpRequest, HttpResponse
+        old_buffer = getattr(settings, 'FULLHISTORY_BUFFER', False)
+        settings.FULLHISTORY_BUFFER = True
+        try:
+            request = HttpRequest()
+            request.path = '/test/'
+            request.user = User.objects.get(username='test')
+            fullhistory.FullHistoryMiddleware().process_request(request)
+            t3 = Test3Model(field1="test1", field2=5)
+            t3.save()
+            t3.field2 = 6
+            t3.save()
+            self.assertEqual(0, len(FullHistory.objects.actions_for_object(t3)))
+            fullhistory.FullHistoryMiddleware().process_response(request, HttpResponse())
+            actions = FullHistory.objects.actions_for_object(t3)
+            self.assertEqual(['C', 'U'], [history.action for history in actions])
+            self.assertEqual([0, 1], [history.revision for history in actions])
+            self.assertEqual([request.user.pk] * 2, [history.user_pk for history in actions])
+            FullHistory.objects.audit(t3)
+        finally:
+            settings.FULLHISTORY_BUFFER = old_buffer
+            fullhistory.end_session()
+
+    def test_discarded_histories(self):
+        from django.conf import settings
+        from django.http import HttpRequest, HttpResponseServerError
+        old_buffer = getattr(settings, 'FULLHISTORY_BUFFER', False)
+        settings.FULLHISTORY_BUFFER = True
+        try:
+            request = HttpRequest()
+            request.path = '/test/'
+            request.user = User.objects.get(username='test')
+            middleware = fullhistory.FullHistoryMiddleware()
+            middleware.process_request(request)
+            t3 = Test3Model(field1="test1", field2=5)
+            t3.save()
+            # the view failed, its writes are rolled back by the transaction
+            middleware.process_exception(request, Exception())
+            middleware.process_response(request, HttpResponseServerError())
+            self.assertEqual(0, len(FullHistory.objects.actions_for_object(t3)))
+            middleware.process_request(request)
+            t3.field2 = 6
+            t3.save()
+            middleware.process_response(request, HttpResponseServerError())
+            self.assertEqual(0, len(FullHistory.objects.actions_for_object(t3)))
+        finally:
+            settings.FULLHISTORY_BUFFER = old_buffer
+            fullhistory.end_session()
+
+    def test_user_actions(self):
+        from django.http import HttpRequest, HttpResponse
+        fullhistory.end_session()
+        t3 = Test3Model(field1="test1", field2=5)
+        t3.save()
+        # histories saved without a request have no user
+        self.assertEqual(None, FullHistory.objects.actions_for_object(t3)[0].user_pk)
+        request = HttpRequest()
+        request.path = '/test/'
+        request.user = User.objects.get(username='test')
+        fullhistory.FullHistoryMiddleware().process_request(request)
+        t3.field2 = 6
+        t3.save()
+        fullhistory.FullHistoryMiddleware().process_response(request, HttpResponse())
+        actions = FullHistory.objects.user_actions(request.user).filter(object_id=t3.pk)
+        self.assertEqual(['U'], [history.action for history in actions])
+        self.assertEqual(request.user.pk, FullHistoryChange.objects.get(history=actions[0]).user_pk)
+
     def test_django11(self):
         if not django1_1:
             return
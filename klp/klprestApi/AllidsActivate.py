@@ -11,6 +11,7 @@ from django.http import HttpResponse,HttpResponseRedirect
 from django.shortcuts import render_to_response
 
 from schools.models import *
+from schools.receivers import KLP_Bulk_Changed
 from schools.forms import *
 
 from django.contrib.auth.models import User
@@ -82,7 +83,9 @@ def KLP_Activation(request):
                 isExecute=True   
                 idlist2=obj2.values_list('id')
                 idstr=','.join(str(v1[0]) for v1 in idlist2)    
-                obj2.update(active=2)      
+                obj2.update(active=2)
+                # activated without signals, clear cached tree nodes
+                KLP_Bulk_Changed(obj2.model)
 	        
 	        SendingMail(idstr,obj2.model._meta.module_name)
 	        receiver=settings.REPORTMAIL_RECEIVER
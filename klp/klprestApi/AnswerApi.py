@@ -14,6 +14,10 @@ from schools.models import *
 from django_restapi.authentication import *
 
 from schools.receivers import KLP_obj_Perm
+from schools.bulk import bulk_insert, bulk_update
+from fullhistory import create_histories
+from django.db import transaction
+from decimal import Decimal, InvalidOperation
          
 def KLP_DataEnry(request):
         return HttpResponse(KLP_ChangeAns(permitted_methods=('POST','GET')).read(request))
@@ -22,93 +26,182 @@ def KLP_DataEnry(request):
 class KLP_ChangeAns(Resource):
     """ To Create and Edit Answers answer/data/entry/"""
     def read(self,request):
-    	user = request.user # get Logged in user
+        user = request.user # get Logged in user
         student =  request.POST.get('student')    #  get Student 
         programId = request.POST.get('programId') #  get programme id
         assessmentId = request.POST.get('assessmentId') # get Assessment Id
         student_groupId = request.POST.get('student_groupId') #  get Student group id
         student_groupObj = StudentGroup.objects.filter(pk = student_groupId).values("institution")[0]  # get SG Object based on id
         instObj = Institution.objects.filter(pk=student_groupObj["institution"]).defer("boundary")[0]  # get Institution Object based on id
-        studentObj = Student.objects.filter(pk=student).defer("child")[0]   # get student Object based on id
         Questions_list = Question.objects.filter(assessment__id=assessmentId).defer("assessment")  # get questions under assessment
         assessmentObj = Assessment.objects.filter(pk=assessmentId).defer("programme")[0]  # get assessment Object based on id
-        dobleEntReq = assessmentObj.doubleEntry
-        if dobleEntReq:
-        	dE = 1
-        else:
-        	dE = 2
         #Checking user permission based on institution and assessment
         KLP_obj_Perm(user, instObj, "Acess", assessmentObj)
+        # get each text field value (student_<studentId>_<questionId>)
+        ansValues = {}
         for question in Questions_list:
-        	textField = 'student_%s_%s' %(student, question.id)        	
-        	textFieldVal = request.POST.get(textField)  # get each text field values
-        	try:
-        		# If answer object already exists update data.
-        		ansObj = Answer.objects.get(question = question, student = studentObj)
-        		if textFieldVal:
-        			if textFieldVal.lower() == 'ab':
-        				# If text field value is ab(absent) then change answerGrade and answerScore to none and status to -99999
-        				ansObj.answerGrade = None
-        				ansObj.answerScore = None
-        				ansObj.status = -99999
-        			elif textFieldVal.lower() == 'uk':
-        				# If text field value is uk(unknown) then change answerGrade and answerScore to none and status to -1
-        				ansObj.answerGrade = None
-        				ansObj.answerScore = None
-        				ansObj.status = -1
-        			elif question.questionType == 2:
-        				# else question type is 2(Grade) then change status to none and store textfield value in answerGrade
-        				ansObj.status = None
-        				ansGrade = textFieldVal
-        				try:
-        					ansGrade = textFieldVal.upper()
-        				except:
-        					pass
-        				ansObj.answerGrade = ansGrade
-        			elif question.questionType == 3:	
-        				ansObj.answerText = textFieldVal
-        			else:
-        				# else question type is 1(Marks) then change status to none and store textfield value in answerScore
-        				ansObj.status = None	
-        				ansScore = '%.2f' %(float(ansObj.answerScore))
-        				textScore = '%.2f' %(float(textFieldVal))
-        				if ansScore != textScore:
-        					ansObj.answerScore = textFieldVal
-        					
-        			if ansObj.doubleEntry == 1 and ansObj.user1 == user:
-        				# if the doubleEntry value for answer is 1(only first user enter data) and user1 is same as logged in user change lastmodifiedBy to current user
-					ansObj.lastmodifiedBy = user
-				else:
-					# else update doubleEntry to 2(second user also submits data), lastmodifiedBy and user2 to logged user
-					ansObj.doubleEntry = 2
-					ansObj.lastmodifiedBy = user
-				       	ansObj.user2 = user
-        			ansObj.save()	# Save Answer object
-        	except :
-        		if textFieldVal:
-        			# If Answer object not exists create new answer object
-        			status, answerGrade, answerScore=None, None, None
-        			if textFieldVal.lower() == 'ab':
-					# If text field value is ab(absent) then set status to -99999
-					status = -99999
-				elif textFieldVal.lower() == 'uk':
-					# If text field value is uk(unknown) then set status to -1
-					status = -1
-				elif question.questionType == 2:
-					# else if  question type is 2(Grade) then store textfield value in answerGrade
-        				answerGrade = textFieldVal
-        				try:
-        					answerGrade = textFieldVal.upper()
-        				except:
-        					pass
-        			else:
-        				# else if  question type is 1(Marks) then store textfield value in answerScore
-        				answerScore = textFieldVal
-				ansObj = Answer(question=question, student=studentObj, doubleEntry=dE, status=status, answerGrade=answerGrade, answerScore=answerScore, lastmodifiedBy=user, user1=user)
-                                #ansObj = Answer(question=question, content_type = cTObj, object_id = savId, doubleEntry=dE, status=status, answerGrade=answerGrade, answerScore=answerScore, answerText=answerText, lastmodifiedBy=user, user1=user)				
-        			ansObj.save()
-	        
-	return "Data Saved"
+            ansValues[(int(student), question.id)] = request.POST.get('student_%s_%s' %(student, question.id))
+        KLP_Save_Answers(user, assessmentObj, Questions_list, ansValues)
+        return "Data Saved"
+
+
+def KLP_Page_DataEntry(request):
+    """ To Create and Edit Answers of all students in the grid page at once answer/data/entry/page/"""
+    """ Takes student group, assessment and answers as json {"<student id>": {"<question id>": "<value>"}} and returns result of each cell keyed by text field name (student_<student id>_<question id>)"""
+    user = request.user # get Logged in user
+    assessmentId = request.POST.get('assessmentId') # get Assessment Id
+    student_groupId = request.POST.get('student_groupId') #  get Student group id
+    try:
+        answers = simplejson.loads(request.POST.get('answers') or '{}')
+    except ValueError:
+        return HttpResponse(simplejson.dumps({'isSuccess':False, 'error':'Answers are not valid json'}), status=400, content_type='application/json; charset=utf-8')
+    student_groupObj = StudentGroup.objects.filter(pk = student_groupId).values("institution")[0]  # get SG Object based on id
+    instObj = Institution.objects.filter(pk=student_groupObj["institution"]).defer("boundary")[0]  # get Institution Object based on id
+    assessmentObj = Assessment.objects.filter(pk=assessmentId).defer("programme")[0]  # get assessment Object based on id
+    #Checking user permission based on institution and assessment, once for the whole page
+    KLP_obj_Perm(user, instObj, "Acess", assessmentObj)
+    Questions_list = Question.objects.filter(assessment__id=assessmentId).defer("assessment")  # get questions under assessment
+    questionDict = dict([(question.id, question) for question in Questions_list])
+    # Only students of this student group can be saved from this page
+    cells = KLP_Answer_Cells(answers)
+    studentIds = set([key[0] for key, textFieldVal in cells if isinstance(key, tuple)])
+    groupStudents = set(Student_StudentGroupRelation.objects.filter(student_group__id=student_groupId, student__id__in=studentIds, academic=current_academic, active=2).values_list('student', flat=True))
+    ansValues, result = {}, {}
+    for key, textFieldVal in cells:
+        if not isinstance(key, tuple):
+            # malformed student or question id, reported with the name it was sent with
+            result['student_%s' %key] = 'invalid'
+            continue
+        cellName = 'student_%s_%s' %key
+        question = questionDict.get(key[1])
+        if textFieldVal is None or textFieldVal == '':
+            result[cellName] = 'empty'
+        elif question is None or key[0] not in groupStudents or isinstance(textFieldVal, (dict, list)) or not KLP_Valid_Answer(question, unicode(textFieldVal)):
+            result[cellName] = 'invalid'
+        else:
+            # numbers in json are stored as text field values
+            ansValues[key] = unicode(textFieldVal)
+    for key, status in KLP_Save_Answers(user, assessmentObj, Questions_list, ansValues).items():
+        result['student_%s_%s' %key] = status
+    return HttpResponse(simplejson.dumps({'isSuccess':True, 'result':result}), content_type='application/json; charset=utf-8')
+
+
+def KLP_Answer_Cells(answers):
+    """ Returns ((student id, question id), value) of each cell of the answers json. Cells with ids that are not numbers have the key '<student id>_<question id>' (or the student id when its answers are not an object) in place of the ids"""
+    cells = []
+    if not isinstance(answers, dict):
+        return cells
+    for studId, qAnswers in answers.items():
+        if not isinstance(qAnswers, dict):
+            cells.append((studId, qAnswers))
+            continue
+        for qId, textFieldVal in qAnswers.items():
+            try:
+                key = (int(studId), int(qId))
+            except ValueError:
+                key = '%s_%s' %(studId, qId)
+            cells.append((key, textFieldVal))
+    return cells
+
+
+def KLP_Valid_Answer(question, textFieldVal):
+    """ Checks text field value can be stored for the question, grades should fit answerGrade and marks should be numbers which fit answerScore (less than 1000 with 2 decimals)"""
+    if textFieldVal.lower() in ['ab', 'uk']:
+        return True
+    if question.questionType == 2:
+        return len(textFieldVal) <= Answer._meta.get_field('answerGrade').max_length
+    try:
+        score = Decimal(textFieldVal)
+    except InvalidOperation:
+        return False
+    # nan and infinity are not finite
+    return score.is_finite() and abs(score) < 1000 and score.as_tuple()[2] >= -2
+
+
+def KLP_Update_Answer(ansObj, question, textFieldVal, user):
+    """ Applies text field value to the existing answer object, same as answer edit in data entry"""
+    if textFieldVal.lower() == 'ab':
+        # If text field value is ab(absent) then change answerGrade and answerScore to none and status to -99999
+        ansObj.answerGrade = None
+        ansObj.answerScore = None
+        ansObj.status = -99999
+    elif textFieldVal.lower() == 'uk':
+        # If text field value is uk(unknown) then change answerGrade and answerScore to none and status to -1
+        ansObj.answerGrade = None
+        ansObj.answerScore = None
+        ansObj.status = -1
+    elif question.questionType == 2:
+        # else question type is 2(Grade) then change status to none and store textfield value in answerGrade
+        ansObj.status = None
+        ansObj.answerGrade = textFieldVal.upper()
+    elif question.questionType != 3:
+        # else question type is 1(Marks) then change status to none and store textfield value in answerScore
+        ansObj.status = None
+        if ansObj.answerScore is None or '%.2f' %(float(ansObj.answerScore)) != '%.2f' %(float(textFieldVal)):
+            ansObj.answerScore = textFieldVal
+    if ansObj.doubleEntry == 1 and ansObj.user1_id == user.id:
+        # if the doubleEntry value for answer is 1(only first user enter data) and user1 is same as logged in user change lastmodifiedBy to current user
+        ansObj.lastmodifiedBy = user
+    else:
+        # else update doubleEntry to 2(second user also submits data), lastmodifiedBy and user2 to logged user
+        ansObj.doubleEntry = 2
+        ansObj.lastmodifiedBy = user
+        ansObj.user2 = user
+
+
+def KLP_New_Answer(studentId, question, textFieldVal, user, dE):
+    """ Returns new (unsaved) answer object for the text field value"""
+    status, answerGrade, answerScore=None, None, None
+    if textFieldVal.lower() == 'ab':
+        # If text field value is ab(absent) then set status to -99999
+        status = -99999
+    elif textFieldVal.lower() == 'uk':
+        # If text field value is uk(unknown) then set status to -1
+        status = -1
+    elif question.questionType == 2:
+        # else if  question type is 2(Grade) then store textfield value in answerGrade
+        answerGrade = textFieldVal.upper()
+    else:
+        # else if  question type is 1(Marks) then store textfield value in answerScore
+        answerScore = textFieldVal
+    return Answer(question=question, student_id=studentId, doubleEntry=dE, status=status, answerGrade=answerGrade, answerScore=answerScore, lastmodifiedBy=user, user1=user)
+
+
+@transaction.commit_on_success
+def KLP_Save_Answers(user, assessmentObj, Questions_list, ansValues):
+    """ This method saves answers for many students and questions at once"""
+    """ ansValues maps (student id, question id) to text field value. Existing answers are loaded with one query and written back with one bulk insert and one bulk update, fullhistory is recorded for all of them in one go. Returns (student id, question id) -> 'created'/'updated' """
+    if assessmentObj.doubleEntry:
+        dE = 1
+    else:
+        dE = 2
+    questionDict = dict([(question.id, question) for question in Questions_list])
+    studentIds = set([key[0] for key in ansValues])
+    # Query all existing answers of the students for these questions
+    existing = {}
+    for ansObj in Answer.objects.filter(student__id__in=studentIds, question__id__in=questionDict.keys()):
+        existing[(ansObj.student_id, ansObj.question_id)] = ansObj
+    newAnswers, updAnswers, result = [], [], {}
+    for key, textFieldVal in ansValues.items():
+        question = questionDict.get(key[1])
+        if not textFieldVal or question is None:
+            continue
+        ansObj = existing.get(key)
+        if ansObj:
+            # If answer object already exists update data.
+            KLP_Update_Answer(ansObj, question, textFieldVal, user)
+            updAnswers.append(ansObj)
+            result[key] = 'updated'
+        else:
+            # If Answer object not exists create new answer object
+            newAnswers.append(KLP_New_Answer(key[0], question, textFieldVal, user, dE))
+            result[key] = 'created'
+    bulk_insert(newAnswers)
+    bulk_update(updAnswers, ['answerScore', 'answerGrade', 'status', 'doubleEntry', 'user2', 'lastmodifiedBy'])
+    # Store information in fullhistory, since save signals are not fired for bulk writes
+    create_histories(newAnswers, 'C')
+    create_histories(updAnswers, 'U')
+    return result
 
 
 def KLP_DataValidation(request):
@@ -116,46 +209,87 @@ def KLP_DataValidation(request):
     validateId = request.POST.get('validateField')  #  Get ValidateId (student and question id)
     validateValue = request.POST.get('validateValue')  #  Get Text field value to validate
     listIds = validateId.split('_')   
-    # Query Answer object based on student and question id
-    ansObj = Answer.objects.filter(student__id=listIds[1], question__id=listIds[2]).defer("student","user1", "user2", "lastmodifiedBy")[0]    
+    # Query Answer along with question type based on student and question id
+    ansObj = Answer.objects.filter(student__id=listIds[1], question__id=listIds[2]).values('doubleEntry', 'status', 'answerGrade', 'answerScore', 'question__questionType')[0]
+    return HttpResponse(simplejson.dumps(KLP_Validate_Answer(ansObj, validateValue)))
+
+
+def KLP_Validation_Key(validateId):
+    """ Returns (student id, question id) of field id student_<student id>_<question id>, or None if it is malformed"""
+    listIds = unicode(validateId).split('_')
+    try:
+        return int(listIds[1]), int(listIds[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def KLP_Batch_DataValidation(request):
+    """ To Validate data for Doble Entry of all fields in a row or page answer/data/validation/batch/"""
+    """ Takes json {"student_<student id>_<question id>": "<value>"} and returns true/false for each field, malformed fields are false"""
+    try:
+        validateFields = simplejson.loads(request.POST.get('validateFields') or '{}')
+    except ValueError:
+        return HttpResponse(simplejson.dumps({'isSuccess':False, 'error':'Fields are not valid json'}), status=400, content_type='application/json; charset=utf-8')
+    if not isinstance(validateFields, dict):
+        return HttpResponse(simplejson.dumps({'isSuccess':False, 'error':'Fields are not a json object'}), status=400, content_type='application/json; charset=utf-8')
+    keys = dict([(validateId, KLP_Validation_Key(validateId)) for validateId in validateFields])
+    studentIds = set([key[0] for key in keys.values() if key])
+    questionIds = set([key[1] for key in keys.values() if key])
+    # Query Answers along with question type of all fields at once
+    ansDict = {}
+    for ansObj in Answer.objects.filter(student__id__in=studentIds, question__id__in=questionIds).values('student', 'question', 'doubleEntry', 'status', 'answerGrade', 'answerScore', 'question__questionType'):
+        ansDict[(ansObj['student'], ansObj['question'])] = ansObj
+    respDict = {}
+    for validateId, validateValue in validateFields.items():
+        if keys[validateId] is None:
+            respDict[validateId] = False
+            continue
+        ansObj = ansDict.get(keys[validateId])
+        if validateValue is not None:
+            # json numbers are compared as text field values
+            validateValue = unicode(validateValue)
+        # If there is no first entry there is nothing to match with
+        respDict[validateId] = ansObj is None or KLP_Validate_Answer(ansObj, validateValue)
+    return HttpResponse(simplejson.dumps(respDict), content_type='application/json; charset=utf-8')
+
+
+def KLP_Validate_Answer(ansObj, validateValue):
+    """ Checks text field value matches with first entry of the answer (values() row with question__questionType)"""
     respStr = False
-    dEntry = int(ansObj.doubleEntry)  # reads dE value
+    dEntry = int(ansObj['doubleEntry'])  # reads dE value
     if dEntry in [0,2]:
         # if dEntry in 0 0r 2 return true
-    	respStr = True
-    else:
-    	# else check text field value
-    	if validateValue:    		
-	    	if validateValue.lower() == 'ab':
-	    		# If text field value is ab(absent) and answer status is -99999 then return true
-	    		if ansObj.status == -99999:
-	    			respStr = True
-	    	elif validateValue.lower() == 'uk':
-	    		# If text field value is uk(unknown) and answer status is -1 then return true
-	    		if ansObj.status == -1:
-	    			respStr = True
-	    	elif ansObj.question.questionType == 2:	    	
-	    	    try:
-	    	    	    # If question type is 2(Grade) then match with answer grade if matches return true
-		    	    if ansObj.answerGrade.lower() == validateValue.lower():
-		    	        respStr = True
-		    	    elif float(ansObj.answerGrade) == float(validateValue):
-		    	    	respStr = True
-		    except:
-		    	pass
-	    	else:
-	    	    try:
-	    	    	    # If question type is 1(marks) then match with answer score if matches return true
-		    	    if float(ansObj.answerScore) == float(validateValue):
-		    	        respStr = True
-	    	    except:
-	    	    	pass
-	else:
-		respStr = False
-    return HttpResponse(simplejson.dumps(respStr))
+        respStr = True
+    elif validateValue:
+        # else check text field value
+        if validateValue.lower() == 'ab':
+            # If text field value is ab(absent) and answer status is -99999 then return true
+            respStr = ansObj['status'] == -99999
+        elif validateValue.lower() == 'uk':
+            # If text field value is uk(unknown) and answer status is -1 then return true
+            respStr = ansObj['status'] == -1
+        elif ansObj['question__questionType'] == 2:
+            try:
+                # If question type is 2(Grade) then match with answer grade if matches return true
+                if ansObj['answerGrade'].lower() == validateValue.lower():
+                    respStr = True
+                elif float(ansObj['answerGrade']) == float(validateValue):
+                    respStr = True
+            except:
+                pass
+        else:
+            try:
+                # If question type is 1(marks) then match with answer score if matches return true
+                if float(ansObj['answerScore']) == float(validateValue):
+                    respStr = True
+            except:
+                pass
+    return respStr
 
         
 urlpatterns = patterns('', 
    url(r'^answer/data/entry/$', KLP_DataEnry),
+   url(r'^answer/data/entry/page/$', KLP_Page_DataEntry),
    url(r'^answer/data/validation/$', KLP_DataValidation),
+   url(r'^answer/data/validation/batch/$', KLP_Batch_DataValidation),
 )        
@@ -0,0 +1,24 @@
+"""
+JobApi is used to show status of background jobs
+"""
+from django.conf.urls.defaults import *
+from django.http import HttpResponse, HttpResponseForbidden
+from django.shortcuts import get_object_or_404
+from django.utils import simplejson
+from django.core.serializers.json import DjangoJSONEncoder
+from schools.models import Background_Job
+
+
+def KLP_Job_Status(request, job_id):
+	""" This method returns status, output and times of a job (json), the UI polls it until the job is done or failed"""
+	user = request.user
+	job = get_object_or_404(Background_Job, pk=job_id)
+	if not (user.is_superuser or user.is_staff or (user.id and job.createdBy_id == user.id)):
+		# only the user who queued the job and admins can see it
+		return HttpResponseForbidden("Insufficient Previliges")
+	respDict = {'id':job.id, 'command':job.command, 'status':job.get_status_display(), 'isFinished':job.status in [2, 3], 'progress':job.progress, 'creationDate':job.creationDate, 'startedDate':job.startedDate, 'finishedDate':job.finishedDate}
+	return HttpResponse(simplejson.dumps(respDict, cls=DjangoJSONEncoder), content_type='application/json; charset=utf-8')
+
+urlpatterns = patterns('',
+   url(r'^job/(?P<job_id>\d+)/status/?$', KLP_Job_Status),
+)
@@ -11,46 +11,166 @@ from django_restapi.receiver import *
 from schools.models import *
 
 from schools.receivers import KLP_user_Perm
-from fullhistory.models import FullHistory
-from django.db.models import Q
+from fullhistory.models import FullHistory, ACTIONS
+from fullhistory.fullhistory import registered_models
+from fullhistory.partitions import search_archive
+from django.db import connection
+from django.http import HttpResponse
+from django.utils.http import urlencode
+from cStringIO import StringIO
+import csv
 import datetime
+import heapq
 from django.contrib.contenttypes.models import ContentType
 
+# Number of histories shown in a page of the audit trail
+AUDIT_PAGE_SIZE = 100
+# Number of histories read at a time for the csv export
+AUDIT_CSV_CHUNK = 1000
+AUDIT_CSV_COLUMNS = ['Id', 'Content Type', 'Object Id', 'Revision', 'Action Time', 'Action', 'Request Id', 'Data', 'Info']
+# Format of the (action_time, id) key of a page in urls
+AUDIT_KEY_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def KLP_Audit_Date(value, default):
+    """ This method returns datetime of the start of a dd-mm-yyyy date, or of the default date """
+    try:
+        day, month, year = [int(part) for part in value.split('-')]
+        return datetime.datetime(year, month, day)
+    except (AttributeError, ValueError):
+        return datetime.datetime(default.year, default.month, default.day)
+
+def KLP_Audit_Filters(params):
+    """ This method returns the filters of the audit trail from request parameters. The end date is included, histories are selected before the start of the next day """
+    today = datetime.date.today()
+    startTime = KLP_Audit_Date(params.get('startDate'), today)
+    endTime = KLP_Audit_Date(params.get('endDate'), today)
+    filters = {'selUser':int(params.get('selUser')), 'startDate':startTime.strftime('%d-%m-%Y'), 'endDate':endTime.strftime('%d-%m-%Y'), 'startTime':startTime, 'endTime':endTime + datetime.timedelta(days=1), 'contentType':None, 'action':None}
+    if params.get('contentType'):
+        filters['contentType'] = int(params.get('contentType'))
+    if params.get('action') in dict(ACTIONS):
+        filters['action'] = params.get('action')
+    return filters
+
+def KLP_Audit_Query(filters):
+    """ This method returns queryset of the histories of the filters, it is read with the (user_pk, action_time, id) index """
+    histories = FullHistory.objects.filter(user_pk=filters['selUser'], action_time__gte=filters['startTime'], action_time__lt=filters['endTime']).select_related('content_type')
+    if filters['contentType']:
+        histories = histories.filter(content_type=filters['contentType'])
+    if filters['action']:
+        histories = histories.filter(action=filters['action'])
+    return histories
+
+def KLP_Audit_Archive(filters, after=None, before=None, size=None):
+    """ This method returns archived histories of the filters (see fullhistory.partitions) after (or before) the (action_time, id) key of another page, ordered by (action_time, id). With size only the size histories next to the key are kept. Only archive files of months from (or up to) the key are read, pages of months kept in the database read none """
+    startTime, endTime = filters['startTime'], filters['endTime']
+    if after is not None:
+        startTime = max(startTime, after[0])
+    if before is not None:
+        endTime = min(endTime, before[0] + datetime.timedelta(microseconds=1))
+    if startTime >= endTime:
+        return []
+    archived = (history for history in search_archive(startTime, endTime, filters['selUser']) if KLP_Audit_Match(history, filters, after, before))
+    if size is None:
+        archived = list(archived)
+    elif before is not None:
+        archived = heapq.nlargest(size, archived, key=KLP_Audit_Key)
+    else:
+        archived = heapq.nsmallest(size, archived, key=KLP_Audit_Key)
+    archived.sort(key=KLP_Audit_Key)
+    for history in archived:
+        history.content_type = ContentType.objects.get_for_id(history.content_type_id)
+    return archived
+
+def KLP_Audit_Match(history, filters, after=None, before=None):
+    """ This method checks an archived history is of the filters and after (or before) the key """
+    if filters['contentType'] and history.content_type_id != filters['contentType']:
+        return False
+    if filters['action'] and history.action != filters['action']:
+        return False
+    key = KLP_Audit_Key(history)
+    return (after is None or key > after) and (before is None or key < before)
+
+def KLP_Audit_Key(history):
+    return (history.action_time, history.id)
+
+def KLP_Audit_Page(filters, after=None, before=None, size=AUDIT_PAGE_SIZE, archived=None):
+    """ This method returns the histories of a page with the rows after (or before) the (action_time, id) key of another page, and whether there are previous and next pages. Rows are compared with the key in the index, so a page costs the same at any position. Archived histories are read for the page unless all of them are given (archived) """
+    table = connection.ops.quote_name(FullHistory._meta.db_table)
+    keyWhere = '(%s."action_time", %s."id") %s (%%s, %%s)'
+    histories = KLP_Audit_Query(filters)
+    if archived is None:
+        archived = KLP_Audit_Archive(filters, after, before, size + 1)
+    if before is not None:
+        histories = histories.extra(where=[keyWhere %(table, table, '<')], params=list(before)).order_by('-action_time', '-id')
+        archived = [history for history in archived if KLP_Audit_Key(history) < before]
+        rows = sorted(list(histories[:size + 1]) + archived[-(size + 1):], key=KLP_Audit_Key)[-(size + 1):]
+        return rows[-size:], len(rows) > size, True
+    if after is not None:
+        histories = histories.extra(where=[keyWhere %(table, table, '>')], params=list(after))
+        archived = [history for history in archived if KLP_Audit_Key(history) > after]
+    rows = sorted(list(histories.order_by('action_time', 'id')[:size + 1]) + archived[:size + 1], key=KLP_Audit_Key)[:size + 1]
+    return rows[:size], after is not None, len(rows) > size
+
+def KLP_Encode_Key(history):
+    return '%s_%s' %(history.action_time.strftime(AUDIT_KEY_FORMAT), history.id)
+
+def KLP_Decode_Key(value):
+    """ This method returns the (action_time, id) key of a page url parameter, or None """
+    try:
+        actionTime, historyId = value.rsplit('_', 1)
+        return (datetime.datetime.strptime(actionTime, AUDIT_KEY_FORMAT), int(historyId))
+    except (AttributeError, ValueError):
+        return None
+
+def KLP_Audit_Csv(filters):
+    """ This method yields the csv lines of all histories of the filters, AUDIT_CSV_CHUNK histories are read at a time. Archive files are read once for the whole export """
+    archived = KLP_Audit_Archive(filters)
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(AUDIT_CSV_COLUMNS)
+    after = None
+    hasNext = True
+    while hasNext:
+        rows, hasPrevious, hasNext = KLP_Audit_Page(filters, after, size=AUDIT_CSV_CHUNK, archived=archived)
+        for history in rows:
+            writer.writerow([unicode(value).encode('utf-8') for value in [history.id, history.content_type, history.object_id, history.revision, history.action_time, history.action, history.request_id, history._data, history.info]])
+        if rows:
+            after = KLP_Audit_Key(rows[-1])
+        yield buffer.getvalue()
+        buffer.truncate(0)
+
 def KLP_audit(request):
-    """ This method is used to show audit trail report for the users using fullhistory """
+    """ This method is used to show audit trail report for the users using fullhistory, a page at a time or as csv """
     user = request.user     # get logged in user
     # check user permissions to access audit trial report
     KLP_user_Perm(request.user, "Audit", None)
     # get all active(1) user to show in drop down.
     userList = User.objects.filter(is_active=1)
-    respDict = {'userList':userList, 'title':'Karanataka Learning Partnership'}
-    # check requested method
-    if request.POST:
-    	# if request methos is post get selcted user from drop down
-    	selUser = request.POST.get('selUser')
-    	today = datetime.date.today()
-    	defaultDate = today.strftime("%d")+'-'+today.strftime("%m")+'-'+today.strftime("%Y")
-    	# get start date and end date
-    	startDate = request.POST.get('startDate')
-    	endDate = request.POST.get('endDate')
-    	# if start date and end date are empty then default start date and end date are current date.
-    	if not startDate:
-    		startDate = defaultDate
-    	if not endDate:
-    		endDate = defaultDate
-    	respDict['startDate'] = startDate
-    	respDict['endDate'] = endDate
-    	respDict['selUser'] = int(selUser)
-    	strDate = startDate.split('-')
-    	enDate = endDate.split('-')
-    	# Query fullhistory table based on start date, end date and selected user
-    	fullHistoryList = FullHistory.objects.filter(action_time__range=(datetime.date(int(strDate[2]), int(strDate[1]), int(strDate[0])), datetime.date(int(enDate[2]), int(enDate[1]), int(enDate[0]))), request__user_pk=selUser)
-    	respDict['fullHistoryList'] = fullHistoryList
-    	# return reponse to template
-    	return render_to_response('viewtemplates/auditTrial.html',respDict,context_instance=RequestContext(request)) 
-    return render_to_response('viewtemplates/auditTrial.html',respDict,context_instance=RequestContext(request)) 
-    
-    
-urlpatterns = patterns('',           
+    contentTypes = sorted([ContentType.objects.get_for_model(model) for model in registered_models], key=unicode)
+    respDict = {'userList':userList, 'contentTypes':contentTypes, 'actions':ACTIONS, 'title':'Karanataka Learning Partnership'}
+    # filters are get parameters, so that pages and the csv export can be linked
+    if not request.GET.get('selUser'):
+        return render_to_response('viewtemplates/auditTrial.html',respDict,context_instance=RequestContext(request))
+    filters = KLP_Audit_Filters(request.GET)
+    respDict.update(filters)
+    filterParams = dict([(key, filters[key]) for key in ['selUser', 'startDate', 'endDate', 'contentType', 'action'] if filters[key]])
+    if request.GET.get('format') == 'csv':
+        response = HttpResponse(KLP_Audit_Csv(filters), mimetype='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=audit_%s_%s_%s.csv' %(filters['selUser'], filters['startTime'].strftime('%Y%m%d'), filters['endTime'].strftime('%Y%m%d'))
+        return response
+    # histories of archived months are read from the archive files
+    fullHistoryList, hasPrevious, hasNext = KLP_Audit_Page(filters, KLP_Decode_Key(request.GET.get('after')), KLP_Decode_Key(request.GET.get('before')), AUDIT_PAGE_SIZE)
+    respDict['fullHistoryList'] = fullHistoryList
+    respDict['pageUrl'] = '?%s' %(urlencode(filterParams))
+    if fullHistoryList and hasPrevious:
+        respDict['previousUrl'] = '?%s' %(urlencode(dict(filterParams, before=KLP_Encode_Key(fullHistoryList[0]))))
+    if fullHistoryList and hasNext:
+        respDict['nextUrl'] = '?%s' %(urlencode(dict(filterParams, after=KLP_Encode_Key(fullHistoryList[-1]))))
+    respDict['csvUrl'] = '?%s' %(urlencode(dict(filterParams, format='csv')))
+    # return reponse to template
+    return render_to_response('viewtemplates/auditTrial.html',respDict,context_instance=RequestContext(request))
+
+
+urlpatterns = patterns('',
    url(r'^audit/trial/$', KLP_audit),
-)    
+)
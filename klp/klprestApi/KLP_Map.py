@@ -8,17 +8,16 @@ from django_restapi.receiver import *
 from klprestApi.BoundaryApi import ChoiceEntry
 from django.template import Template, Context, RequestContext
 from schools.models import *
+from schools.mapping import KLP_Boundary_Groups, KLP_Map_Assessment
+from django.utils import simplejson
 
 def KLP_Map_SG(request):
-	""" This method uses to map Student Groups With Assessment"""
+	""" This method uses to map Student Groups With Assessment, all student groups under the boundary are mapped in bulk. Returns count of groups mapped and permissions given"""
 	boundary_id= request.GET.get("boundary")
 	asssessment_id = request.GET.get("assessment")
 	assessmentObj = Assessment.objects.get(id=asssessment_id) 
-	studentgroup_list = StudentGroup.objects.filter(institution__boundary__parent__parent__id =boundary_id)
-	for sg in studentgroup_list:
-		sg_as_mapObj = Assessment_StudentGroup_Association(assessment=assessmentObj, student_group=sg, active=2 )
-		sg_as_mapObj.save()
-	return HttpResponse(studentgroup_list) 
+	counts = KLP_Map_Assessment(assessmentObj, KLP_Boundary_Groups(boundary_id))
+	return HttpResponse(simplejson.dumps(counts), content_type='application/json; charset=utf-8')
 
 urlpatterns = patterns('',
    url(r'^map/sg/as/$', KLP_Map_SG),
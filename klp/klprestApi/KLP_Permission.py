@@ -22,10 +22,15 @@ from django.utils import simplejson
 from django.db.models import Q	
 from django.core.management import call_command
 from schools.receivers import KLP_user_Perm
+from schools.permissions import KLP_Grant_Permissions, KLP_Reassign_Assessments, KLP_Revoke_User_Permissions, KLP_Boundary_Institutions, KLP_Unassigned_Assessments
+from django.core.paginator import Paginator, EmptyPage, InvalidPage
 from django.conf import settings
-from subprocess import Popen
-from subprocess import call
+from schools.jobs import KLP_Queue_Job
 from klprestApi.TreeMenu import KLP_assignedInstitutions
+
+# Number of institutions and assessments listed in each section of the permissions page
+PERMISSION_PAGE_SIZE = 100
+
 def KLP_Assign_Permissions(request):
 	""" This method is used to assign permissions"""
 	""" Check logged in user permissions to assign permissions"""
@@ -71,7 +76,8 @@ def KLP_Assign_Permissions(request):
 			respDict['isSuccess'] = False
 		else:
                         #bound_list=','.join(str(v1) for v1 in bound_list if v1 > 0)
-                        Popen(["python" ,"/home/klp/production/manage.py","KLP_assignPermissions",str(inst_list),str(deUserList),str(permissions),str(permissionType),str(assessmentId),str(assessmentPerm),bound_cat,bound_list,request.user.username])
+                        job = KLP_Queue_Job("KLP_assignPermissions", [str(inst_list),str(deUserList),str(permissions),str(permissionType),str(assessmentId),str(assessmentPerm),bound_cat,bound_list,request.user.username], request.user)
+                        respDict['jobId'] = job.id
                         #call(["/home/c2staging/c2staging/bin/python" ,"/home/c2staging/c2staging/c2staging/manage.py","KLP_assignPermissions",str(inst_list),str(deUserList),str(permissions),str(permissionType),str(assessmentId),str(assessmentPerm),bound_cat,bound_list])
                         respDict['respMsg'] = message #'Assigned Permissions successfully for %s Institutions' %(count)
                         respDict['isSuccess'] = True
@@ -91,7 +97,8 @@ def KLP_Assign_Permissions(request):
 			# call assignPermission method to assign permissions
                         inst_list=','.join(str(v1) for v1 in inst_list if v1 > 0)
                         print "FDFDF",bound_cat,bound_list,"HREEEEEEE"
-                        Popen(["python" ,"/home/klp/production/manage.py","KLP_assignPermissions",str(inst_list),str(deUserList),str(permissions),str(permissionType),str(assessmentId),str(assessmentPerm),bound_cat,str(bound_list).strip(),request.user.username])
+                        job = KLP_Queue_Job("KLP_assignPermissions", [str(inst_list),str(deUserList),str(permissions),str(permissionType),str(assessmentId),str(assessmentPerm),bound_cat,str(bound_list).strip(),request.user.username], request.user)
+                        respDict['jobId'] = job.id
 			respDict['respMsg'] = message #'Assigned Permissions successfully for  %s Institutions' %(count)
 			respDict['isSuccess'] = True
                         #Tosendmailteam(inst_list,deUserList,permissions,permissionType,assessmentId,assessmentPerm)
@@ -99,72 +106,8 @@ def KLP_Assign_Permissions(request):
 
     
 def assignPermission(inst_list, deUserList, permissions, permissionType, assessmentId=None, assessmentPerm=None):
-	assignedAsmIds = []
-        print inst_list,"SSSSSSSSSSs" 
-        assignedInsIds=[]
-        if assessmentId:
-            assessmentObjsel = Assessment.objects.get(id=assessmentId)
-	for inst_id in inst_list:
-		# get Institution object using id
-                inst_id=int(inst_id)
-         
-		instObj = Institution.objects.get(pk=inst_id)
-		for deUser in deUserList:
-		   # get user object
-              
-                   deUser=int(deUser)
-		   userObj = User.objects.get(id=deUser)
-                   if assessmentPerm!=None and assessmentPerm!='None': 
-                     uobj=UserAssessmentPermissions.objects.filter(user=userObj,  instituion= instObj,assessment=assessmentObjsel) 
-                     if uobj:
-                               uflag=True
-                     else:
-                                           uflag=False
-                   else:
-                                        uflag=True           
-                                       
-                   if uflag:  
-                        print userObj,permissionType   
-                        assignedInsIds.append(inst_id)
-			if permissionType == 'permissions':
-				# if permission type is permissions set institution level permissions for the user
-				userObj.set_perms(permissions, instObj)
-			        if assessmentPerm!=None and assessmentPerm!='None':	
-					# if assessmentPerm is true assign assessment also to the user.
-					sg_list = StudentGroup.objects.filter(institution__id=inst_id).values_list('id', flat=True).distinct()
-                                        print sg_list[:10],inst_id
-                                        #print sg_list  
-					asmIds = Assessment_StudentGroup_Association.objects.filter(student_group__id__in= sg_list, active=2).values_list("assessment__id", flat=True).distinct()
-                                        print asmIds
-					for asmId in asmIds:
-						assessmentObj = Assessment.objects.get(id=asmId)
-						try:
-                                                        
-							permObj = UserAssessmentPermissions.objects.get(user = userObj, instituion = instObj, assessment = assessmentObj)
-							permObj.access = True
-							permObj.save()							
-						except:
-                                                        print "EXT"
-							permObj = UserAssessmentPermissions(user = userObj, instituion = instObj, assessment = assessmentObj, access=True)
-                                                        try: 
-							  permObj.save()
-                                                        except:
-                                                              pass 
-							
-					assignedAsmIds.extend(asmIds)
-			else:
-				# else assign assessment permissions to user.
-				assessmentObj = Assessment.objects.get(pk=assessmentId)
-				try:
-					permObj = UserAssessmentPermissions.objects.get(user = userObj, instituion = instObj, assessment = assessmentObj)
-					permObj.access = True
-					permObj.save()
-				except :
-					permObj = UserAssessmentPermissions(user = userObj, instituion = instObj, assessment = assessmentObj, access=True)
-					permObj.save()
-	assignedAsmIds = list(set(assignedAsmIds))
-        print assignedAsmIds,"total"
-	return assignedInsIds
+	""" This method assigns permissions of the users on the institutions, all rows are written with set based statements in one transaction (see schools.permissions)"""
+	return KLP_Grant_Permissions(inst_list, deUserList, permissions, permissionType, assessmentId, assessmentPerm)
 
 def KLP_Users_list(request):
 	""" This method is used to list out active(1) users other than staff and super users"""
@@ -243,40 +186,32 @@ def KLP_User_Permissions(request, user_id):
 	
 	
 def KLP_Show_Permissions(request, boundary_id, user_id):
-	""" This method is used to show user permissions """
+	""" This method is used to show user permissions, assigned and unassigned institutions and assessments are computed with (anti) joins and shown a page at a time """
 	userObj = User.objects.get(pk=user_id) # get user object 
-	boundType_List = Boundary_Type.objects.all()  # get all boundary types
-	# get session value, if session is not set default value is 0
 	try:
-		sessionVal = int(request.session['session_sch_typ'])
-	except:
-		sessionVal = 0
-	redUrl = '/list/%s/user/%s/permissions/' %(boundary_id, user_id)
-	# get all assigned institutions to the user
-	assignedInst = Institution.objects.select_related("boundary").filter(Q(boundary__id=boundary_id)|Q(boundary__parent__id=boundary_id)|Q(boundary__parent__parent__id=boundary_id), active=2).extra(where=['''schools_institution.id in (SELECT "obj_id" FROM "public"."object_permissions_institution_perms" WHERE "user_id" = '%s' AND "Acess" = 't')''' %(user_id)]).only("id", "name", "boundary").order_by("boundary", "boundary__parent", "name")
-	
-	assignedInstIds = assignedInst.values_list("id", flat=True)
-	# get unassigned institutions based on assigned institutions
-	unAssignedInst = Institution.objects.select_related("boundary").filter(Q(boundary__id=boundary_id)|Q(boundary__parent__id=boundary_id)|Q(boundary__parent__parent__id=boundary_id), active=2).exclude(pk__in=assignedInstIds).only("id", "name", "boundary").order_by("boundary", "boundary__parent", "name")
-	
-	
+		page = int(request.GET.get('page'))
+	except (ValueError, TypeError):
+		page = 1
+	pageUrl = '/list/%s/user/%s/permissions/' %(boundary_id, user_id)
+	redUrl = '%s?page=%s' %(pageUrl, page)
+	# get assigned and unassigned institutions under the boundary
+	assignedInst = KLP_Permission_Page(KLP_Boundary_Institutions(user_id, boundary_id), page)
+	unAssignedInst = KLP_Permission_Page(KLP_Boundary_Institutions(user_id, boundary_id, False), page)
 	# get all assigned assessment objects
-	assignedpermObjects = UserAssessmentPermissions.objects.select_related("assessment", "instituion").filter(Q(instituion__boundary__id=boundary_id)|Q(instituion__boundary__parent__id=boundary_id)|Q(instituion__boundary__parent__parent__id=boundary_id), user=userObj, access=True).defer("access").order_by("instituion__boundary", "instituion__boundary__parent", "instituion__name",)
-	
-	
-	
-	unMapObjs = Assessment_StudentGroup_Association.objects.select_related("student_group", "assessment").filter(Q(student_group__institution__boundary__id=boundary_id)|Q(student_group__institution__boundary__parent__id=boundary_id)|Q(student_group__institution__boundary__parent__parent__id=boundary_id), active=2).defer("active").order_by("student_group__institution__boundary", "student_group__institution__boundary__parent", "student_group__institution__name")
-	for assignedPermObj in assignedpermObjects:
-		qsets = (
-	            Q(assessment = assignedPermObj.assessment)&
-	            Q(student_group__institution = assignedPermObj.instituion)
-	        )
-		unMapObjs = unMapObjs.exclude(qsets)
-	unMapList = unMapObjs.values_list("student_group__institution", "assessment").distinct()
-	# get all unassigned assessment objects
-	qList=[Assessment_StudentGroup_Association.objects.select_related("student_group", "assessment").filter(student_group__institution__id=unMapVal[0], assessment__id=unMapVal[1]).defer("active")[0] for unMapVal in unMapList]
-	
-	return render_to_response('viewtemplates/show_permissions.html',{'assignedInst':assignedInst,  'userId':user_id, 'userName':userObj.username, 'unAssignedInst':unAssignedInst, 'assignedpermObjects':assignedpermObjects, 'redUrl':redUrl, 'qList':qList}, context_instance=RequestContext(request))		
+	assignedpermObjects = KLP_Permission_Page(UserAssessmentPermissions.objects.select_related("assessment__programme", "instituion__boundary__parent__parent").filter(instituion__boundary__in=boundary_descendants(boundary_id), user=userObj, access=True).defer("access").order_by("instituion__boundary", "instituion__boundary__parent", "instituion__name", "id"), page)
+	# get mapped assessments which are not assigned
+	qList = KLP_Permission_Page(KLP_Unassigned_Assessments(user_id, boundary_id), page)
+	pages = [pageObj for pageObj in [assignedInst, unAssignedInst, assignedpermObjects, qList] if pageObj]
+	has_next = True in [pageObj.has_next() for pageObj in pages]
+	return render_to_response('viewtemplates/show_permissions.html',{'assignedInst':assignedInst and assignedInst.object_list,  'userId':user_id, 'userName':userObj.username, 'unAssignedInst':unAssignedInst and unAssignedInst.object_list, 'assignedpermObjects':assignedpermObjects and assignedpermObjects.object_list, 'redUrl':redUrl, 'qList':qList and qList.object_list, 'pageUrl':pageUrl, 'page':page, 'has_next':has_next, 'next':page + 1, 'has_previous':page > 1, 'previous':page - 1}, context_instance=RequestContext(request))		
+
+def KLP_Permission_Page(objects, page):
+	""" This method returns the page of objects shown in permissions page, or None if the list has less pages """
+	paginator = Paginator(objects, PERMISSION_PAGE_SIZE)
+	try:
+		return paginator.page(page)
+	except (EmptyPage, InvalidPage):
+		return None
 	
 def KLP_Show_User_Permissions(request, boundary_id, user_id):	
 	return render_to_response('viewtemplates/show_permissions.html',{'userId':user_id, 'boundary_id':boundary_id, 'confirmMsg':True}, context_instance=RequestContext(request))	 
@@ -288,29 +223,19 @@ def KLP_Revoke_Permissions(request, permissionType):
 	KLP_user_Perm(request.user, "Users", None)
 	# get user id to revoke permissions
 	user_id = request.POST.get('userId')
-	opStatus = "success"
+	respDict = {'status':'success'}
 	try:	
 		if permissionType == 'permissions':
-			# if permissiontype is permissions revoke institution permissions for the user
-			userObj = User.objects.get(pk=user_id)
-			# get institution list to revoke
-			instList = request.POST.getlist('assignedInst')
-			for inst_id in instList:
-				instObj = Institution.objects.get(pk=inst_id)
-				# revoke permission for user
-				userObj.revoke('Acess', instObj)
+			# if permissiontype is permissions revoke institution permissions of the user on selected institutions
+			idList = request.POST.getlist('assignedInst')
 		else:
-			# else revoke assessment permissions
-			assignedAsmList = request.POST.getlist('assignedAsm')
-			for userAsm_id in assignedAsmList:
-				# get UserAssessmentPermissions object
-				permObj = UserAssessmentPermissions.objects.get(pk=userAsm_id)
-				permObj.access = False  # revoke permissions
-				permObj.save()
+			# else revoke selected assessment permissions
+			idList = request.POST.getlist('assignedAsm')
+		respDict['count'] = KLP_Revoke_User_Permissions(permissionType, user_id, idList)
 	except:
-		opStatus = "fail"		
-	# if revoke permission fail return response as fail else return success.
-	return HttpResponse(opStatus)
+		respDict['status'] = "fail"		
+	# if revoke permission fail return response as fail else return success with count of permissions revoked.
+	return HttpResponse(simplejson.dumps(respDict), content_type='application/json; charset=utf-8')
 	
 def KLP_ReAssign_Permissions(request, permissionType):
 	""" This method is used to reassign permissions to user"""
@@ -319,24 +244,20 @@ def KLP_ReAssign_Permissions(request, permissionType):
 	#get selected users list
 	userList = request.POST.getlist('userId')
 	permissions = ['Acess']
-	opStatus = "success"
+	respDict = {'status':'success'}
 	try:
 		if permissionType== 'permissions':
 			# if permissionsType is permissions assign instituions to user
 			inst_list = request.POST.getlist('unassignedInst') # get selected institution list
-			assignPermission(inst_list, userList, permissions, permissionType, None, True) # call assignPermission method to assign permission
+			respDict['count'] = len(assignPermission(inst_list, userList, permissions, permissionType, None, True)) # call assignPermission method to assign permission
 		else:
-			# else assign assessments to user
-			asmList = request.POST.getlist('unassignedAsm') # get selected assesment and institution list
-			for asm in asmList:
-				asm_list = asm.split("_")
-				inst_list = [asm_list[0]]
-				assessmentId = asm_list[1]
-				assignPermission(inst_list, userList, permissions, permissionType, assessmentId) # call assignPermission method to assign permission
+			# else assign all selected assessments to user at once, each entry is institutionId_assessmentId
+			entries = [asm.split("_")[:2] for asm in request.POST.getlist('unassignedAsm')]
+			respDict['count'] = KLP_Reassign_Assessments(userList, entries)
 	except:
-		opStatus = "fail"	
-	# if reassign permission fail return response as fail else return success.	
-	return HttpResponse(opStatus)
+		respDict['status'] = "fail"	
+	# if reassign permission fail return response as fail else return success with count of permissions assigned.	
+	return HttpResponse(simplejson.dumps(respDict), content_type='application/json; charset=utf-8')
 
 urlpatterns = patterns('',             
    url(r'^assign/permissions/?$', KLP_Assign_Permissions),
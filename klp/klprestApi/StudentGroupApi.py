@@ -87,7 +87,6 @@ def KLP_StudentGroup_Answer_Entry(request, studentgroup_id, programme_id, assess
 	grupObj = StudentGroup.objects.filter(pk = studentgroup_id).only("group_type")
 	childs_list = Child.objects.filter(id__in=students).extra(select={'lower_firstname':'lower(trim("firstName"))' }).order_by('lower_firstname').defer("mt")
 	question_list = Question.objects.filter(assessment__id=assessment_id, active=2).defer("assessment")
-	studIdList, qNamesList, qIdList, chList, rDict, childDict, counter=[], [], [], [], {}, {}, 0
 	paginator = Paginator(childs_list, 20)
 	
 	page = request.GET.get('page')  #get page to show result
@@ -101,130 +100,95 @@ def KLP_StudentGroup_Answer_Entry(request, studentgroup_id, programme_id, assess
 		# If page is out of range (e.g. 9999), deliver last page of results.
 		pagchilds_list = paginator.page(paginator.num_pages)
 	
-	for child in pagchilds_list.object_list:
-		chDic={}
-		
+	question_list = list(question_list)
+	chList, childDict, studIdList, rDict = KLP_Answer_Grid(user, assessment_id, pagchilds_list.object_list, question_list)
+	qNamesList = [ques.name for ques in question_list]
+	qIdList = [ques.id for ques in question_list]
+	
+	val=Collection(childs_list, permitted_methods = ('GET', 'POST'), responder = TemplateResponder(template_dir = 'prgtemplates', template_object_name = 'childs', paginate_by=20, extra_context={'filter_id':programme_id, 'assessment_id':assessment_id, 'user':user, 'studentgroup_id':studentgroup_id, 'question_list':question_list,  'group_typ':grupObj[0].group_type, 'url':url, 'studIdList':studIdList, 'rDict':rDict, 'qNamesList':qNamesList, 'chList':chList, 'childDict':childDict, 'rDict':rDict, 'qIdList':qIdList}), entry_class = ChoiceEntry, )
+	return HttpResponse(val(request))
+	
+
+def KLP_Answer_Grid(user, assessment_id, childs, question_list):
+	""" This method builds answer grid data for the page of childs with fixed number of queries (students, relations, assessment and answers)"""
+	""" Returns child ids, child information (childDict), student ids and answer data for each question and student (rDict)"""
+	chList = [child.id for child in childs]
+	# Query active students of all childs
+	studDict = {}
+	for studId, chId in Student.objects.filter(child__id__in=chList, active=2).values_list('id', 'child').order_by('id'):
+		studDict.setdefault(chId, studId)
+	# Query father and mother names of all childs
+	relDict = {}
+	for chId, relType, firstName in Relations.objects.filter(child__id__in=chList, relation_type__in=['Father', 'Mother']).values_list('child', 'relation_type', 'first_name').order_by('-id'):
+		relDict[(chId, relType)] = firstName
+	studIdList, childDict = [], {}
+	for child in childs:
 		chId = child.id
-		chList.append(chId)
-		# Query for active student using child object
-		student = Student.objects.filter(child=child, active=2).defer("child")
-		studId = student[0].id
+		studId = studDict[chId]
 		# get Child and student information to show in grid.
 		if child.dob:
 			dOfB = child.dob.strftime("%d-%m-%Y")
 		else:
 			dOfB = ''
-		chDic = {'studId':studId, 'Gender':child.gender, 'dob':dOfB, 'firstName':child.firstName, 'lastName':child.lastName}
-		# get relations
-		try:			
-			relObj = Relations.objects.filter(child=child, relation_type="Father").only("first_name")
-			chDic['fName'] = relObj[0].first_name
-		except:
-			chDic['fName'] = ''
-		
-		try:
-			relObj = Relations.objects.filter(child=child, relation_type="Mother").only("first_name")
-			chDic['mName'] = relObj[0].first_name
-		except:
-			chDic['mName'] = ''
-			
+		childDict[chId] = {'studId':studId, 'Gender':child.gender, 'dob':dOfB, 'firstName':child.firstName, 'lastName':child.lastName, 'fName':relDict.get((chId, 'Father'), ''), 'mName':relDict.get((chId, 'Mother'), '')}
 		studIdList.append(studId)
-		childDict[chId] = chDic
-	rDict, ansStudList={}, []
-	counter = counter +1 
-	
+	AdoubleEntry = Assessment.objects.filter(pk=assessment_id).values_list('doubleEntry', flat=True)[0]
+	# Query answers of all questions and students in the page
+	ansMap = {}
+	for ansObj in Answer.objects.filter(question__id__in=[ques.id for ques in question_list], student__id__in=studIdList).values('question', 'student', 'doubleEntry', 'user1', 'status', 'answerGrade', 'answerScore'):
+		ansMap[(ansObj['question'], ansObj['student'])] = ansObj
+	rDict = {}
 	for ques in question_list:
-		qNamesList.append(ques.name)
 		# get Question Information
 		qId = ques.id
-		qIdList.append(qId)
-		dataDict={'qId':qId, 'qOrder':ques.order}
 		qType = ques.questionType
-		dataDict['qType'] = qType		
-                AdoubleEntry=ques.assessment.doubleEntry
+		dataDict = {'qId':qId, 'qOrder':ques.order, 'qType':qType}
 		if qType == 2:
-			# if quetion type is 2(marks) get grades to do validation while data entry
-			ansIn =  ques.grade
-			dataDict['ansIn'] = ansIn
+			# if quetion type is 2(grade) get grades to do validation while data entry
+			dataDict['ansIn'] = ques.grade
 		else:
 			# else get minmum and maximum score to do validation while data entry
 			dataDict['scMin'] = ques.scoreMin
 			dataDict['scMax'] = ques.scoreMax
-		qDict={}	
-		# Query For Answers based on question id and studens
-		ansList = Answer.objects.select_related("user1").filter(question=ques, student__id__in = studIdList).defer("question").values()
-		if ansList:
-			for ansObj in ansList:
-				# If answers is there get answer Information
-				ansDict=dict(dataDict)
-				dEntry = ansObj['doubleEntry']
-			
-				firstUser = ansObj['user1_id']
-				studentId = ansObj['student_id']
-				ansStudList.append(studentId)
-				if dEntry == 2:
-					# if dEntry is 2 (doubleentry is finished) then dont show input box
-					ansDict['iBox'] = False
-				else:
-					# else show input box
-					ansDict['iBox'] = True
-                                if dEntry == 2 and AdoubleEntry ==False and firstUser==user.id:
-                                        # if dEntry is 2 and assesment double entry is false and first user is matched with logged in user then input box will show (refer ticket 322)x
-                                        ansDict['iBox'] =True
- 
-		                status = ansObj['status']
-				if status == -99999:
-					# if answer status is -99999(absent) then show answer value as 'AB'.
-		    			ansVal = 'AB'
-		    		elif status == -1:
-		    			# if answer status is -1(unknown) then show answer value as 'UK'.
-		    			ansVal = 'UK'
-		    		elif qType == 2:
-		    			# if question type is 2(grade) then show answer grade
-		    			ansVal = ansObj['answerGrade']
-		    		else:
-		    			# else show answer score
-		    			ansVal = ansObj['answerScore']
-				ansDict['ansVal']=ansVal								
-				ansDict['shVal'] = False	  
-				if firstUser != user.id and dEntry ==1:
-					# if dEntry is 1, (first entry finished doubleentry is not finished) and logged in user is not match with first user who enter data, then make dE attribute true to do validation while doubleentry
-					ansDict['dE'] = True
-				elif firstUser == user.id and dEntry ==1 or (dEntry == 2 and AdoubleEntry ==False and firstUser==user.id):
-					# if dEntry is 1, (first entry finished doubleentry is not finished) and logged in user is match with first user who enter data, then make shVal attribute true to show answer value in input box.
-					ansDict['shVal'] = True
-				
-			        qDict[studentId] = ansDict
-				
-		
-		rDict[qId] = qDict	
-	noAnsList = list(set(studIdList).difference(set(ansStudList)))
-	if noAnsList:
-		# If No Answers Found get only Question Information to show empty text box.
-		for ques in question_list:
-			qId = ques.id
-			dataDict={'qId':qId, 'qOrder':ques.order}
-			qType = ques.questionType
-			dataDict['qType'] = qType
-			if qType == 2:
-				ansIn =  ques.grade
-				dataDict['ansIn'] = ansIn
-			else:
-				dataDict['scMin'] = ques.scoreMin
-				dataDict['scMax'] = ques.scoreMax
-			qDict=rDict[qId]
-			for stId in noAnsList:
-				ansDict=dict(dataDict)
+		qDict = {}
+		for studId in studIdList:
+			ansDict = dict(dataDict)
+			qDict[studId] = ansDict
+			ansObj = ansMap.get((qId, studId))
+			if ansObj is None:
+				# If No Answer Found show empty text box.
 				ansDict['iBox'] = True
 				ansDict['ansVal'] = ''
-				qDict[stId] = ansDict
-			
-			
-				
-	
-	val=Collection(childs_list, permitted_methods = ('GET', 'POST'), responder = TemplateResponder(template_dir = 'prgtemplates', template_object_name = 'childs', paginate_by=20, extra_context={'filter_id':programme_id, 'assessment_id':assessment_id, 'user':user, 'studentgroup_id':studentgroup_id, 'question_list':question_list,  'group_typ':grupObj[0].group_type, 'url':url, 'studIdList':studIdList, 'rDict':rDict, 'qNamesList':qNamesList, 'chList':chList, 'childDict':childDict, 'rDict':rDict, 'qIdList':qIdList}), entry_class = ChoiceEntry, )
-	return HttpResponse(val(request))
-	
+				continue
+			dEntry = ansObj['doubleEntry']
+			firstUser = ansObj['user1']
+			# if dEntry is 2 (doubleentry is finished) then dont show input box
+			# but if assesment double entry is false and first user is matched with logged in user then input box will show (refer ticket 322)
+			ansDict['iBox'] = dEntry != 2 or (AdoubleEntry == False and firstUser == user.id)
+			status = ansObj['status']
+			if status == -99999:
+				# if answer status is -99999(absent) then show answer value as 'AB'.
+				ansVal = 'AB'
+			elif status == -1:
+				# if answer status is -1(unknown) then show answer value as 'UK'.
+				ansVal = 'UK'
+			elif qType == 2:
+				# if question type is 2(grade) then show answer grade
+				ansVal = ansObj['answerGrade']
+			else:
+				# else show answer score
+				ansVal = ansObj['answerScore']
+			ansDict['ansVal'] = ansVal
+			ansDict['shVal'] = False
+			if firstUser != user.id and dEntry == 1:
+				# if dEntry is 1, (first entry finished doubleentry is not finished) and logged in user is not match with first user who enter data, then make dE attribute true to do validation while doubleentry
+				ansDict['dE'] = True
+			elif firstUser == user.id and dEntry == 1 or (dEntry == 2 and AdoubleEntry == False and firstUser == user.id):
+				# if dEntry is 1, (first entry finished doubleentry is not finished) and logged in user is match with first user who enter data, then make shVal attribute true to show answer value in input box.
+				ansDict['shVal'] = True
+		rDict[qId] = qDict
+	return chList, childDict, studIdList, rDict
+
 
 def MapStudents(request,id):
 	""" To Map Students With Centers"""
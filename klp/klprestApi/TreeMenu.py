@@ -8,31 +8,43 @@ from schools.models import *
 from django.http import *
 from production.klprestApi.Treeresponder import *
 from django.db.models.query import QuerySet
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+from schools.receivers import KLP_Tree_Version
+from schools.permissions import KLP_User_Institutions, KLP_Assessment_Institutions, KLP_User_Groups, KLP_Perm_Version
 
 
 def hasChild(query, typ, boundaryType, filterBy, secFilter, permFilter, assessmentPerm, shPerm, userSel):
 	""" This method checks for child objects and get urls """
-    	subboundary = 0
-	childtree = 0
+	query = list(query)
 	childDic={}
+	if not query:
+		return childDic
+	# get child flags of all the objects at once
+	childSet = KLP_Child_Flags(query, boundaryType, permFilter or assessmentPerm or shPerm)
+	if typ == 'institution' and filterBy != 'None' and permFilter in ['', ' ', None]:
+		# get mapped assessments of all student groups and names of the assessments
+		secFilter = [int(secFil) for secFil in secFilter]
+		mapSet = set(Assessment_StudentGroup_Association.objects.filter(assessment__id__in=secFilter, student_group__id__in=[i.id for i in query], active=2).values_list('student_group', 'assessment'))
+		asmNames = dict(Assessment.objects.filter(id__in=secFilter).values_list('id', 'name'))
 	for i in query:
 		if typ == 'source' or typ == 'boundary': 
 		    if permFilter:
-		    	templist = [i.getPermissionChild(boundaryType), i.getPermissionViewUrl()]
+		    	templist = [i.id in childSet, i.getPermissionViewUrl()]
 		    elif assessmentPerm:
-		    	templist = [i.getPermissionChild(boundaryType), i.getAssessmentPermissionViewUrl(secFilter[0])]
+		    	templist = [i.id in childSet, i.getAssessmentPermissionViewUrl(secFilter[0])]
 		    elif shPerm:
-		    	templist = [i.getPermissionChild(boundaryType), i.showPermissionViewUrl(userSel)]		
+		    	templist = [i.id in childSet, i.showPermissionViewUrl(userSel)]		
 		    else:
-		    	templist = [i.getChild(boundaryType), i.getViewUrl(boundaryType)]
+		    	templist = [i.id in childSet, i.getViewUrl(boundaryType)]
 		elif  typ == 'institution' and filterBy != 'None' and permFilter in ['', ' ', None]:
                       templist=[] 
                       for secFil in secFilter:        
-                        mapObj = Assessment_StudentGroup_Association.objects.filter(assessment__id=secFil,student_group=i,active=2)
-                        if mapObj:
-			  templist .append([i.getChild(),i.getStudentProgrammeUrl(filterBy, secFil)] )
+                        if (i.id, secFil) in mapSet:
+			  templist .append([i.id in childSet,i.getStudentProgrammeUrl(filterBy, secFil, asmNames[secFil])] )
 		else:
-		    templist=[i.getChild(),i.getViewUrl()]
+		    templist=[i.id in childSet,i.getViewUrl()]
 		try:
 			templist.append(i.GetName())
 		except:
@@ -42,20 +54,39 @@ def hasChild(query, typ, boundaryType, filterBy, secFilter, permFilter, assessme
         
 	return childDic
 
+def KLP_Child_Flags(query, boundaryType, permissionTree=False):
+	""" This method returns ids of objects in query which have active child objects, using one grouped query (two for boundaries)"""
+	model = type(query[0])
+	ids = [i.id for i in query]
+	if model == Boundary:
+		# boundary has child if it has sub boundaries or institutions (institutions are not shown in permission trees)
+		childSet = set(Boundary.objects.filter(parent__id__in=ids, active=2, boundary_type=boundaryType).values_list('parent', flat=True).distinct())
+		if not permissionTree:
+			childSet.update(Institution.objects.filter(boundary__id__in=ids, active=2).values_list('boundary', flat=True).distinct())
+	elif model == Institution:
+		childSet = set(StudentGroup.objects.filter(institution__id__in=ids, active=2).values_list('institution', flat=True).distinct())
+	elif model == Programme:
+		childSet = set(Assessment.objects.filter(programme__id__in=ids, active=2).values_list('programme', flat=True).distinct())
+	elif model == Assessment:
+		childSet = set(Question.objects.filter(assessment__id__in=ids, active=2).values_list('assessment', flat=True).distinct())
+	else:
+		# student groups and questions do not have child objects in tree
+		childSet = set()
+	return childSet
+
 def KLP_assignedInstitutions(userId):
 	""" This method returns assigned institutions for the user"""
-	rawQuerySet = Institution.objects.raw(""" SELECT "id","obj_id" FROM "public"."object_permissions_institution_perms" WHERE "user_id" = '%s' AND "Acess" = 't' """ %(userId))
-	inst_list=[]
-	for permObj in rawQuerySet:
-		inst_list.append(permObj.obj_id)
-	return inst_list
+	return list(KLP_User_Institutions(userId))
 	
 def KLP_assignedAssessmentInst(userId, assessmentId):
 	""" This method returns assigned Assessments for the user"""
-	inst_list = UserAssessmentPermissions.objects.filter(user__id=userId, assessment__id__in=assessmentId, access=True).values_list("instituion__id", flat=True).distinct()
-	return inst_list	
+	inst_list = set()
+	for asmId in assessmentId:
+		inst_list.update(KLP_Assessment_Institutions(userId, asmId))
+	return list(inst_list)
 
-def TreeClass(request):
+def KLP_Tree_Nodes(request):
+     """ Returns response with tree nodes (json) of the parent node"""
      model = request.GET['root']
      data = request.GET['home']
      filterBy = request.GET['filter']
@@ -74,8 +105,7 @@ def TreeClass(request):
      model = model.split('_')
      typ = model[0]
      logUser = request.user
-     klp_UserGroups = logUser.groups.all()
-     user_GroupsList = ['%s' %(usergroup.name) for usergroup in klp_UserGroups]
+     user_GroupsList = KLP_User_Groups(logUser.id)
      if typ == "source":
      	# if type is source
 	if data:
@@ -99,10 +129,8 @@ def TreeClass(request):
 	    		map_institutions_list = StudentGroup.objects.filter(id__in=studentgroup_list, active=2).values_list('institution__id', flat=True).distinct()
 	    		
 	    		institutions_list = list(set(map_institutions_list)&set(KLP_assignedAssessmentInst(logUser.id, secFilter)))
-	        try:
-	        	boundary_list = Boundary.objects.filter(institution__pk__in=institutions_list, active=2, boundary_type=boundaryType).values_list('parent__parent__id', flat=True).distinct()
-	        except:
-	        	boundary_list = Boundary.objects.filter(institution__pk__in=institutions_list, active=2, boundary_type=boundaryType).values_list('parent__id', flat=True).distinct()
+	        # get top level boundaries above the institutions using boundary hierarchy
+	        boundary_list = Boundary_Hierarchy.objects.filter(descendant__institution__pk__in=institutions_list, descendant__active=2, descendant__boundary_type=boundaryType, ancestor__parent__id=1).values_list('ancestor', flat=True).distinct()
 	        	
 	        query = Boundary.objects.filter(pk__in=boundary_list, active=2, parent__id=1).distinct().extra(select={'lower_name':'lower(name)'}).order_by("lower_name")
 		
@@ -189,7 +217,29 @@ def TreeClass(request):
      queryset = query,
      responder = TreeResponder(CDict=CDict),
      )
-     return HttpResponse(val(request),mimetype="application/json")
+     return val(request)
+
+def TreeClass(request):
+     """ Returns tree nodes of the parent, nodes are cached until any tree object or the user permissions are changed"""
+     cacheTimeout = getattr(settings, 'TREE_CACHE_TIMEOUT', 0)
+     logUser = request.user
+     if not cacheTimeout or not logUser.id:
+          return KLP_Tree_Nodes(request)
+     params = sorted(request.GET.items())
+     versions = [KLP_Tree_Version()]
+     if not (logUser.is_superuser or logUser.is_staff or 'AdminGroup' in KLP_User_Groups(logUser.id)):
+          # nodes of users other than admins depend on the user permissions, cache them for the user and its permission version
+          versions.append('%s_%s' %(logUser.id, KLP_Perm_Version(logUser.id)))
+     userSel = request.GET.get('userSel')
+     if userSel and str(userSel).isdigit():
+          # permission trees also depend on permissions of the selected user
+          versions.append('%s_%s' %(userSel, KLP_Perm_Version(userSel)))
+     cacheKey = 'klp_tree_%s_%s' %('_'.join([str(version) for version in versions]), md5_constructor(repr(params)).hexdigest())
+     content = cache.get(cacheKey)
+     if content is None:
+          content = KLP_Tree_Nodes(request).content
+          cache.set(cacheKey, content, cacheTimeout)
+     return HttpResponse(content, mimetype="application/json")
 
 def GetAssementList(programId):
     try:
@@ -4,7 +4,7 @@ into model_resource.ModelResource and determine how
 the objects of a ModelResource instance are rendered
 (e.g. serialized to XML, rendered by templates, ...).
 """
-from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.handlers.wsgi import STATUS_CODE_TEXT
 from django.core.paginator import QuerySetPaginator, InvalidPage
 # the correct paginator for Model objects is the QuerySetPaginator,
@@ -18,19 +18,17 @@ from django.template import loader, RequestContext
 from django.utils import simplejson
 from django.utils.xmlutils import SimplerXMLGenerator
 from django.views.generic.simple import direct_to_template
-import json
-from schools.models import StudentGroup,Answer,Student_StudentGroupRelation
 
 class TreeSerializeResponder(object):
     """
-    Class for all data formats that are possible
-    with Django's serializer framework.
+    Class for the jQuery treeview node format. Nodes are
+    encoded straight from values() rows and the child map
+    (CDict) built by TreeMenu.hasChild.
     """
     def __init__(self, CDict,format, mimetype=None, paginate_by=None, allow_empty=False):
         """
         format:
-            may be every format that works with Django's serializer
-            framework. By default: xml, python, json, (yaml).
+            kept for compatibility, nodes are always json.
         mimetype:
             if the default None is not changed, any HttpResponse calls 
             use settings.DEFAULT_CONTENT_TYPE and settings.DEFAULT_CHARSET
@@ -43,73 +41,57 @@ class TreeSerializeResponder(object):
         self.allow_empty = allow_empty
         self.expose_fields = []
         self.CDict=CDict
+
     def render(self, object_list):
         """
-        Serializes a queryset to the format specified in
-        self.format.
+        Encodes model objects to tree nodes json.
         """
-        # Hide unexposed fields
-        hidden_fields = []
-	
-        for obj in list(object_list):
-            for field in obj._meta.fields:
-                if not field.name in self.expose_fields and field.serialize:
-                    field.serialize = False
-                    hidden_fields.append(field)
-        
-        response = serializers.serialize(self.format, object_list)
-        # Show unexposed fields again
-        
-        response1 = serializers.serialize(self.format, object_list,use_natural_keys=True)       
-        response1= simplejson.loads(response)
-        """ This is customised to generate list of dictionaries for tree structure"""
-        response2=[]
-        for k in response1:
-		   
-		   modelName = k['model'].split('.')[-1]
-                   childkey= modelName+'_'+str(k['pk'])
-                   temval=self.CDict[childkey]
-                   childval=temval[0]
-                   if type(childval)()==[]:
-                               childval=childval[0]
-                               
-                               for c in temval:
-                                     copyk=k.copy()
-                                     if childval:
-                                          # if object has childval(has child objects) pass haschildren true
-                                          copyk['hasChildren']='true'
-                                     copyk['id']=childkey
-                                     names =  copyk['fields']
-                                     # get names of object to show in tree structure
-                                     try:
-                                                         titleval=names['name']
-                                     except:
-                                                 titleval = names['question']
-                                     copyk['text'] = c[1]
-                        
-                                     response2.append(copyk) 
-                                     del copyk
-                               response1=response2   
-                   else:                   
-                     if childval:
-                          # if object has childval(has child objects) pass haschildren true
-                          k['hasChildren']='true'
-                     k['id']=childkey
-		     names =  k['fields']
-		     # get names of object to show in tree structure
-                     try:
-                        titleval=names['name']
-		     except:
-			titleval = names['question']
-		     k['text'] = temval[1]
+        if not object_list:
+            return '[]'
+        model = type(object_list[0])
+        rows = []
+        for obj in object_list:
+            row = dict([(field.name, field.value_from_object(obj)) for field in model._meta.fields if field.name in self.expose_fields])
+            row['pk'] = obj.pk
+            rows.append(row)
+        return ''.join(self.iter_nodes(model, rows))
 
-	
+    def iter_nodes(self, model, rows, extraNames=()):
+        """
+        Yields tree nodes json for values() rows, one node at a time
+        so that large levels are streamed to the client. Extra selects
+        (extraNames) are only read for ordering, they are not encoded.
+        """
+        encoder = DjangoJSONEncoder()
+        label = '%s.%s' %(model._meta.app_label, model._meta.module_name)
+        pkName = model._meta.pk.name
+        yield '['
+        first = True
+        for row in rows:
+            for name in extraNames:
+                row.pop(name, None)
+            pk = row.pop('pk', None)
+            if pk is None:
+                pk = row.pop(pkName)
+            childkey = model._meta.module_name+'_'+str(pk)
+            temval = self.CDict[childkey]
+            if type(temval[0]) == list:
+                # object is shown once for each entry (student group for each mapped assessment)
+                entries = temval
+            else:
+                entries = [temval]
+            for entry in entries:
+                node = {'pk':pk, 'model':label, 'fields':row, 'id':childkey, 'text':entry[1]}
+                if entry[0]:
+                    # if object has child objects pass haschildren true
+                    node['hasChildren'] = 'true'
+                if first:
+                    first = False
+                else:
+                    yield ', '
+                yield encoder.encode(node)
+        yield ']'
 
-        response=simplejson.dumps(response1)
-        for field in hidden_fields:
-            field.serialize = True
-        return response
-    
     def element(self, request, elem):
         """
         Renders single model objects to HttpResponse.
@@ -137,6 +119,10 @@ class TreeSerializeResponder(object):
         """
         Renders a list of model objects to HttpResponse.
         """
+        fields = [name for name in self.expose_fields if name != queryset.model._meta.pk.name]
+        # tree querysets are ordered by extra selects (lower_name, lower_class), values() has to keep them
+        extraNames = queryset.query.extra_select.keys()
+        queryset = queryset.values('pk', *(fields + extraNames))
         if self.paginate_by:
             paginator = QuerySetPaginator(queryset, self.paginate_by)
             if not page:
@@ -150,8 +136,8 @@ class TreeSerializeResponder(object):
                 else:
                     return self.error(request, 404)
         else:
-            object_list = list(queryset)
-        return HttpResponse(self.render(object_list), self.mimetype)
+            object_list = queryset
+        return HttpResponse(self.iter_nodes(queryset.model, object_list, extraNames), self.mimetype)
     
 class TreeResponder(TreeSerializeResponder):
     """
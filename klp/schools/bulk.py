@@ -0,0 +1,65 @@
+""" This file contains helpers to insert and update many rows of a model with a single sql statement. They write straight to the database, so model save signals (and fullhistory) are not fired for these rows. Cached tree nodes and permissions are cleared for them by KLP_Bulk_Changed."""
+
+from django.db import connection, transaction
+from django.db.models import AutoField
+
+# Number of rows sent to the database in one statement
+CHUNK_SIZE = 500
+
+
+def _chunks(objs, size=CHUNK_SIZE):
+    for start in range(0, len(objs), size):
+        yield objs[start:start + size]
+
+
+def bulk_insert(objs):
+    """ Inserts unsaved model objects (all of the same model) and sets their primary keys. Ids are taken from the sequence before the insert, partitioned tables (see schools.partitions) return no row for INSERT ... RETURNING """
+    from fullhistory.models import next_ids
+    from schools.receivers import KLP_Bulk_Changed
+    if not objs:
+        return objs
+    model = type(objs[0])
+    opts = model._meta
+    qn = connection.ops.quote_name
+    fields = opts.local_fields
+    columns = ', '.join([qn(field.column) for field in fields])
+    rowSql = '(%s)' % ', '.join(['%s'] * len(fields))
+    cursor = connection.cursor()
+    for chunk in _chunks(objs):
+        if isinstance(opts.pk, AutoField):
+            for obj, pk in zip(chunk, next_ids(model, len(chunk))):
+                setattr(obj, opts.pk.attname, pk)
+        params = []
+        for obj in chunk:
+            params.extend([field.get_db_prep_save(field.pre_save(obj, True), connection=connection) for field in fields])
+        cursor.execute('INSERT INTO %s (%s) VALUES %s' % (qn(opts.db_table), columns, ', '.join([rowSql] * len(chunk))), params)
+    transaction.commit_unless_managed()
+    KLP_Bulk_Changed(model, objs)
+    return objs
+
+
+def bulk_update(objs, fieldNames):
+    """ Writes the given fields of saved model objects (all of the same model) back to the database """
+    from schools.receivers import KLP_Bulk_Changed
+    if not objs:
+        return 0
+    model = type(objs[0])
+    opts = model._meta
+    qn = connection.ops.quote_name
+    table = qn(opts.db_table)
+    fields = [opts.pk] + [opts.get_field(name) for name in fieldNames]
+    # Cast every value so that postgresql does not guess column types from NULLs
+    rowSql = '(%s)' % ', '.join(['%%s::%s' % field.db_type(connection=connection).replace('serial', 'integer') for field in fields])
+    aliases = ', '.join([qn(field.column) for field in fields])
+    assignments = ', '.join(['%s = v.%s' % (qn(field.column), qn(field.column)) for field in fields[1:]])
+    cursor = connection.cursor()
+    count = 0
+    for chunk in _chunks(objs):
+        params = []
+        for obj in chunk:
+            params.extend([field.get_db_prep_save(getattr(obj, field.attname), connection=connection) for field in fields])
+        cursor.execute('UPDATE %s SET %s FROM (VALUES %s) AS v (%s) WHERE %s.%s = v.%s' % (table, assignments, ', '.join([rowSql] * len(chunk)), aliases, table, qn(opts.pk.column), qn(opts.pk.column)), params)
+        count += cursor.rowcount
+    transaction.commit_unless_managed()
+    KLP_Bulk_Changed(model, objs)
+    return count
@@ -0,0 +1,104 @@
+""" This file contains the methods of the job queue. Web requests queue management commands as Background_Job rows and the KLP_jobWorker command runs them, so that long commands neither block the request nor start a new python process per request."""
+
+import datetime
+import time
+import traceback
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.utils import simplejson
+
+# Commands which can be queued from the web
+JOB_COMMANDS = ['KLP_assignPermissions', 'KLP_map', 'KLP_promote']
+# Number of characters of command output kept as job progress
+PROGRESS_LENGTH = 4000
+
+
+def KLP_Queue_Job(command, args, user=None):
+    """ This method queues a management command with its arguments and returns the job """
+    from schools.models import Background_Job
+    if command not in JOB_COMMANDS:
+        raise Exception("%s can not be queued" %(command))
+    job = Background_Job(command=command, arguments=simplejson.dumps([unicode(arg) for arg in args]))
+    if user is not None and user.id:
+        job.createdBy = user
+    job.save()
+    return job
+
+
+def KLP_Claim_Job():
+    """ This method marks the oldest queued job as running and returns it, or None if no job is queued. The update checks the status again, so two workers never get the same job, the worker which loses a job tries the next one """
+    from schools.models import Background_Job
+    qn = connection.ops.quote_name
+    table = qn(Background_Job._meta.db_table)
+    cursor = connection.cursor()
+    while True:
+        cursor.execute("UPDATE %s SET status = 1, \"startedDate\" = %%s WHERE id = (SELECT id FROM %s WHERE status = 0 ORDER BY id LIMIT 1) AND status = 0 RETURNING id" %(table, table), [datetime.datetime.now()])
+        row = cursor.fetchone()
+        transaction.commit_unless_managed()
+        if row is not None:
+            return Background_Job.objects.get(id=row[0])
+        # another worker may have claimed the selected job first, the queue is empty only when no job is left queued
+        if not Background_Job.objects.filter(status=0).exists():
+            return None
+
+
+def KLP_Fail_Stale_Jobs():
+    """ This method marks the jobs left running as failed and returns their number. It is called when the workers start, before any job is claimed, so a job is running then only if the worker which ran it died """
+    from schools.models import Background_Job
+    staleJobs = list(Background_Job.objects.filter(status=1))
+    for job in staleJobs:
+        Background_Job.objects.filter(id=job.id, status=1).update(status=3, finishedDate=datetime.datetime.now(), progress=((job.progress or '') + '\nThe worker running this job stopped\n')[-PROGRESS_LENGTH:])
+    transaction.commit_unless_managed()
+    return len(staleJobs)
+
+
+class KLP_Job_Output(object):
+    """ This class is given to the command as stdout, it keeps the last lines written as job progress """
+    def __init__(self, job):
+        self.job = job
+        self.output = ''
+        self.saved = 0
+
+    def write(self, msg):
+        self.output = (self.output + msg)[-PROGRESS_LENGTH:]
+        # save progress at most once a second
+        if time.time() - self.saved >= 1:
+            self.flush()
+
+    def flush(self):
+        from schools.models import Background_Job
+        Background_Job.objects.filter(id=self.job.id).update(progress=self.output)
+        self.saved = time.time()
+
+
+def KLP_Run_Job(job):
+    """ This method runs the command of a claimed job and stores its status, output and finish time """
+    from schools.models import Background_Job
+    output = KLP_Job_Output(job)
+    try:
+        call_command(job.command, *simplejson.loads(job.arguments), **{'stdout':output, 'stderr':output})
+        status = 2
+    except SystemExit:
+        # commands exit after writing a CommandError to stderr
+        status = 3
+    except Exception:
+        output.write(traceback.format_exc())
+        status = 3
+    output.flush()
+    Background_Job.objects.filter(id=job.id).update(status=status, finishedDate=datetime.datetime.now())
+    return status
+
+
+def KLP_Work(once=False):
+    """ This method runs queued jobs one after another. Waits JOB_POLL_SECONDS when no job is queued, or returns if once is set """
+    pollSeconds = getattr(settings, 'JOB_POLL_SECONDS', 5)
+    while True:
+        job = KLP_Claim_Job()
+        if job is not None:
+            KLP_Run_Job(job)
+        elif once:
+            return
+        else:
+            time.sleep(pollSeconds)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from schools.rollups import KLP_Update_Rollups
+
+class Command(BaseCommand):
+	''' Command To count the fullhistory saved since the last run into daily data entry rollups. Run it nightly, reports read the rollups. On a database with histories older than the changes table, run KLP_fullhistoryChanges before the first run, histories without recorded changes are not counted. Takes optional chunk size (history ids per transaction) as input parameter.'''
+	help = 'Updates daily data entry rollups from fullhistory'
+
+	def handle(self, *args, **options):
+		chunkSize = 100000
+		if args:
+			chunkSize = int(args[0])
+		def progress(lastId, rows):
+			self.stdout.write('Counted histories up to id %s, %s rollups changed\n' %(lastId, rows))
+		lastId = KLP_Update_Rollups(chunkSize, progress)
+		self.stdout.write('Rollups are updated up to history id %s\n' %(lastId))
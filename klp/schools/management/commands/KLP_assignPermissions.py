@@ -13,11 +13,11 @@ class Command(BaseCommand):
         #option_list = BaseCommand.option_list + (make_option('--user', dest='user', type='string',help='User running the command'),)
         @transaction.autocommit         
 	def handle(self, *args, **options):
-                print args,"options ",options                
+                self.stdout.write("%s options %s\n" %(args, options))                
 	        if 1:	
 
 			# Reads the arguments from command line.
-                        print "INNTER TRY" 
+                        self.stdout.write("INNTER TRY\n") 
                         inst_list= args[0] #options["inst_list"]
 			deUserList=args[1] #options["deUserList"]
 
@@ -32,7 +32,7 @@ class Command(BaseCommand):
                         deUserList=deUserList.split(',')
                         permissions=permissions.split(',')
                         bound_list=bound_list.split(',') 
-                        print inst_list,bound_cat,bound_list
+                        self.stdout.write("%s %s %s\n" %(inst_list, bound_cat, bound_list))
                         asmIdList=[]
                         if inst_list and bound_cat in ['cluster','circle']:
                             inst_list=inst_list.split(',')
@@ -41,16 +41,13 @@ class Command(BaseCommand):
                         else:
                                   for bound in bound_list:
                                      bound=int(bound)
-                                     print bound
-                                     if bound_cat== 'district':
-                                              inst_list = Institution.objects.filter(boundary__parent__id = bound, active=2).values_list('id', flat=True).distinct()
-                                         
-                                     elif bound_cat in [ 'block', 'project']:
-                                                  inst_list = Institution.objects.filter(boundary__id = bound, active=2).values_list('id', flat=True).distinct()
+                                     self.stdout.write("%s\n" %(bound))
+                                     # get all institutions under district, block or project boundary
+                                     inst_list = boundary_institutions(bound).filter(active=2).values_list('id', flat=True).distinct()
 		              	     inst_listall.extend(inst_list)   
                                   asmIdList = assignPermission(inst_listall, deUserList, permissions, permissionType, assessmentId, assessmentPerm)
                         self.SendingMail(asmIdList,deUserList,permissions,permissionType,assessmentId,assessmentPerm,bound_list,username)
-                        print "Successfully Assigned"
+                        self.stdout.write("Successfully Assigned\n")
 		if 0:
 			raise CommandError('Pass First Parameter as Boundary Ids List file and Second Parameter as User Ids List \n')
 	           		
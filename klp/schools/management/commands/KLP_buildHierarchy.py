@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from schools.models import Boundary, Boundary_Hierarchy
+
+class Command(BaseCommand):
+	''' Command To (re)build boundary hierarchy (closure table) from boundary parents. Run it once after syncdb, later boundary saves keep it current.'''
+	help = 'Rebuilds boundary hierarchy from boundary parents'
+
+	@transaction.commit_on_success
+	def handle(self, *args, **options):
+		qn = connection.ops.quote_name
+		table = qn(Boundary_Hierarchy._meta.db_table)
+		cursor = connection.cursor()
+		cursor.execute("DELETE FROM %s" %(table))
+		# walk down from every boundary to all boundaries under it
+		cursor.execute("""INSERT INTO %s ("ancestor_id", "descendant_id", "depth")
+			WITH RECURSIVE tree("ancestor_id", "descendant_id", "depth") AS (
+				SELECT "id", "id", 0 FROM %s
+				UNION ALL
+				SELECT tree."ancestor_id", b."id", tree."depth" + 1 FROM tree JOIN %s b ON b."parent_id" = tree."descendant_id" AND b."id" <> b."parent_id"
+			)
+			SELECT "ancestor_id", "descendant_id", "depth" FROM tree""" %(table, qn(Boundary._meta.db_table), qn(Boundary._meta.db_table)))
+		transaction.set_dirty()
+		self.stdout.write('Boundary hierarchy is built with %s rows\n' %(cursor.rowcount))
@@ -35,7 +35,7 @@ class Command(BaseCommand):
                         if bound_cat == 'district':
                                 # if boundary category is district query for institutions under sub boundaries
                                 for bound in bound_list:
-                                        inst_list = Institution.objects.filter(boundary__parent__id = bound, active=2).values_list('id', flat=True).distinct()
+                                        inst_list = boundary_institutions(bound).filter(active=2).values_list('id', flat=True).distinct()
                                         # get count of institutions to show count of assigned institution objects to user
                                         #count = count + inst_list.count()
                                         # call assignPermission method to assign permissions
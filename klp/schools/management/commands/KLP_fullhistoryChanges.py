@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from fullhistory.models import FullHistory, FullHistoryChange
+
+class Command(BaseCommand):
+	''' Command To fill fullhistory changes (changed fields) for the history entries saved before the changes table existed. Histories are read in id order, 5000 at a time, histories which already have changes are skipped so the command can be stopped and run again. Run it before the first KLP_activityRollup (or activity report), rollups need the changes of every history they count. Takes optional chunk size as input parameter.
+	Creations recorded with one change per field by earlier versions are reduced to one change without field name, the values of created objects are kept in the histories.'''
+	help = 'Records changed fields of old fullhistory entries'
+
+	def handle(self, *args, **options):
+		chunkSize = 5000
+		if args:
+			chunkSize = int(args[0])
+		lastId = 0
+		count = 0
+		while True:
+			histories = list(FullHistory.objects.filter(id__gt=lastId, changes__isnull=True).select_related('request').order_by('id')[:chunkSize])
+			if not histories:
+				break
+			FullHistoryChange.objects.record(histories)
+			lastId = histories[-1].id
+			count += len(histories)
+			self.stdout.write('%s histories done, last id %s\n' %(count, lastId))
+		self.stdout.write('Changes are recorded for %s histories\n' %(count))
+		self.stdout.write('Changes of %s created fields are removed\n' %(self.reduce_creations(chunkSize * 10)))
+
+	def reduce_creations(self, chunkSize):
+		''' Replaces the changes of each field of creations by one change without field name, chunkSize history ids per transaction. Returns count of changes removed '''
+		qn = connection.ops.quote_name
+		table = qn(FullHistoryChange._meta.db_table)
+		cursor = connection.cursor()
+		cursor.execute("SELECT min(history_id), max(history_id) FROM %s WHERE action = 'C' AND field_name <> ''" %(table))
+		first, last = cursor.fetchone()
+		count = 0
+		for start in range(first or 0, (last or 0) + 1, chunkSize):
+			cursor.execute("INSERT INTO %s (history_id, content_type_id, object_id, action, field_name, user_pk, action_time) SELECT DISTINCT ON (history_id) history_id, content_type_id, object_id, action, '', user_pk, action_time FROM %s c WHERE action = 'C' AND field_name <> '' AND history_id >= %%s AND history_id < %%s AND NOT EXISTS(SELECT 1 FROM %s e WHERE e.history_id = c.history_id AND e.field_name = '') ORDER BY history_id" %(table, table, table), [start, start + chunkSize])
+			cursor.execute("DELETE FROM %s WHERE action = 'C' AND field_name <> '' AND history_id >= %%s AND history_id < %%s" %(table), [start, start + chunkSize])
+			count += cursor.rowcount
+			transaction.commit_unless_managed()
+		return count
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from fullhistory.models import FullHistory, Request
+from fullhistory.partitions import partitions, partition_name
+
+# Number of fullhistory ids given their user in one transaction
+BATCH_SIZE = 50000
+
+class Command(BaseCommand):
+	''' Command To create the (content_type, object_id, revision) index on an existing fullhistory table, and the user_pk column with its (user_pk, action_time, id) index used by the audit trail. user_pk of existing histories is copied from their requests, BATCH_SIZE ids per transaction. New databases get the column and indexes from syncdb (unique_together and sql/fullhistory.sql).'''
+	help = 'Creates the revision and user indexes of fullhistory'
+
+	def handle(self, *args, **options):
+		qn = connection.ops.quote_name
+		table = FullHistory._meta.db_table
+		self.create_index(table, '%s_revision_idx' %(table), '("content_type_id", "object_id", "revision")')
+		cursor = connection.cursor()
+		cursor.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'user_pk'", [table])
+		if cursor.fetchone() is None:
+			# added to the partitions too
+			cursor.execute('ALTER TABLE %s ADD COLUMN "user_pk" integer CHECK ("user_pk" >= 0)' %(qn(table)))
+			transaction.commit_unless_managed()
+			self.stdout.write('Column user_pk is added\n')
+		cursor.execute('SELECT min(id), max(id) FROM %s' %(qn(table)))
+		first, last = cursor.fetchone()
+		count = 0
+		for start in range(first or 0, (last or 0) + 1, BATCH_SIZE):
+			cursor.execute('UPDATE %s h SET "user_pk" = r."user_pk" FROM %s r WHERE r.id = h."request_id" AND h."user_pk" IS NULL AND r."user_pk" IS NOT NULL AND h.id >= %%s AND h.id < %%s' %(qn(table), qn(Request._meta.db_table)), [start, start + BATCH_SIZE])
+			count += cursor.rowcount
+			transaction.commit_unless_managed()
+		self.stdout.write('User of %s histories is set\n' %(count))
+		# indexes of the table are not used for rows of its partitions
+		for name in [table] + [partition_name(month) for month in partitions()]:
+			self.create_index(name, '%s_user_idx' %(name), '("user_pk", "action_time", "id")')
+
+	def create_index(self, table, indexName, columns):
+		qn = connection.ops.quote_name
+		cursor = connection.cursor()
+		cursor.execute("SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s", [table, indexName])
+		if cursor.fetchone():
+			self.stdout.write('Index %s already exists\n' %(indexName))
+			return
+		cursor.execute('CREATE INDEX %s ON %s %s' %(qn(indexName), qn(table), columns))
+		transaction.commit_unless_managed()
+		self.stdout.write('Index %s is created\n' %(indexName))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+import datetime
+from fullhistory.partitions import month_start, add_months, partitions, create_partition, install_routing, drop_history_references, parent_months, move_rows, partition_sizes, archive_partition
+
+class Command(BaseCommand):
+	''' Command To keep monthly partitions of fullhistory (see fullhistory.partitions). Creates the partitions of the current month and the months ahead (default 3, first parameter), installs the insert trigger and archives partitions older than FULLHISTORY_RETENTION_MONTHS to FULLHISTORY_ARCHIVE_DIR, where KLP_audit still finds them. Pass "move" as second parameter to move rows kept in the fullhistory table into partitions of their months. Run it monthly, before a month starts.'''
+	help = 'Maintains monthly partitions of fullhistory'
+
+	def handle(self, *args, **options):
+		ahead = 3
+		if args:
+			ahead = int(args[0])
+		moveRows = len(args) > 1 and args[1] == 'move'
+		for name in drop_history_references():
+			self.stdout.write('Foreign key %s to fullhistory is dropped\n' %(name))
+		thisMonth = month_start(datetime.datetime.now())
+		months = [add_months(thisMonth, i) for i in range(ahead + 1)]
+		if moveRows:
+			months.extend(parent_months())
+		for month in sorted(set(months)):
+			if create_partition(month):
+				self.stdout.write('Partition of %s is created\n' %(month.strftime('%Y-%m')))
+		install_routing()
+		self.stdout.write('Inserts are routed to %s partitions\n' %(len(partitions())))
+		if moveRows:
+			for month in parent_months():
+				self.stdout.write('%s rows of %s are moved\n' %(move_rows(month), month.strftime('%Y-%m')))
+		retention = getattr(settings, 'FULLHISTORY_RETENTION_MONTHS', 0)
+		if retention:
+			oldest = add_months(thisMonth, -retention)
+			for month in partitions():
+				if month < oldest:
+					self.stdout.write('%s histories of %s are archived\n' %(archive_partition(month), month.strftime('%Y-%m')))
+		for month, rows, size in partition_sizes():
+			self.stdout.write('%s : %s rows, %s MB\n' %(month.strftime('%Y-%m'), rows, size / (1024 * 1024)))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from fullhistory.models import FullHistory, FullHistorySnapshot, snapshot_every
+
+class Command(BaseCommand):
+	''' Command To keep fullhistory snapshots of the objects which have FULLHISTORY_SNAPSHOT_EVERY or more revisions after their latest snapshot, so that get_version, audit and rollback replay only a few revisions. Can be stopped and run again, objects already done are skipped.'''
+	help = 'Keeps fullhistory snapshots of objects with many revisions'
+
+	def handle(self, *args, **options):
+		qn = connection.ops.quote_name
+		cursor = connection.cursor()
+		cursor.execute("SELECT h.content_type_id, h.object_id FROM %s h LEFT JOIN (SELECT content_type_id, object_id, max(revision) AS revision FROM %s GROUP BY content_type_id, object_id) s ON s.content_type_id = h.content_type_id AND s.object_id = h.object_id GROUP BY h.content_type_id, h.object_id, s.revision HAVING max(h.revision) - COALESCE(s.revision, -1) >= %%s ORDER BY h.content_type_id, h.object_id" %(qn(FullHistory._meta.db_table), qn(FullHistorySnapshot._meta.db_table)), [snapshot_every()])
+		objectKeys = cursor.fetchall()
+		self.stdout.write('%s objects need a snapshot\n' %(len(objectKeys)))
+		count = 0
+		for ctId, objectId in objectKeys:
+			model = ContentType.objects.get_for_id(ctId).model_class()
+			if model is None:
+				# model is removed
+				continue
+			# rebuilding the latest version keeps its snapshot
+			FullHistory.objects.get_version(model=model, pk=objectId, audit=False)
+			count += 1
+			if count % 1000 == 0:
+				self.stdout.write('%s snapshots done\n' %(count))
+		self.stdout.write('Snapshots are kept for %s objects\n' %(count))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import connection
+from schools.jobs import KLP_Work, KLP_Fail_Stale_Jobs
+from multiprocessing import Process
+
+class Command(BaseCommand):
+	''' Command To run the jobs queued from the web (see schools.jobs). Starts JOB_WORKERS worker processes (or the number passed), so at most that many jobs run at a time. Pass "once" as second parameter to stop when the queue is empty instead of waiting for new jobs. Jobs left running by workers which died are marked failed on start, so only one KLP_jobWorker should run at a time.'''
+	help = 'Runs queued background jobs'
+
+	def handle(self, *args, **options):
+		workers = getattr(settings, 'JOB_WORKERS', 2)
+		if args:
+			workers = int(args[0])
+		once = len(args) > 1 and args[1] == 'once'
+		staleJobs = KLP_Fail_Stale_Jobs()
+		if staleJobs:
+			self.stdout.write('%s jobs left running are marked failed\n' %(staleJobs))
+		# every worker process opens its own database connection
+		connection.close()
+		processList = [Process(target=KLP_Work, args=(once,)) for i in range(workers)]
+		for process in processList:
+			process.start()
+		self.stdout.write('%s job workers are started\n' %(workers))
+		for process in processList:
+			process.join()
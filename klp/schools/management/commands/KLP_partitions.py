@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from schools.partitions import PARTITIONS, KLP_Partition_Config, KLP_Drop_References, KLP_Rebalance, KLP_Verify, KLP_Partition_Sizes
+
+class Command(BaseCommand):
+	''' Command To maintain the partitions of answer (by status), child (by id ranges), relations (by relation type), student, student group and student group relation (by active) declared in schools.partitions.PARTITIONS.
+	Creates the declared partitions, drops foreign keys to partitioned tables, installs the triggers routing inserts and moving updated rows, creates partitions for rows left in the tables (new values or id ranges) and moves them, then reports problems and partition sizes.
+	Pass "verify" to only report problems and sizes. Pass model names (Answer, Child ...) to work only on those models. Run it before an id range is full and after new status values are used.'''
+	help = 'Maintains partitions of answer, child, relation, student and student group tables'
+
+	def handle(self, *args, **options):
+		verifyOnly = 'verify' in args
+		modelNames = [arg for arg in args if arg != 'verify']
+		declared = [config['model'] for config in PARTITIONS]
+		for modelName in modelNames:
+			if modelName not in declared:
+				raise CommandError('%s is not partitioned, partitioned models are %s\n' %(modelName, ', '.join(declared)))
+		configs = KLP_Partition_Config(modelNames)
+		if not verifyOnly:
+			for name in KLP_Drop_References():
+				self.stdout.write('Foreign key %s to a partitioned table is dropped\n' %(name))
+			for config in configs:
+				created, moved = KLP_Rebalance(config)
+				for name in created:
+					self.stdout.write('Partition %s is created\n' %(name))
+				for name, count in moved:
+					if count:
+						self.stdout.write('%s rows are moved to %s\n' %(count, name))
+		for config in configs:
+			for problem in KLP_Verify(config):
+				self.stdout.write('Problem : %s\n' %(problem))
+			for name, rows, size in KLP_Partition_Sizes(config):
+				if size is None:
+					self.stdout.write('%s : %s rows without partition\n' %(name, rows))
+				else:
+					self.stdout.write('%s : %s rows, %s MB\n' %(name, rows, size / (1024 * 1024)))
@@ -0,0 +1,76 @@
+""" This file contains the set based mapping of an assessment to student groups used by the KLP_map command and the map/sg/as/ url. Student groups are given as a queryset (see KLP_Group_Ids and KLP_Boundary_Groups), missing associations are inserted with bulk statements and data entry users get access to the assessment in the institutions of the groups with one update and one insert. Rows are written straight to the database, so model save signals are not fired for them, fullhistory of the associations is recorded with create_histories."""
+
+from django.contrib.auth.models import User, Group
+from django.db import connection, transaction
+
+from schools.permissions import PERM_TABLE, KLP_Ids, KLP_Set_Assessment_Access, KLP_Perm_Changed
+
+# Groups of the users who get access to newly mapped assessments
+DATA_ENTRY_GROUPS = ['Data Entry Executive', 'Data Entry Operator']
+
+
+def KLP_Group_Ids(idList):
+    """ This method returns queryset of the student groups with the given ids """
+    from schools.models import StudentGroup
+    return StudentGroup.objects.extra(where=['%s.id = ANY(%%s)' %(connection.ops.quote_name(StudentGroup._meta.db_table))], params=[KLP_Ids(idList)])
+
+
+def KLP_Boundary_Groups(boundaryId):
+    """ This method returns queryset of the student groups of institutions under the boundary (at any level) """
+    from schools.models import StudentGroup, boundary_descendants
+    return StudentGroup.objects.filter(institution__boundary__in=boundary_descendants(boundaryId))
+
+
+def KLP_Group_Sql(groups):
+    """ This method returns sql (and params) selecting ids of a student group queryset """
+    return groups.order_by().values_list('id', flat=True).query.get_compiler(connection=connection).as_sql()
+
+
+def KLP_Map_Associations(assessmentId, groups):
+    """ This method maps the assessment to the student groups which are not mapped yet. Groups to map are selected with one query and inserted with bulk statements, their fullhistory is recorded. Returns count of groups mapped """
+    from schools.models import Assessment_StudentGroup_Association
+    from schools.bulk import bulk_insert
+    from fullhistory import create_histories
+    groupSql, groupParams = KLP_Group_Sql(groups)
+    table = connection.ops.quote_name(Assessment_StudentGroup_Association._meta.db_table)
+    cursor = connection.cursor()
+    # counted from the selection, the row count of an insert is hidden by partition triggers (see schools.partitions)
+    cursor.execute("SELECT DISTINCT g.id FROM (%s) g WHERE NOT EXISTS(SELECT 1 FROM %s a WHERE a.assessment_id = %%s AND a.student_group_id = g.id)" %(groupSql, table), list(groupParams) + [int(assessmentId)])
+    associations = [Assessment_StudentGroup_Association(assessment_id=int(assessmentId), student_group_id=row[0], active=2) for row in cursor.fetchall()]
+    bulk_insert(associations)
+    create_histories(associations, 'C')
+    return len(associations)
+
+
+def KLP_Mapped_Permission_Sql(assessmentObj, groups):
+    """ This method returns sql (and params) selecting (user_id, inst_id, assessment_id) which get access to the assessment: active data entry users having permission on the institution of a group, who already have access to an assessment of the programme or if the programme has no other active assessment """
+    from schools.models import Assessment, StudentGroup, UserAssessmentPermissions
+    qn = connection.ops.quote_name
+    groupSql, groupParams = KLP_Group_Sql(groups)
+    asmTable = qn(Assessment._meta.db_table)
+    sql = "SELECT DISTINCT p.user_id, p.obj_id AS inst_id, %%s AS assessment_id FROM %s p JOIN %s u ON u.id = p.user_id AND u.is_active WHERE p.%s AND p.obj_id IN (SELECT sg.institution_id FROM %s sg WHERE sg.id IN (%s)) AND EXISTS(SELECT 1 FROM %s ug JOIN %s gr ON gr.id = ug.group_id WHERE ug.user_id = p.user_id AND gr.name = ANY(%%s)) AND (NOT EXISTS(SELECT 1 FROM %s a WHERE a.programme_id = %%s AND a.active = 2 AND a.id <> %%s) OR EXISTS(SELECT 1 FROM %s x JOIN %s a ON a.id = x.assessment_id WHERE x.user_id = p.user_id AND x.access AND a.programme_id = %%s AND a.active = 2))" %(qn(PERM_TABLE), qn(User._meta.db_table), qn('Acess'), qn(StudentGroup._meta.db_table), groupSql, qn(User.groups.through._meta.db_table), qn(Group._meta.db_table), asmTable, qn(UserAssessmentPermissions._meta.db_table), asmTable)
+    params = [assessmentObj.id] + list(groupParams) + [DATA_ENTRY_GROUPS, assessmentObj.programme_id, assessmentObj.id, assessmentObj.programme_id]
+    return sql, params
+
+
+@transaction.commit_on_success
+def KLP_Save_Mapping(assessmentObj, groups):
+    """ This method writes the mapping of KLP_Map_Assessment. Returns counts and ids of the users whose permissions are changed """
+    counts = {'mapped':KLP_Map_Associations(assessmentObj.id, groups)}
+    targetSql, params = KLP_Mapped_Permission_Sql(assessmentObj, groups)
+    cursor = connection.cursor()
+    cursor.execute("SELECT DISTINCT t.user_id FROM (%s) t" %(targetSql), params)
+    userIds = [row[0] for row in cursor.fetchall()]
+    counts['permissions'] = KLP_Set_Assessment_Access(targetSql, params)
+    return counts, userIds
+
+
+def KLP_Map_Assessment(assessmentObj, groups):
+    """ This method maps the assessment to the student groups (a queryset) and gives data entry users access to it in one transaction. Returns count of groups mapped and count of permissions given """
+    from schools.receivers import KLP_Tree_Changed
+    from schools.models import Assessment_StudentGroup_Association
+    counts, userIds = KLP_Save_Mapping(assessmentObj, groups)
+    # rows are written without signals, clear cached tree nodes and permissions
+    KLP_Tree_Changed(Assessment_StudentGroup_Association)
+    KLP_Perm_Changed(userIds)
+    return counts
@@ -187,6 +187,23 @@ class Boundary(models.Model):
 
 register_model(Boundary)
 
+class Boundary_Hierarchy(models.Model):
+	'''This class stores every ancestor of each boundary (closure table), depth 0 row is the boundary itself'''
+	ancestor = models.ForeignKey(Boundary, related_name='hierarchy_descendants')
+	descendant = models.ForeignKey(Boundary, related_name='hierarchy_ancestors')
+	depth = models.IntegerField()
+
+	class Meta:
+		unique_together = (('ancestor', 'descendant'),)
+
+def boundary_descendants(boundary_id):
+	''' Returns ids of the boundary and all boundaries under it (at any level) as a subquery'''
+	return Boundary_Hierarchy.objects.filter(ancestor__id=boundary_id).values_list('descendant', flat=True)
+
+def boundary_institutions(boundary_id):
+	''' Returns all institutions under the boundary (at any level)'''
+	return Institution.objects.filter(boundary__in=boundary_descendants(boundary_id))
+
 class Institution(models.Model):
 	''' It stores the all data regarding Institutions'''
 	boundary = models.ForeignKey(Boundary)
@@ -255,9 +272,11 @@ register(['Acess'], Institution) # Register model for Object permissions
 register_model(Institution)  # Register model for to store information in fullhistory
 
 from django.db.models.signals import post_save, pre_save
-from schools.receivers import KLP_NewInst_Permission
+from schools.receivers import KLP_NewInst_Permission, KLP_Boundary_Hierarchy
 # Call KLP_NewInst_Permission method on Institution save
 post_save.connect(KLP_NewInst_Permission, sender=Institution) 
+# Call KLP_Boundary_Hierarchy method on Boundary save to keep boundary hierarchy current
+post_save.connect(KLP_Boundary_Hierarchy, sender=Boundary)
 
 class Child(models.Model):
 	''' This class stores the personnel information of the childrens'''
@@ -347,8 +366,9 @@ class StudentGroup(models.Model):
 			groupName = 'Anganwadi Class'
 		return '<a href="/studentgroup/%s/view/" onclick="return KLP_View(this)" class="KLP_treetxt" title="%s %s"> <img src="/static_media/tree-images/reicons/studentgroup_%s.gif" title="%s" /> <span id="studentgroup_%s_text">%s %s</span> </a>' %(self.id, groupName, sec, self.group_type, self.group_type, self.id, groupName, sec)
 		
-	def getStudentProgrammeUrl(self, filter_id, secfilter_id):
-            assname=Assessment.objects.filter(id=secfilter_id).values_list('name',flat=True)[0]
+	def getStudentProgrammeUrl(self, filter_id, secfilter_id, assname=None):
+            if assname is None:
+                assname=Assessment.objects.filter(id=secfilter_id).values_list('name',flat=True)[0]
 	    groupName = self.name
 	    if groupName == '0':
 	    	groupName = 'Anganwadi Class'
@@ -657,3 +677,61 @@ class UserAssessmentPermissions(models.Model):
 	
 	class Meta: 
 		unique_together = (('user', 'instituion', 'assessment'),)
+
+class DE_Activity_Rollup(models.Model):
+	''' This class stores data entry counts per day, user, content type and boundary type (or assessment for answers), filled from fullhistory by KLP_activityRollup'''
+	day = models.DateField(db_index=True)
+	user_pk = models.PositiveIntegerField(null=True)
+	content_type = models.ForeignKey(ContentType)
+	boundary_type = models.ForeignKey(Boundary_Type, null=True)
+	assessment = models.ForeignKey(Assessment, null=True)
+	created = models.IntegerField(default=0)
+	modified = models.IntegerField(default=0)
+	deleted = models.IntegerField(default=0)
+	verified = models.IntegerField(default=0)
+	rectified = models.IntegerField(default=0)
+	wrong = models.IntegerField(default=0)
+
+class Rollup_Watermark(models.Model):
+	''' This class stores the last fullhistory id counted in a rollup'''
+	name = models.CharField(max_length=100, unique=True)
+	last_id = models.IntegerField(default=0)
+
+Job_Status = [(0, 'Queued'),
+              (1, 'Running'),
+              (2, 'Done'),
+              (3, 'Failed')
+             ]
+
+class Background_Job(models.Model):
+	''' This class stores management commands queued from the web (permission assignment, mapping, promotion), they are run by KLP_jobWorker'''
+	command = models.CharField(max_length=100)
+	arguments = models.TextField()
+	status = models.IntegerField(choices=Job_Status, default=0, db_index=True)
+	progress = models.TextField(blank=True, default='')
+	createdBy = models.ForeignKey(User, blank=True, null=True)
+	creationDate = models.DateTimeField(auto_now_add=True)
+	startedDate = models.DateTimeField(blank=True, null=True)
+	finishedDate = models.DateTimeField(blank=True, null=True)
+
+	def __unicode__(self):
+		return "%s %s" %(self.command, self.id)
+
+from schools.receivers import KLP_Tree_Changed
+# Models shown in tree, cached tree nodes are cleared when they are changed (see KLP_Bulk_Changed for writes without signals)
+TREE_MODELS = [Boundary, Institution, StudentGroup, Programme, Assessment, Question, Assessment_StudentGroup_Association]
+# Call KLP_Tree_Changed method on save of models shown in tree to clear cached tree nodes
+for treeModel in TREE_MODELS:
+	post_save.connect(KLP_Tree_Changed, sender=treeModel)
+
+from django.db.models.signals import post_delete, m2m_changed
+from schools.receivers import KLP_Perm_Receiver, KLP_Groups_Changed
+# Clear cached user permissions when assessment permissions or groups of users are changed
+post_save.connect(KLP_Perm_Receiver, sender=UserAssessmentPermissions)
+post_delete.connect(KLP_Perm_Receiver, sender=UserAssessmentPermissions)
+m2m_changed.connect(KLP_Groups_Changed, sender=User.groups.through)
+
+from schools.receivers import KLP_Partition_Id
+# Take ids of new rows of partitioned models from the sequence (see schools.partitions)
+for partitionedModel in [Answer, Child, Relations, Student, StudentGroup, Student_StudentGroupRelation]:
+	pre_save.connect(KLP_Partition_Id, sender=partitionedModel)
@@ -0,0 +1,245 @@
+""" This file contains the list and range partitioning of the answer, child, relation, student, student group and student group relation tables used by the KLP_partitions command. Partitions are child tables (INHERITS) with a CHECK on the partition column, so that postgresql only reads the partitions a query needs (constraint_exclusion). A trigger on the table inserts new rows in their partition and a trigger on each partition moves a row to its new partition when the partition column (status, active ...) is changed. Rows without a partition stay in the table until the next rebalance.
+Each partition keeps its definition as json in its table comment. Insert triggers return no row, so new ids are taken from the sequence before the insert (see KLP_Partition_Id and bulk_insert), and the row count of inserts and of updates moving rows is 0. Code counting changed rows counts the rows it selects to change (see schools.promotion and schools.mapping)."""
+
+import re
+
+from django.db import connection, transaction
+from django.db.models import get_model
+from django.utils import simplejson
+
+# Partitioned models with the partition column and either the list partitions (name suffix, values) or the size of id ranges
+ACTIVE_LISTS = [('active', [2]), ('inactive', [1]), ('deleted', [0]), ('other', [3, 4, 5, 6, 7, None])]
+PARTITIONS = [
+    {'model':'Answer', 'column':'status', 'lists':[('entered', [None]), ('absent', [-99999]), ('unknown', [-1])]},
+    {'model':'Child', 'column':'id', 'range':500000},
+    {'model':'Relations', 'column':'relation_type', 'lists':[('mother', ['Mother']), ('father', ['Father']), ('siblings', ['Siblings'])]},
+    {'model':'Student', 'column':'active', 'lists':ACTIVE_LISTS},
+    {'model':'StudentGroup', 'column':'active', 'lists':ACTIVE_LISTS},
+    {'model':'Student_StudentGroupRelation', 'column':'active', 'lists':ACTIVE_LISTS},
+]
+# Number of id ranges created ahead of the current sequence value
+RANGES_AHEAD = 1
+
+
+def KLP_Partition_Config(modelNames=None):
+    """ This method returns the partition configs of the given model names (default all), with the model added """
+    configs = []
+    for config in PARTITIONS:
+        if modelNames and config['model'] not in modelNames:
+            continue
+        config = dict(config)
+        config['model'] = get_model('schools', config['model'])
+        configs.append(config)
+    return configs
+
+
+def KLP_Partitioned_Tables():
+    """ This method returns the tables of all partitioned models """
+    return [config['model']._meta.db_table for config in KLP_Partition_Config()]
+
+
+def KLP_Sql_Literal(value):
+    """ This method returns the sql literal of a partition value """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, long)):
+        return str(value)
+    return "'%s'" %(unicode(value).replace("'", "''"))
+
+
+def KLP_Partition_Condition(column, definition, prefix=''):
+    """ This method returns the sql condition of the rows of a partition, prefix is 'NEW.' in triggers. The condition is false (not null) for rows of other partitions, as a CHECK passes on null """
+    column = prefix + connection.ops.quote_name(column)
+    if 'start' in definition:
+        return "(%s >= %s AND %s < %s)" %(column, definition['start'], column, definition['end'])
+    values = [value for value in definition['values'] if value is not None]
+    conditions = []
+    if len(values) < len(definition['values']):
+        conditions.append("%s IS NULL" %(column))
+    if values:
+        conditions.append("(%s IS NOT NULL AND %s IN (%s))" %(column, column, ', '.join([KLP_Sql_Literal(value) for value in values])))
+    return "(%s)" %(' OR '.join(conditions))
+
+
+def KLP_Partitions(table):
+    """ This method returns (name, definition) of the partitions of a table, ordered by name """
+    cursor = connection.cursor()
+    cursor.execute("SELECT c.relname, obj_description(c.oid, 'pg_class') FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s ORDER BY c.relname", [table])
+    return [(name, simplejson.loads(comment or '{}')) for name, comment in cursor.fetchall()]
+
+
+def KLP_Drop_References():
+    """ This method drops foreign keys to partitioned tables, they do not see rows in partitions. Returns names of the keys dropped """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("SELECT c.conname, r.relname FROM pg_constraint c JOIN pg_class r ON r.oid = c.conrelid JOIN pg_class f ON f.oid = c.confrelid WHERE c.contype = 'f' AND f.relname = ANY(%s)", [KLP_Partitioned_Tables()])
+    dropped = []
+    for name, table in cursor.fetchall():
+        cursor.execute("ALTER TABLE %s DROP CONSTRAINT %s" %(qn(table), qn(name)))
+        dropped.append(name)
+    transaction.commit_unless_managed()
+    return dropped
+
+
+def KLP_Create_Partition(config, name, definition):
+    """ This method creates a partition with the columns, indexes and foreign keys of the table, returns False if it exists already """
+    qn = connection.ops.quote_name
+    table = config['model']._meta.db_table
+    if name in [partition for partition, partitionDef in KLP_Partitions(table)]:
+        return False
+    cursor = connection.cursor()
+    cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING INDEXES, CONSTRAINT %s CHECK %s) INHERITS (%s)" %(qn(name), qn(table), qn('%s_key' %(name)), KLP_Partition_Condition(config['column'], definition), qn(table)))
+    cursor.execute("COMMENT ON TABLE %s IS %%s" %(qn(name)), [simplejson.dumps(definition)])
+    # foreign keys are not inherited, references to partitioned tables are dropped (see KLP_Drop_References)
+    cursor.execute("SELECT pg_get_constraintdef(c.oid) FROM pg_constraint c JOIN pg_class r ON r.oid = c.conrelid JOIN pg_class f ON f.oid = c.confrelid WHERE c.contype = 'f' AND r.relname = %s AND NOT f.relname = ANY(%s) ORDER BY c.conname", [table, KLP_Partitioned_Tables()])
+    for number, (constraint,) in enumerate(cursor.fetchall()):
+        cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s %s" %(qn(name), qn('%s_fk%s' %(name, number)), constraint))
+    transaction.commit_unless_managed()
+    return True
+
+
+def KLP_Value_Name(table, value):
+    """ This method returns the name of the partition created for a value found in the table """
+    if value is None:
+        suffix = 'null'
+    elif isinstance(value, (int, long)):
+        suffix = str(value).replace('-', 'm')
+    else:
+        suffix = re.sub('[^a-z0-9]', '', value.lower())
+    return '%s_v%s' %(table, suffix)
+
+
+def KLP_Range_Name(table, start):
+    return '%s_p%s' %(table, start)
+
+
+def KLP_Declared_Partitions(config):
+    """ This method returns (name, definition) of the partitions declared in the config, for range partitions the ranges up to RANGES_AHEAD ranges after the current sequence value """
+    table = config['model']._meta.db_table
+    if 'lists' in config:
+        return [('%s_%s' %(table, suffix), {'values':values}) for suffix, values in config['lists']]
+    cursor = connection.cursor()
+    cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [table, config['column']])
+    cursor.execute("SELECT last_value FROM %s" %(cursor.fetchone()[0]))
+    size = config['range']
+    last = cursor.fetchone()[0] // size + RANGES_AHEAD
+    return [(KLP_Range_Name(table, block * size), {'start':block * size, 'end':(block + 1) * size}) for block in range(last + 1)]
+
+
+def KLP_Stray_Partitions(config):
+    """ This method returns (name, definition) of partitions for the rows kept in the table, one for each value (list) or range of ids (range) """
+    qn = connection.ops.quote_name
+    table = config['model']._meta.db_table
+    column = qn(config['column'])
+    cursor = connection.cursor()
+    if 'lists' in config:
+        cursor.execute("SELECT DISTINCT %s FROM ONLY %s" %(column, qn(table)))
+        return [(KLP_Value_Name(table, value), {'values':[value]}) for (value,) in cursor.fetchall()]
+    size = config['range']
+    cursor.execute("SELECT DISTINCT %s / %%s FROM ONLY %s" %(column, qn(table)), [size])
+    return [(KLP_Range_Name(table, block * size), {'start':block * size, 'end':(block + 1) * size}) for (block,) in cursor.fetchall()]
+
+
+def KLP_Install_Routing(config):
+    """ This method (re)creates the insert trigger of the table for its current partitions and the trigger of each partition moving rows whose partition column is changed """
+    qn = connection.ops.quote_name
+    table = config['model']._meta.db_table
+    pk = qn(config['model']._meta.pk.column)
+    partitions = KLP_Partitions(table)
+    branches = []
+    for name, definition in partitions:
+        branches.append("%s %s THEN INSERT INTO %s VALUES (NEW.*);" %(branches and 'ELSIF' or 'IF', KLP_Partition_Condition(config['column'], definition, 'NEW.'), qn(name)))
+    # rows without a partition stay in the table
+    body = "RETURN NEW;"
+    if branches:
+        body = "%s ELSE RETURN NEW; END IF; RETURN NULL;" %(' '.join(branches))
+    cursor = connection.cursor()
+    KLP_Create_Trigger(cursor, table, '%s_route' %(table), 'INSERT', body)
+    for name, definition in partitions:
+        body = "IF %s IS NOT TRUE THEN DELETE FROM ONLY %s WHERE %s = OLD.%s; INSERT INTO %s VALUES (NEW.*); RETURN NULL; END IF; RETURN NEW;" %(KLP_Partition_Condition(config['column'], definition, 'NEW.'), qn(name), pk, pk, qn(table))
+        KLP_Create_Trigger(cursor, name, '%s_move' %(name), 'UPDATE', body)
+    transaction.commit_unless_managed()
+    return len(partitions)
+
+
+def KLP_Create_Trigger(cursor, table, name, event, body):
+    """ This method replaces the function of a before row trigger and creates the trigger if it is missing """
+    qn = connection.ops.quote_name
+    cursor.execute("CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$ BEGIN %s END; $$ LANGUAGE plpgsql" %(qn(name), body))
+    cursor.execute("SELECT 1 FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid WHERE t.tgname = %s AND c.relname = %s", [name, table])
+    if cursor.fetchone() is None:
+        cursor.execute("CREATE TRIGGER %s BEFORE %s ON %s FOR EACH ROW EXECUTE PROCEDURE %s()" %(qn(name), event, qn(table), qn(name)))
+
+
+def KLP_Move_Rows(config):
+    """ This method moves the rows kept in the table to their partitions, returns count of rows moved to each partition """
+    qn = connection.ops.quote_name
+    table = qn(config['model']._meta.db_table)
+    cursor = connection.cursor()
+    counts = []
+    for name, definition in KLP_Partitions(config['model']._meta.db_table):
+        condition = KLP_Partition_Condition(config['column'], definition)
+        cursor.execute("INSERT INTO %s SELECT * FROM ONLY %s WHERE %s" %(qn(name), table, condition))
+        counts.append((name, cursor.rowcount))
+        cursor.execute("DELETE FROM ONLY %s WHERE %s" %(table, condition))
+    transaction.commit_unless_managed()
+    return counts
+
+
+def KLP_Rebalance(config):
+    """ This method creates the declared partitions, installs the triggers and moves the rows kept in the table, then creates partitions for the rows left (values or ranges missing in the config) and moves them. Returns names of the partitions created and count of rows moved to each partition """
+    created = []
+    moved = {}
+    for partitions in [KLP_Declared_Partitions, KLP_Stray_Partitions]:
+        for name, definition in partitions(config):
+            if KLP_Create_Partition(config, name, definition):
+                created.append(name)
+        KLP_Install_Routing(config)
+        for name, count in KLP_Move_Rows(config):
+            moved[name] = moved.get(name, 0) + count
+    return created, sorted(moved.items())
+
+
+def KLP_Verify(config):
+    """ This method checks the partitions of a model against the config and returns the problems found """
+    qn = connection.ops.quote_name
+    table = config['model']._meta.db_table
+    partitions = KLP_Partitions(table)
+    names = [name for name, definition in partitions]
+    problems = []
+    for name, definition in KLP_Declared_Partitions(config):
+        if name not in names:
+            problems.append('%s is missing' %(name))
+    cursor = connection.cursor()
+    cursor.execute("SELECT count(*) FROM ONLY %s" %(qn(table)))
+    count = cursor.fetchone()[0]
+    if count:
+        problems.append('%s rows of %s have no partition' %(count, table))
+    cursor.execute("SELECT c.relname, count(t.oid) FROM pg_class c LEFT JOIN pg_trigger t ON t.tgrelid = c.oid AND t.tgname = c.relname || %s WHERE c.relname = ANY(%s) GROUP BY c.relname", ['_move', names])
+    for name, triggers in cursor.fetchall():
+        if not triggers:
+            problems.append('%s has no trigger moving updated rows' %(name))
+    cursor.execute("SELECT 1 FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid WHERE t.tgname = %s AND c.relname = %s", ['%s_route' %(table), table])
+    if partitions and cursor.fetchone() is None:
+        problems.append('%s has no insert trigger' %(table))
+    cursor.execute("SELECT r.relname, c.conname FROM pg_constraint c JOIN pg_class r ON r.oid = c.conrelid JOIN pg_class f ON f.oid = c.confrelid WHERE c.contype = 'f' AND f.relname = %s", [table])
+    for referencing, constraint in cursor.fetchall():
+        problems.append('foreign key %s of %s references %s' %(constraint, referencing, table))
+    for name, definition in partitions:
+        if not definition:
+            problems.append('%s has no definition' %(name))
+    return problems
+
+
+def KLP_Partition_Sizes(config):
+    """ This method returns (name, rows, bytes) of the table (rows kept in it) and its partitions, rows of partitions are estimates of the planner """
+    qn = connection.ops.quote_name
+    table = config['model']._meta.db_table
+    cursor = connection.cursor()
+    cursor.execute("SELECT count(*) FROM ONLY %s" %(qn(table)))
+    sizes = [(table, cursor.fetchone()[0], None)]
+    for name, definition in KLP_Partitions(table):
+        cursor.execute("SELECT reltuples::bigint, pg_total_relation_size(oid) FROM pg_class WHERE relname = %s", [name])
+        rows, size = cursor.fetchone()
+        sizes.append((name, rows, size))
+    return sizes
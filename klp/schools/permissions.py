@@ -0,0 +1,267 @@
+""" This file contains set based methods to grant institution permissions (object_permissions_institution_perms) and assessment permissions (UserAssessmentPermissions) to many users and institutions at once. Each method runs a fixed number of sql statements whatever the number of users, institutions and assessments.
+It also keeps a cached snapshot of the permissions of each user (groups, assigned institutions and institutions of each assessment) which is read by the tree and the data entry screens. The snapshot of a user is dropped by changing its version whenever permissions of the user are changed."""
+
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, transaction
+
+# table and permission columns of the object permissions registered for Institution
+PERM_TABLE = 'object_permissions_institution_perms'
+INSTITUTION_PERMS = ['Acess']
+
+
+def KLP_Ids(idList):
+    """ This method converts posted/command line ids to a list of ints, dropping empty values """
+    return [int(i) for i in idList if str(i).strip() not in ['', 'None']]
+
+
+def KLP_Permission_Pairs(userIds, instIds, assessmentId=None):
+    """ This method returns sql (and params) selecting (user_id, inst_id) for all selected users and institutions. With assessmentId only pairs which already have a permission row for the assessment are selected """
+    from schools.models import Institution, UserAssessmentPermissions
+    qn = connection.ops.quote_name
+    pairSql = "SELECT u.id AS user_id, i.id AS inst_id FROM %s u, %s i WHERE u.id = ANY(%%s) AND i.id = ANY(%%s)" %(qn(User._meta.db_table), qn(Institution._meta.db_table))
+    params = [KLP_Ids(userIds), KLP_Ids(instIds)]
+    if assessmentId:
+        pairSql += " AND EXISTS(SELECT 1 FROM %s p WHERE p.user_id = u.id AND p.instituion_id = i.id AND p.assessment_id = %%s)" %(qn(UserAssessmentPermissions._meta.db_table))
+        params.append(int(assessmentId))
+    return pairSql, params
+
+
+def KLP_Grant_Institution_Perms(pairs, permissions):
+    """ This method sets institution level permissions (like set_perms) for the (user, institution) pairs with one update and one insert. Returns count of rows changed """
+    pairSql, params = KLP_Permission_Pairs(*pairs)
+    qn = connection.ops.quote_name
+    columns = [qn(perm) for perm in INSTITUTION_PERMS]
+    values = [perm in permissions for perm in INSTITUTION_PERMS]
+    cursor = connection.cursor()
+    # update rows of users already having a row for the institution
+    cursor.execute("UPDATE %s p SET %s FROM (%s) t WHERE p.user_id = t.user_id AND p.obj_id = t.inst_id AND (%s)" %(qn(PERM_TABLE), ', '.join(['%s = %%s' %(column) for column in columns]), pairSql, ' OR '.join(['p.%s IS DISTINCT FROM %%s' %(column) for column in columns])), values + params + values)
+    count = cursor.rowcount
+    # insert rows for the others
+    cursor.execute("INSERT INTO %s (user_id, obj_id, %s) SELECT t.user_id, t.inst_id, %s FROM (%s) t WHERE NOT EXISTS(SELECT 1 FROM %s p WHERE p.user_id = t.user_id AND p.obj_id = t.inst_id)" %(qn(PERM_TABLE), ', '.join(columns), ', '.join(['%s'] * len(columns)), pairSql, qn(PERM_TABLE)), values + params)
+    count += cursor.rowcount
+    transaction.set_dirty()
+    return count
+
+
+def KLP_Grant_Assessment_Perms(pairs, assessmentId=None):
+    """ This method gives access to an assessment (or, without assessmentId, to all assessments mapped to student groups of the institution) for the (user, institution) pairs with one update and one insert. Returns count of rows changed """
+    from schools.models import StudentGroup, Assessment_StudentGroup_Association
+    pairSql, params = KLP_Permission_Pairs(*pairs)
+    qn = connection.ops.quote_name
+    if assessmentId:
+        targetSql = "SELECT t.user_id, t.inst_id, %%s AS assessment_id FROM (%s) t" %(pairSql)
+        params = [int(assessmentId)] + params
+    else:
+        targetSql = "SELECT DISTINCT t.user_id, t.inst_id, asg.assessment_id FROM (%s) t JOIN %s sg ON sg.institution_id = t.inst_id JOIN %s asg ON asg.student_group_id = sg.id AND asg.active = 2" %(pairSql, qn(StudentGroup._meta.db_table), qn(Assessment_StudentGroup_Association._meta.db_table))
+    return KLP_Set_Assessment_Access(targetSql, params)
+
+
+def KLP_Grant_Assessment_Entries(userIds, entries):
+    """ This method gives the users access to each (institution, assessment) entry with one update and one insert. Returns count of rows changed """
+    qn = connection.ops.quote_name
+    targetSql = "SELECT u.id AS user_id, e.inst_id, e.assessment_id FROM %s u, (SELECT unnest(%%s) AS inst_id, unnest(%%s) AS assessment_id) e WHERE u.id = ANY(%%s)" %(qn(User._meta.db_table))
+    params = [[int(instId) for instId, asmId in entries], [int(asmId) for instId, asmId in entries], KLP_Ids(userIds)]
+    return KLP_Set_Assessment_Access(targetSql, params)
+
+
+def KLP_Set_Assessment_Access(targetSql, params):
+    """ This method sets access for the (user_id, inst_id, assessment_id) rows selected by targetSql, updating existing permissions and inserting the others. Returns count of rows changed """
+    from schools.models import UserAssessmentPermissions
+    table = connection.ops.quote_name(UserAssessmentPermissions._meta.db_table)
+    cursor = connection.cursor()
+    cursor.execute("UPDATE %s p SET access = true FROM (%s) a WHERE p.user_id = a.user_id AND p.instituion_id = a.inst_id AND p.assessment_id = a.assessment_id AND NOT p.access" %(table, targetSql), params)
+    count = cursor.rowcount
+    cursor.execute("INSERT INTO %s (user_id, instituion_id, assessment_id, access) SELECT a.user_id, a.inst_id, a.assessment_id, true FROM (%s) a WHERE NOT EXISTS(SELECT 1 FROM %s p WHERE p.user_id = a.user_id AND p.instituion_id = a.inst_id AND p.assessment_id = a.assessment_id)" %(table, targetSql, table), params)
+    count += cursor.rowcount
+    transaction.set_dirty()
+    return count
+
+
+def KLP_Grant_Permissions(inst_list, deUserList, permissions, permissionType, assessmentId=None, assessmentPerm=None):
+    """ This method assigns permissions of the selected users on the selected institutions in one transaction.
+    permissionType 'permissions' sets institution permissions, and with assessmentPerm also access to the assessments mapped to the institution. Otherwise access to assessmentId is given. Returns ids of the institutions assigned """
+    assignedInsIds = KLP_Save_Permissions(inst_list, deUserList, permissions, permissionType, assessmentId, assessmentPerm)
+    # drop cached permissions once the transaction is committed
+    KLP_Perm_Changed(KLP_Ids(deUserList))
+    return assignedInsIds
+
+
+@transaction.commit_on_success
+def KLP_Save_Permissions(inst_list, deUserList, permissions, permissionType, assessmentId=None, assessmentPerm=None):
+    """ This method writes the permissions given by KLP_Grant_Permissions """
+    if assessmentId in ['', 'None']:
+        assessmentId = None
+    withAssessments = assessmentPerm not in [None, 'None']
+    # with assessment permission, only users who have the selected assessment in the institution get permissions
+    pairs = (deUserList, inst_list, withAssessments and assessmentId or None)
+    pairSql, params = KLP_Permission_Pairs(*pairs)
+    cursor = connection.cursor()
+    cursor.execute("SELECT DISTINCT t.inst_id FROM (%s) t" %(pairSql), params)
+    assignedInsIds = [row[0] for row in cursor.fetchall()]
+    if permissionType == 'permissions':
+        # if permission type is permissions set institution level permissions for the user
+        KLP_Grant_Institution_Perms(pairs, permissions)
+        if withAssessments:
+            # if assessmentPerm is true assign mapped assessments also to the user.
+            KLP_Grant_Assessment_Perms(pairs)
+    else:
+        # else assign assessment permissions to user.
+        KLP_Grant_Assessment_Perms(pairs, assessmentId)
+    return assignedInsIds
+
+
+def KLP_Reassign_Assessments(userIds, entries):
+    """ This method gives the users access to the selected (institution, assessment) entries in one transaction. Returns count of rows changed """
+    count = KLP_Save_Assessment_Entries(userIds, entries)
+    KLP_Perm_Changed(KLP_Ids(userIds))
+    return count
+
+
+@transaction.commit_on_success
+def KLP_Save_Assessment_Entries(userIds, entries):
+    """ This method writes the permissions given by KLP_Reassign_Assessments """
+    if not entries:
+        return 0
+    return KLP_Grant_Assessment_Entries(userIds, entries)
+
+
+def KLP_Revoke_Institution_Perms(userId, instIds):
+    """ This method removes institution permissions of the user on the institutions with one delete. Returns count of permissions removed """
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE user_id = %%s AND obj_id = ANY(%%s)" %(connection.ops.quote_name(PERM_TABLE)), [int(userId), KLP_Ids(instIds)])
+    transaction.set_dirty()
+    return cursor.rowcount
+
+
+def KLP_Revoke_Assessment_Perms(permIds):
+    """ This method removes access of the assessment permissions (UserAssessmentPermissions ids) with one update. Returns ids of the users whose permissions are changed """
+    from schools.models import UserAssessmentPermissions
+    cursor = connection.cursor()
+    cursor.execute("UPDATE %s SET access = false WHERE id = ANY(%%s) AND access RETURNING user_id" %(connection.ops.quote_name(UserAssessmentPermissions._meta.db_table)), [KLP_Ids(permIds)])
+    transaction.set_dirty()
+    return [row[0] for row in cursor.fetchall()]
+
+
+def KLP_Revoke_User_Permissions(permissionType, userId, idList):
+    """ This method revokes institution permissions (permissionType 'permissions', idList has institution ids) or assessment permissions (idList has UserAssessmentPermissions ids) in one transaction. Returns count of permissions revoked """
+    count, userIds = KLP_Save_Revoke(permissionType, userId, idList)
+    KLP_Perm_Changed(userIds)
+    return count
+
+
+@transaction.commit_on_success
+def KLP_Save_Revoke(permissionType, userId, idList):
+    """ This method writes the revoke of KLP_Revoke_User_Permissions. Returns count of permissions revoked and ids of the users changed """
+    if permissionType == 'permissions':
+        return KLP_Revoke_Institution_Perms(userId, idList), [int(userId)]
+    userIds = KLP_Revoke_Assessment_Perms(idList)
+    return len(userIds), userIds
+
+
+def KLP_Boundary_Institutions(userId, boundaryId, assigned=True):
+    """ This method returns active institutions under the boundary which are assigned to the user, or with assigned False which are not, selected with an (anti) join on the institution permission table """
+    from schools.models import Institution, boundary_descendants
+    qn = connection.ops.quote_name
+    permWhere = "%sEXISTS(SELECT 1 FROM %s p WHERE p.obj_id = %s.id AND p.user_id = %%s AND p.%s)" %(assigned and '' or 'NOT ', qn(PERM_TABLE), qn(Institution._meta.db_table), qn('Acess'))
+    return Institution.objects.select_related('boundary__parent__parent').filter(boundary__in=boundary_descendants(boundaryId), active=2).extra(where=[permWhere], params=[int(userId)]).order_by("boundary", "boundary__parent", "name")
+
+
+class KLP_Unassigned_Assessments(object):
+    """ This class holds (institution, assessment) entries mapped under the boundary which the user does not have access to, selected with an anti join on UserAssessmentPermissions. It can be given to Paginator, only the entries of the page are read (limit/offset) and each entry is a dict with institution and assessment objects """
+    def __init__(self, userId, boundaryId):
+        from schools.models import Boundary, Boundary_Hierarchy, Institution, StudentGroup, Assessment_StudentGroup_Association, UserAssessmentPermissions
+        qn = connection.ops.quote_name
+        self.sql = "SELECT i.id, asg.assessment_id FROM %s asg JOIN %s sg ON sg.id = asg.student_group_id JOIN %s i ON i.id = sg.institution_id JOIN %s b ON b.id = i.boundary_id WHERE asg.active = 2 AND i.boundary_id IN (SELECT descendant_id FROM %s WHERE ancestor_id = %%s) AND NOT EXISTS(SELECT 1 FROM %s p WHERE p.user_id = %%s AND p.instituion_id = i.id AND p.assessment_id = asg.assessment_id AND p.access) GROUP BY i.id, asg.assessment_id, i.boundary_id, b.parent_id, i.name" %(qn(Assessment_StudentGroup_Association._meta.db_table), qn(StudentGroup._meta.db_table), qn(Institution._meta.db_table), qn(Boundary._meta.db_table), qn(Boundary_Hierarchy._meta.db_table), qn(UserAssessmentPermissions._meta.db_table))
+        self.params = [int(boundaryId), int(userId)]
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            cursor = connection.cursor()
+            cursor.execute("SELECT count(*) FROM (%s) t" %(self.sql), self.params)
+            self._count = cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, page):
+        from schools.models import Institution, Assessment
+        cursor = connection.cursor()
+        cursor.execute("%s ORDER BY i.boundary_id, b.parent_id, i.name, i.id, asg.assessment_id LIMIT %%s OFFSET %%s" %(self.sql), self.params + [page.stop - page.start, page.start])
+        rows = cursor.fetchall()
+        institutions = Institution.objects.select_related('boundary__parent__parent').in_bulk(set([row[0] for row in rows]))
+        assessments = Assessment.objects.select_related('programme').in_bulk(set([row[1] for row in rows]))
+        return [{'institution':institutions[instId], 'assessment':assessments[asmId]} for instId, asmId in rows]
+
+
+def KLP_Perm_Version(userId):
+    """ This method returns current version of the cached permissions of the user """
+    key = 'klp_perm_version_%s' %(userId)
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time())
+        cache.add(key, version)
+    return version
+
+
+def KLP_Perm_Changed(userIds):
+    """ This method drops cached permissions (and tree nodes) of the users by moving them to a new version """
+    for userId in set(userIds):
+        key = 'klp_perm_version_%s' %(userId)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # version is not in cache, start new version
+            cache.set(key, int(time.time()))
+
+
+def KLP_Perm_Cached(userId, name, compute):
+    """ This method returns the named part of the permission snapshot of the user, compute() is called only if it is not in cache """
+    cacheTimeout = getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 0)
+    if not cacheTimeout:
+        return compute()
+    key = 'klp_perm_%s_%s_%s' %(userId, KLP_Perm_Version(userId), name)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, cacheTimeout)
+    return value
+
+
+def KLP_Id_Set(idList):
+    """ This method returns ids as a sorted int array, which is small to keep in cache and can be searched with bisect """
+    return array('i', sorted(set(idList)))
+
+
+def KLP_In_Id_Set(idSet, objId):
+    """ This method checks if objId is in an array made by KLP_Id_Set """
+    i = bisect_left(idSet, int(objId))
+    return i < len(idSet) and idSet[i] == int(objId)
+
+
+def KLP_User_Groups(userId):
+    """ This method returns names of the groups of the user """
+    from django.contrib.auth.models import Group
+    return KLP_Perm_Cached(userId, 'groups', lambda: [str(name) for name in Group.objects.filter(user__id=userId).values_list('name', flat=True)])
+
+
+def KLP_User_Institutions(userId):
+    """ This method returns sorted array of ids of the institutions assigned to the user """
+    def compute():
+        cursor = connection.cursor()
+        cursor.execute("SELECT obj_id FROM %s WHERE user_id = %%s AND %s" %(connection.ops.quote_name(PERM_TABLE), connection.ops.quote_name('Acess')), [int(userId)])
+        return KLP_Id_Set([row[0] for row in cursor.fetchall()])
+    return KLP_Perm_Cached(userId, 'institutions', compute)
+
+
+def KLP_Assessment_Institutions(userId, assessmentId):
+    """ This method returns sorted array of ids of the institutions where the user has access to the assessment """
+    from schools.models import UserAssessmentPermissions
+    return KLP_Perm_Cached(userId, 'assessment_%s' %(assessmentId), lambda: KLP_Id_Set(UserAssessmentPermissions.objects.filter(user__id=userId, assessment__id=assessmentId, access=True).values_list('instituion', flat=True)))
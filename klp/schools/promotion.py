@@ -0,0 +1,118 @@
+""" This file contains the set based promotion of students to the next academic year used by the KLP_promote command. Institutions are promoted a chunk at a time, each chunk in its own transaction. Rows to change are selected with a fixed number of sql statements and written with bulk statements (schools.bulk), so model save signals are not fired for them, their fullhistory is recorded with create_histories."""
+
+from django.db import connection, transaction
+
+# Number of institutions promoted in one transaction
+CHUNK_SIZE = 200
+# Counts returned for each chunk, in the order they are reported
+COUNTERS = ['groupsCreated', 'groupsActivated', 'studentsPromoted', 'studentsCompleted', 'groupsDeactivated']
+
+
+def KLP_Promotion_Institutions(instIds=None):
+    """ This method returns ids of the institutions to promote, the given ids or all active primary schools """
+    from schools.models import Institution
+    if instIds:
+        return sorted([int(instId) for instId in instIds])
+    return list(Institution.objects.filter(cat__categoryType=1, active=2).order_by('id').values_list('id', flat=True))
+
+
+def KLP_Set_Active(model, ids, active, record=True):
+    """ This method sets active of the model rows with the ids, with fullhistory of the change if record is set. Returns the count of rows """
+    from schools.bulk import bulk_update
+    from fullhistory import create_histories
+    objs = model.objects.in_bulk(ids).values()
+    for obj in objs:
+        obj.active = active
+    bulk_update(objs, ['active'])
+    if record:
+        create_histories(objs, 'U')
+    return len(objs)
+
+
+def KLP_Insert(objs, record=True):
+    """ This method inserts the model objects, with fullhistory of the creation if record is set. Returns the count of rows """
+    from schools.bulk import bulk_insert
+    from fullhistory import create_histories
+    bulk_insert(objs)
+    if record:
+        create_histories(objs, 'C')
+    return len(objs)
+
+
+@transaction.commit_manually
+def KLP_Promote_Chunk(instIds, currentId, nextId, dryRun=False):
+    """ This method promotes students of active classes of the institutions from the current to the next academic year. Students of the highest class of an institution are marked as completed (4), students of other classes get a relation with the next class (created if missing) and classes without students are deactivated (1).
+    Rows to change are selected first and counted from the selection, as the partition triggers (see schools.partitions) hide the row count of writes. They are written with bulk statements and their fullhistory is recorded, except for dry runs.
+    Returns count of rows changed for each of COUNTERS, with dryRun the changes are rolled back """
+    from schools.models import StudentGroup, Student_StudentGroupRelation
+    from fullhistory.fullhistory import end_session
+    qn = connection.ops.quote_name
+    sgTable = qn(StudentGroup._meta.db_table)
+    relTable = qn(Student_StudentGroupRelation._meta.db_table)
+    # next class of a group, same institution and section (classes without section too) with class number + 1
+    nextJoin = "%s n ON n.institution_id = g.institution_id AND n.name = (g.cls + 1)::text AND n.section IS NOT DISTINCT FROM g.section AND n.group_type = 'Class'" %(sgTable)
+    record = not dryRun
+    counts = {}
+    try:
+        cursor = connection.cursor()
+        # active classes of the institutions, final is set for the highest class of each institution
+        cursor.execute("CREATE TEMP TABLE promote_groups ON COMMIT DROP AS SELECT id, institution_id, name::int AS cls, section, name::int = max(name::int) OVER (PARTITION BY institution_id) AS final FROM %s WHERE institution_id = ANY(%%s) AND active = 2 AND group_type = 'Class' AND name ~ '^[0-9]+$'" %(sgTable), [list(instIds)])
+        # create missing next classes
+        cursor.execute("SELECT DISTINCT g.institution_id, (g.cls + 1)::text, g.section FROM promote_groups g WHERE NOT g.final AND NOT EXISTS(SELECT 1 FROM %s n WHERE n.institution_id = g.institution_id AND n.name = (g.cls + 1)::text AND n.section IS NOT DISTINCT FROM g.section)" %(sgTable))
+        counts['groupsCreated'] = KLP_Insert([StudentGroup(institution_id=instId, name=name, section=section, active=2, group_type='Class') for instId, name, section in cursor.fetchall()], record)
+        # activate existing next classes
+        cursor.execute("SELECT DISTINCT n.id FROM promote_groups g JOIN %s WHERE NOT g.final AND n.active IS DISTINCT FROM 2" %(nextJoin))
+        counts['groupsActivated'] = KLP_Set_Active(StudentGroup, [row[0] for row in cursor.fetchall()], 2, record)
+        # map students to the next class for the next academic year
+        cursor.execute("SELECT DISTINCT r.student_id, n.id FROM promote_groups g JOIN %s r ON r.student_group_id = g.id AND r.academic_id = %%s AND r.active = 2 JOIN %s WHERE NOT g.final AND NOT EXISTS(SELECT 1 FROM %s x WHERE x.student_id = r.student_id AND x.student_group_id = n.id AND x.academic_id = %%s)" %(relTable, nextJoin, relTable), [currentId, nextId])
+        counts['studentsPromoted'] = KLP_Insert([Student_StudentGroupRelation(student_id=studentId, student_group_id=groupId, academic_id=nextId, active=2) for studentId, groupId in cursor.fetchall()], record)
+        # students of the highest class are promoted from the school
+        cursor.execute("SELECT r.id FROM promote_groups g JOIN %s r ON r.student_group_id = g.id WHERE g.final AND r.academic_id = %%s AND r.active = 2" %(relTable), [currentId])
+        counts['studentsCompleted'] = KLP_Set_Active(Student_StudentGroupRelation, [row[0] for row in cursor.fetchall()], 4, record)
+        # deactivate classes without students, unless they are the next class of a lower class
+        cursor.execute("SELECT g.id FROM promote_groups g WHERE NOT g.final AND NOT EXISTS(SELECT 1 FROM %s r WHERE r.student_group_id = g.id AND r.academic_id = %%s AND r.active = 2) AND NOT EXISTS(SELECT 1 FROM promote_groups p WHERE NOT p.final AND p.institution_id = g.institution_id AND p.cls + 1 = g.cls AND p.section IS NOT DISTINCT FROM g.section)" %(relTable), [currentId])
+        counts['groupsDeactivated'] = KLP_Set_Active(StudentGroup, [row[0] for row in cursor.fetchall()], 1, record)
+        # histories of the chunk are written before the commit
+        end_session()
+    except:
+        transaction.rollback()
+        # the request of the histories may have been rolled back with the chunk
+        end_session()
+        raise
+    if dryRun:
+        transaction.rollback()
+    else:
+        transaction.commit()
+    return counts
+
+
+def KLP_Promote_Worker(chunkArgs):
+    """ This method promotes a chunk in a worker process (see KLP_Promote), returns number of institutions and counts """
+    instIds, currentId, nextId, dryRun = chunkArgs
+    return len(instIds), KLP_Promote_Chunk(instIds, currentId, nextId, dryRun)
+
+
+def KLP_Promote(instIds, currentId, nextId, dryRun=False, workers=1, progress=None):
+    """ This method promotes the institutions, CHUNK_SIZE institutions at a time in workers processes. progress(done, counts) is called after each chunk. Returns total counts """
+    from multiprocessing import Pool
+    chunks = [(instIds[start:start + CHUNK_SIZE], currentId, nextId, dryRun) for start in range(0, len(instIds), CHUNK_SIZE)]
+    totals = dict([(counter, 0) for counter in COUNTERS])
+    if workers > 1:
+        # every worker process opens its own database connection
+        connection.close()
+        pool = Pool(workers)
+        results = pool.imap_unordered(KLP_Promote_Worker, chunks)
+    else:
+        pool = None
+        results = (KLP_Promote_Worker(chunk) for chunk in chunks)
+    done = 0
+    for instCount, counts in results:
+        done += instCount
+        for counter in COUNTERS:
+            totals[counter] += counts[counter]
+        if progress:
+            progress(done, counts)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return totals
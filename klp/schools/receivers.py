@@ -1,18 +1,18 @@
 """ This file containd the methods  and receiver methods to check the user permissions and to assign permission on new institution creation"""
+from schools.permissions import KLP_Perm_Changed
 
 
 def KLP_obj_Perm(userObj, instObj, permission, assessmentObj):
 	""" This method is used to check user object level permissions """
 	""" Get user, instance(Instituion), assessment objects to check permissions"""
-        from schools.models import UserAssessmentPermissions
+	from schools.permissions import KLP_Assessment_Institutions, KLP_In_Id_Set
 	
 	# Check user is logged in or not if logged in, check user is active user or not
 	if (userObj.id is not None or userObj.is_active):
 		# If true check user has permissions to access intitution and assessment object
 		chkPerm = False
-		userAsmList = UserAssessmentPermissions.objects.filter(user=userObj, instituion=instObj, assessment=assessmentObj).values()
-		if userAsmList:
-		    chkPerm = userAsmList[0].get('access') or False
+		if userObj.id is not None:
+			chkPerm = KLP_In_Id_Set(KLP_Assessment_Institutions(userObj.id, assessmentObj.id), instObj.id)
 	else:
 		# else raise Insufficient Previliges exception
 		raise Exception("Insufficient Previliges")
@@ -23,9 +23,11 @@ def KLP_obj_Perm(userObj, instObj, permission, assessmentObj):
 def KLP_user_Perm(userObj, modelName, operation):
 	""" This method is used to check user operational permissions based on model """
 	""" Get User, model name and operation(Add/update/delete) to check permissions"""
+	from schools.permissions import KLP_User_Groups
 	# get user groups 
-	klp_UserGroups = userObj.groups.all()
-	user_GroupsList = ['%s' %(str(usergroup.name)) for usergroup in klp_UserGroups]
+	user_GroupsList = []
+	if userObj.id is not None:
+		user_GroupsList = KLP_User_Groups(userObj.id)
 	# check logged in user is active user or not
 	if userObj.is_active: 		
 		if userObj.is_superuser:
@@ -76,4 +78,84 @@ def KLP_NewInst_Permission(sender, instance, created, **kwargs):
 			lenTrue = userPerm.count(True) # get count of instituions where user has permission
 			if lenTrue == lenInst - 1:
 				# if user has permission with all institutions under boundary except newly created institution, set permissions to user for new institution also
-				user.set_perms(['Acess'], instance)		
+				user.set_perms(['Acess'], instance)
+				KLP_Perm_Changed([user.id])
+
+def KLP_Boundary_Hierarchy(sender, instance, created, **kwargs):
+	""" This receiver method keeps boundary hierarchy (closure table) current on boundary creation and when boundary is moved under another parent"""
+	from schools.models import Boundary_Hierarchy
+	from schools.bulk import bulk_insert
+	from django.db import connection, transaction
+	# get ancestors of the parent boundary
+	parentAncestors = []
+	if instance.parent_id:
+		parentAncestors = [(ancestor, depth + 1) for ancestor, depth in Boundary_Hierarchy.objects.filter(descendant__id=instance.parent_id).values_list('ancestor', 'depth')]
+	if created:
+		# If new boundary is created store boundary itself and all ancestors of parent
+		hierarchyList = [Boundary_Hierarchy(ancestor_id=instance.id, descendant_id=instance.id, depth=0)]
+		hierarchyList.extend([Boundary_Hierarchy(ancestor_id=ancestor, descendant_id=instance.id, depth=depth) for ancestor, depth in parentAncestors])
+		bulk_insert(hierarchyList)
+		return
+	ancestors = Boundary_Hierarchy.objects.filter(descendant__id=instance.id).exclude(ancestor__id=instance.id).values_list('ancestor', 'depth')
+	if set(ancestors) == set(parentAncestors):
+		# parent boundary is not changed
+		return
+	# If parent is changed, unlink boundary and all boundaries under it from old ancestors and link them with new ancestors
+	table = connection.ops.quote_name(Boundary_Hierarchy._meta.db_table)
+	cursor = connection.cursor()
+	cursor.execute("""DELETE FROM %s WHERE "descendant_id" IN (SELECT "descendant_id" FROM %s WHERE "ancestor_id" = %%s) AND "ancestor_id" NOT IN (SELECT "descendant_id" FROM %s WHERE "ancestor_id" = %%s)""" %(table, table, table), [instance.id, instance.id])
+	if instance.parent_id:
+		cursor.execute("""INSERT INTO %s ("ancestor_id", "descendant_id", "depth") SELECT a."ancestor_id", d."descendant_id", a."depth" + d."depth" + 1 FROM %s a, %s d WHERE a."descendant_id" = %%s AND d."ancestor_id" = %%s""" %(table, table, table), [instance.parent_id, instance.id])
+	transaction.commit_unless_managed()
+
+def KLP_Tree_Version():
+	""" This method returns current version of tree nodes cache, version changes whenever tree objects are saved"""
+	from django.core.cache import cache
+	import time
+	version = cache.get('klp_tree_version')
+	if version is None:
+		version = int(time.time())
+		cache.add('klp_tree_version', version)
+	return version
+
+def KLP_Tree_Changed(sender, **kwargs):
+	""" This receiver method is used to clear cached tree nodes on save of boundary, institution, sg, programme, assessment, question and assessment mapping"""
+	from django.core.cache import cache
+	import time
+	try:
+		cache.incr('klp_tree_version')
+	except ValueError:
+		# version is not in cache, start new version
+		cache.set('klp_tree_version', int(time.time()))
+
+def KLP_Bulk_Changed(model, objs=()):
+	""" This method clears cached tree nodes and permissions after rows of the model are written without signals (bulk insert and update, queryset update), objs are the rows written when they are known"""
+	from schools.models import TREE_MODELS, UserAssessmentPermissions
+	if model in TREE_MODELS:
+		KLP_Tree_Changed(model)
+	if model is UserAssessmentPermissions:
+		KLP_Perm_Changed([obj.user_id for obj in objs])
+
+def KLP_Perm_Receiver(sender, instance, **kwargs):
+	""" This receiver method is used to clear cached permissions of the user on save or delete of assessment permissions"""
+	KLP_Perm_Changed([instance.user_id])
+
+def KLP_Groups_Changed(sender, instance, action, reverse, pk_set, **kwargs):
+	""" This receiver method is used to clear cached permissions when users are added to or removed from groups"""
+	from django.contrib.auth.models import User
+	if not reverse:
+		# groups of a user are changed
+		if action.startswith('post_'):
+			KLP_Perm_Changed([instance.id])
+	elif action == 'pre_clear':
+		# all users of a group are removed
+		KLP_Perm_Changed(User.objects.filter(groups=instance).values_list('id', flat=True))
+	elif action.startswith('post_') and pk_set:
+		# users are added to or removed from a group
+		KLP_Perm_Changed(pk_set)
+
+def KLP_Partition_Id(sender, instance, raw, **kwargs):
+	""" This receiver method gives new rows of partitioned models (see schools.partitions) their id from the sequence, the insert trigger of a partitioned table returns no row for INSERT ... RETURNING"""
+	from fullhistory.models import next_ids
+	if instance.pk is None:
+		instance.pk = next_ids(sender, 1)[0]
@@ -0,0 +1,106 @@
+""" This file contains the pipeline shared by the report commands (KLP_DEOHistory, KLP_DE_activity_report, KLP_map). Rows are read in chunks and streamed to csv files in ./logFiles/, progress is written to the command output and a checkpoint is kept so that a failed run continues where it stopped when it is started again with the same file name and arguments."""
+
+import csv
+import os
+import time
+
+from django.utils import simplejson
+
+# Number of objects read from the database at a time
+CHUNK_SIZE = 1000
+
+
+def KLP_Iter_Chunks(queryset, key='pk', after=None, chunkSize=CHUNK_SIZE):
+    """ This method yields lists of objects (or values() dicts) ordered by key, chunkSize at a time. Each chunk is read with key > last key of the previous chunk, so rows are never loaded all at once and the iteration can continue after a given key """
+    while True:
+        chunkQuery = queryset.order_by(key)
+        if after is not None:
+            chunkQuery = chunkQuery.filter(**{'%s__gt' %(key): after})
+        chunk = list(chunkQuery[:chunkSize])
+        if not chunk:
+            return
+        yield chunk
+        if isinstance(chunk[-1], dict):
+            after = chunk[-1][key]
+        else:
+            after = getattr(chunk[-1], key)
+
+
+class KLP_Csv_Report(object):
+    """ This class writes the csv files of a report and its checkpoint (logFiles/<name>.checkpoint). If a checkpoint of an earlier run with the same arguments exists, the files are cut back to the size at the checkpoint and writing continues from there, state holds what the command saved with the checkpoint. A checkpoint of other arguments is dropped and the report starts again """
+    def __init__(self, name, fileNames, stdout, arguments=(), progressEvery=CHUNK_SIZE):
+        # get current working directory.
+        self.path = "%s/logFiles/" %(os.getcwd())
+        if not os.path.exists(self.path):# if dir not exists creates directory with name logfiles in cwd.
+            os.makedirs(self.path)
+        self.checkpointFile = "%s%s.checkpoint" %(self.path, name)
+        # arguments are compared as they are read back from json
+        self.arguments = simplejson.loads(simplejson.dumps(list(arguments)))
+        saved = {}
+        if os.path.exists(self.checkpointFile):
+            saved = simplejson.load(open(self.checkpointFile))
+            if saved.get('arguments') != self.arguments:
+                stdout.write('Checkpoint of %s was saved for arguments %s, starting again\n' %(name, saved.get('arguments')))
+                saved = {}
+        self.state = saved.get('state')
+        self.fileNames = fileNames
+        self.files, self.writers = {}, {}
+        for fileName in fileNames:
+            genFile = "%s%s.csv" %(self.path, fileName)# create csv file with the name passed.
+            if self.state is not None and os.path.exists(genFile):
+                # drop the rows written after the checkpoint
+                csvFile = open(genFile, 'r+b')
+                csvFile.truncate(saved['offsets'][fileName])
+                csvFile.seek(0, 2)
+            else:
+                csvFile = open(genFile, 'wb')
+            self.files[fileName] = csvFile
+            self.writers[fileName] = csv.writer(csvFile)
+        self.stdout = stdout
+        self.progressEvery = progressEvery
+        self.rows = saved.get('rows', 0)
+        self.newRows = 0
+        self.started = time.time()
+        if self.state is not None:
+            self.stdout.write('Continuing %s after %s rows\n' %(name, self.rows))
+
+    def resumed(self):
+        """ Returns True if the report continues an earlier run """
+        return self.state is not None
+
+    def writerow(self, row, fileName=None):
+        """ Writes a row to the file (default first file) """
+        self.writers[fileName or self.fileNames[0]].writerow(row)
+        self.rows += 1
+        self.newRows += 1
+        if self.newRows % self.progressEvery == 0:
+            self.progress()
+
+    def progress(self):
+        """ Writes rows written and rows per second to the command output """
+        seconds = max(time.time() - self.started, 0.001)
+        self.stdout.write('%s rows written, %.1f rows/s\n' %(self.rows, self.newRows / seconds))
+
+    def checkpoint(self, state):
+        """ Saves state with the current size of the files, after making sure the rows are on disk """
+        offsets = {}
+        for fileName, csvFile in self.files.items():
+            csvFile.flush()
+            os.fsync(csvFile.fileno())
+            offsets[fileName] = csvFile.tell()
+        tmpFile = self.checkpointFile + '.tmp'
+        checkpointFile = open(tmpFile, 'w')
+        simplejson.dump({'state':state, 'offsets':offsets, 'rows':self.rows, 'arguments':self.arguments}, checkpointFile)
+        checkpointFile.close()
+        os.rename(tmpFile, self.checkpointFile)
+        self.state = state
+
+    def finish(self):
+        """ Closes the files and removes the checkpoint """
+        for csvFile in self.files.values():
+            csvFile.close()
+        if os.path.exists(self.checkpointFile):
+            os.remove(self.checkpointFile)
+        self.progress()
+        for fileName in self.fileNames:
+            self.stdout.write("%s.csv file has been created in %s directory\n" %(fileName, self.path))
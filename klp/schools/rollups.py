@@ -0,0 +1,182 @@
+""" This file contains the methods to count data entry activity from fullhistory into daily rollups (DE_Activity_Rollup) and to read totals for a date range from them. Only the histories saved after the last run (watermark) are counted."""
+
+import datetime
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import Max, Sum
+from fullhistory.models import FullHistory, FullHistoryChange, Request
+from schools.models import *
+from schools.bulk import bulk_insert, bulk_update
+
+ROLLUP_NAME = 'de_activity'
+COUNTERS = ['created', 'modified', 'deleted', 'verified', 'rectified', 'wrong']
+# Histories newer than this are left for the next run, so that histories of transactions still open get counted in order
+ROLLUP_LAG = datetime.timedelta(minutes=60)
+
+
+def KLP_Boundary_Type_Sql(contentTypeIds):
+    """ This method returns sql which maps content type and object id of boundaries, schools, students and teachers to boundary type """
+    qn = connection.ops.quote_name
+    return """
+        SELECT %(boundaryCt)s AS ct_id, b.id AS object_id, b.boundary_type_id FROM %(boundary)s b
+        UNION ALL
+        SELECT %(institutionCt)s, i.id, b.boundary_type_id FROM %(institution)s i JOIN %(boundary)s b ON b.id = i.boundary_id
+        UNION ALL
+        SELECT DISTINCT %(studentCt)s, ssr.student_id, b.boundary_type_id FROM %(ssr)s ssr JOIN %(studentgroup)s sg ON sg.id = ssr.student_group_id JOIN %(institution)s i ON i.id = sg.institution_id JOIN %(boundary)s b ON b.id = i.boundary_id
+        UNION ALL
+        SELECT %(staffCt)s, s.id, b.boundary_type_id FROM %(staff)s s JOIN %(institution)s i ON i.id = s.institution_id JOIN %(boundary)s b ON b.id = i.boundary_id
+    """ %{'boundary':qn(Boundary._meta.db_table), 'institution':qn(Institution._meta.db_table), 'ssr':qn(Student_StudentGroupRelation._meta.db_table), 'studentgroup':qn(StudentGroup._meta.db_table), 'staff':qn(Staff._meta.db_table), 'boundaryCt':contentTypeIds['boundary'], 'institutionCt':contentTypeIds['institution'], 'studentCt':contentTypeIds['student'], 'staffCt':contentTypeIds['staff']}
+
+
+def KLP_Rollup_Counts(fromId, toId, contentTypeIds):
+    """ This method counts histories with fromId < id <= toId. Returns (day, user, content type, boundary type, assessment) -> {counter: count} """
+    qn = connection.ops.quote_name
+    tables = {'history':qn(FullHistory._meta.db_table), 'request':qn(Request._meta.db_table), 'change':qn(FullHistoryChange._meta.db_table), 'answer':qn(Answer._meta.db_table), 'question':qn(Question._meta.db_table), 'answerCt':contentTypeIds['answer']}
+    tables['answerChanged'] = "EXISTS(SELECT 1 FROM %(change)s c WHERE c.history_id = h.id AND c.field_name IN ('answerScore', 'answerGrade'))" %tables
+    cursor = connection.cursor()
+    counts = {}
+    def add(key, counter, count):
+        counts.setdefault(key, {})
+        counts[key][counter] = counts[key].get(counter, 0) + count
+
+    ################################ Objects of type Boundary, School, Teacher, Student
+    #  C => Content created
+    #  U + active changed from 2 => Content modified and status changed from active-state to non-active states(deleted!)
+    #  U + active not changed from 2 => content updated and is still in active state!
+    ################################
+    cursor.execute("""
+        SELECT CAST(h.action_time AS date), r.user_pk, h.content_type_id, bt.boundary_type_id, h.action,
+            EXISTS(SELECT 1 FROM %(change)s c WHERE c.history_id = h.id AND c.field_name = 'active' AND c.old_value = '2') AS deleted,
+            COUNT(*)
+        FROM %(history)s h
+        JOIN %(request)s r ON r.id = h.request_id
+        JOIN (%(boundaryTypes)s) bt ON bt.ct_id = h.content_type_id AND bt.object_id = h.object_id
+        WHERE h.id > %%s AND h.id <= %%s AND h.action IN ('C', 'U')
+        GROUP BY 1, 2, 3, 4, 5, 6""" %dict(tables, boundaryTypes=KLP_Boundary_Type_Sql(contentTypeIds)), [fromId, toId])
+    for day, userId, ctId, boundaryType, action, deleted, count in cursor.fetchall():
+        if action == 'C':
+            counter = 'created'
+        elif deleted:
+            counter = 'deleted'
+        else:
+            counter = 'modified'
+        add((day, userId, ctId, boundaryType, None), counter, count)
+
+    ################################ Objects of type Answer
+    #  C => answer entered by user
+    #  U on answers not entered by user, answer not changed => verified by double entry
+    #  U on answers not entered by user, answer changed => rectified
+    #  U by others, answer changed, last modified by user before => wrong (counted for the user who last modified it)
+    ################################
+    cursor.execute("""
+        SELECT CAST(h.action_time AS date), r.user_pk, q.assessment_id, h.action,
+            EXISTS(SELECT 1 FROM %(history)s h2 JOIN %(request)s r2 ON r2.id = h2.request_id
+                   WHERE h2.content_type_id = h.content_type_id AND h2.object_id = h.object_id AND h2.action = 'C'
+                   AND r2.user_pk = r.user_pk) AS entered,
+            %(answerChanged)s AS changed,
+            COUNT(*)
+        FROM %(history)s h
+        LEFT JOIN %(request)s r ON r.id = h.request_id
+        JOIN %(answer)s a ON a.id = h.object_id
+        JOIN %(question)s q ON q.id = a.question_id
+        WHERE h.content_type_id = %(answerCt)s AND h.id > %%s AND h.id <= %%s AND h.action IN ('C', 'U')
+        GROUP BY 1, 2, 3, 4, 5, 6""" %tables, [fromId, toId])
+    for day, userId, assessmentId, action, entered, changed, count in cursor.fetchall():
+        if action == 'C':
+            counter = 'created'
+        elif entered:
+            continue
+        elif changed:
+            counter = 'rectified'
+        else:
+            counter = 'verified'
+        add((day, userId, contentTypeIds['answer'], None, assessmentId), counter, count)
+    cursor.execute("""
+        SELECT CAST(h.action_time AS date), m.old_value, q.assessment_id, COUNT(*)
+        FROM %(history)s h
+        JOIN %(request)s r ON r.id = h.request_id
+        JOIN %(change)s m ON m.history_id = h.id AND m.field_name = 'lastmodifiedBy' AND m.old_value IS NOT NULL
+        JOIN %(answer)s a ON a.id = h.object_id
+        JOIN %(question)s q ON q.id = a.question_id
+        WHERE h.content_type_id = %(answerCt)s AND h.id > %%s AND h.id <= %%s AND h.action = 'U'
+            AND r.user_pk::text <> m.old_value AND %(answerChanged)s
+        GROUP BY 1, 2, 3""" %tables, [fromId, toId])
+    for day, userId, assessmentId, count in cursor.fetchall():
+        add((day, int(userId), contentTypeIds['answer'], None, assessmentId), 'wrong', count)
+    return counts
+
+
+@transaction.commit_on_success
+def KLP_Rollup_Chunk(toId, contentTypeIds):
+    """ This method adds counts of the histories after the watermark up to toId to the rollups and moves the watermark, in one transaction """
+    watermark = Rollup_Watermark.objects.get_or_create(name=ROLLUP_NAME)[0]
+    # lock the watermark so that two runs do not count the same histories
+    cursor = connection.cursor()
+    cursor.execute("SELECT last_id FROM %s WHERE id = %%s FOR UPDATE" %(connection.ops.quote_name(Rollup_Watermark._meta.db_table)), [watermark.id])
+    fromId = cursor.fetchone()[0]
+    if toId <= fromId:
+        return 0
+    counts = KLP_Rollup_Counts(fromId, toId, contentTypeIds)
+    # add to existing rollups of the days
+    existing = {}
+    for rollup in DE_Activity_Rollup.objects.filter(day__in=set([key[0] for key in counts])):
+        existing[(rollup.day, rollup.user_pk, rollup.content_type_id, rollup.boundary_type_id, rollup.assessment_id)] = rollup
+    newRollups, changedRollups = [], []
+    for key, counters in counts.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            rollup = DE_Activity_Rollup(day=key[0], user_pk=key[1], content_type_id=key[2], boundary_type_id=key[3], assessment_id=key[4])
+            newRollups.append(rollup)
+        else:
+            changedRollups.append(rollup)
+        for counter, count in counters.items():
+            setattr(rollup, counter, getattr(rollup, counter) + count)
+    bulk_insert(newRollups)
+    bulk_update(changedRollups, COUNTERS)
+    Rollup_Watermark.objects.filter(id=watermark.id).update(last_id=toId)
+    return len(counts)
+
+
+def KLP_Unrecorded_History(fromId, toId):
+    """ This method returns id of a history with fromId < id <= toId which has no changes recorded (see KLP_fullhistoryChanges), or None """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("SELECT h.id FROM %s h WHERE h.id > %%s AND h.id <= %%s AND NOT EXISTS(SELECT 1 FROM %s c WHERE c.history_id = h.id) LIMIT 1" %(qn(FullHistory._meta.db_table), qn(FullHistoryChange._meta.db_table)), [fromId, toId])
+    row = cursor.fetchone()
+    return row and row[0]
+
+
+def KLP_Update_Rollups(chunkSize=100000, progress=None):
+    """ This method counts all histories saved after the watermark (and older than ROLLUP_LAG) into the rollups, chunkSize history ids per transaction. progress is called with (last id, rollup rows changed) after each chunk. Raises an exception without counting if changes of some of the histories are not recorded yet. Returns last counted history id """
+    contentTypeIds = {}
+    ## Create a dictionary of valid content types
+    for modelType in ContentType.objects.filter(app_label='schools'):
+        contentTypeIds[modelType.model]=modelType.id
+    lastId = FullHistory.objects.filter(action_time__lt=datetime.datetime.now() - ROLLUP_LAG).aggregate(lastId=Max('id'))['lastId'] or 0
+    fromId = Rollup_Watermark.objects.get_or_create(name=ROLLUP_NAME)[0].last_id
+    missingId = KLP_Unrecorded_History(fromId, lastId)
+    if missingId is not None:
+        # counted histories are never counted again, their deletes and corrections would stay 0
+        raise Exception("Changes of history %s are not recorded, run KLP_fullhistoryChanges before counting rollups" %(missingId))
+    while fromId < lastId:
+        toId = min(fromId + chunkSize, lastId)
+        rows = KLP_Rollup_Chunk(toId, contentTypeIds)
+        if progress:
+            progress(toId, rows)
+        fromId = toId
+    return lastId
+
+
+def KLP_Rollup_Watermark():
+    """ This method returns the last history id counted in the rollups """
+    return Rollup_Watermark.objects.get_or_create(name=ROLLUP_NAME)[0].last_id
+
+
+def KLP_Rollup_Totals(sDate, eDate):
+    """ This method returns (user, content type, boundary type, assessment) -> {counter: count} summed over the days sDate to eDate """
+    totals = {}
+    rows = DE_Activity_Rollup.objects.filter(day__range=(sDate, eDate)).values('user_pk', 'content_type', 'boundary_type', 'assessment').annotate(*[Sum(counter) for counter in COUNTERS])
+    for row in rows:
+        totals[(row['user_pk'], row['content_type'], row['boundary_type'], row['assessment'])] = dict([(counter, row[counter+'__sum']) for counter in COUNTERS])
+    return totals
@@ -6,6 +6,13 @@ Replace these with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from django.http import HttpRequest
+from django.utils import simplejson
+from schools.models import *
+from fullhistory.models import FullHistory
+from fullhistory.fullhistory import end_session
+import datetime
+import os
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +28,537 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+
+def KLP_Test_Boundary(name, parent=None, category='district'):
+    """ This method creates an active primary school boundary for tests """
+    categoryObj, created = Boundary_Category.objects.get_or_create(boundary_category=category)
+    typeObj, created = Boundary_Type.objects.get_or_create(boundary_type='Primary School')
+    return Boundary.objects.create(name=name, parent=parent, boundary_category=categoryObj, boundary_type=typeObj, active=2)
+
+
+def KLP_Test_Institution(name='school'):
+    """ This method creates an active institution (in a boundary of its own) for tests """
+    mgmt, created = Institution_Management.objects.get_or_create(name='ed')
+    return Institution.objects.create(boundary=KLP_Test_Boundary('%s boundary' %(name)), name=name, mgmt=mgmt, active=2)
+
+
+def KLP_Test_Student(group, academic, active=2):
+    """ This method creates a student of the student group in the academic year for tests """
+    mt, created = Moi_Type.objects.get_or_create(name='kannada')
+    child = Child.objects.create(firstName='child', dob=datetime.date(2005, 1, 1), mt=mt)
+    student = Student.objects.create(child=child, active=2)
+    Student_StudentGroupRelation.objects.create(student=student, student_group=group, academic=academic, active=active)
+    return student
+
+
+class TreeNodesTest(TestCase):
+    def test_nodes_ordered_by_extra_select(self):
+        """
+        Tree querysets are ordered by extra selects, nodes are built without them.
+        """
+        from klprestApi.Treeresponder import TreeResponder
+        boundaries = [KLP_Test_Boundary(name) for name in ['b', 'A']]
+        query = Boundary.objects.filter(id__in=[boundary.id for boundary in boundaries]).extra(select={'lower_name':'lower(name)'}).order_by("lower_name")
+        responder = TreeResponder(CDict=dict([('boundary_%s' %(boundary.id), [boundary.name == 'A', boundary.name]) for boundary in boundaries]))
+        responder.expose_fields = ['name']
+        nodes = simplejson.loads(responder.list(HttpRequest(), query).content)
+        self.assertEqual(['A', 'b'], [node['text'] for node in nodes])
+        self.assertEqual({'name':'A'}, nodes[0]['fields'])
+        self.assertEqual('boundary_%s' %(boundaries[1].id), nodes[0]['id'])
+        self.assertEqual('true', nodes[0]['hasChildren'])
+        self.assertFalse('hasChildren' in nodes[1])
+
+
+class PromotionTest(TestCase):
+    def setUp(self):
+        end_session()
+        self.current = Academic_Year.objects.create(name='2010-2011')
+        self.next = Academic_Year.objects.create(name='2011-2012')
+        self.institution = KLP_Test_Institution()
+        self.groups = {}
+        for name, section, active in [('1', 'A', 2), ('1', 'B', 2), ('1', 'C', 2), ('2', 'A', 1), ('3', 'A', 2)]:
+            self.groups[name + section] = StudentGroup.objects.create(institution=self.institution, name=name, section=section, active=active, group_type='Class')
+        self.students = dict([(key, KLP_Test_Student(self.groups[key], self.current)) for key in ['1A', '1B', '3A']])
+
+    def promote(self):
+        from schools.promotion import KLP_Promote_Chunk
+        return KLP_Promote_Chunk([self.institution.id], self.current.id, self.next.id)
+
+    def assertPromoted(self, counts):
+        """
+        2B and 2C are created, 2A is activated, students of 1A and 1B go to
+        2A and 2B, the student of 3A completes and the empty 1C is deactivated.
+        """
+        self.assertEqual({'groupsCreated':2, 'groupsActivated':1, 'studentsPromoted':2, 'studentsCompleted':1, 'groupsDeactivated':1}, counts)
+        groups = StudentGroup.objects.filter(institution=self.institution)
+        self.assertEqual(2, groups.get(name='2', section='A').active)
+        self.assertEqual(2, groups.get(name='2', section='B').active)
+        self.assertEqual(1, groups.get(name='1', section='C').active)
+        self.assertEqual(4, Student_StudentGroupRelation.objects.get(student=self.students['3A'], academic=self.current).active)
+        self.assertEqual(('2', 'B'), Student_StudentGroupRelation.objects.filter(student=self.students['1B'], academic=self.next).values_list('student_group__name', 'student_group__section')[0])
+
+    def test_promote(self):
+        self.assertPromoted(self.promote())
+
+    def test_promote_partitioned(self):
+        """
+        Partition triggers return no row, counters do not depend on the row count of writes.
+        """
+        from django.db import connection
+        from schools.partitions import KLP_Partition_Config, KLP_Drop_References, KLP_Rebalance, KLP_Verify
+        KLP_Drop_References()
+        configs = KLP_Partition_Config(['StudentGroup', 'Student_StudentGroupRelation'])
+        for config in configs:
+            KLP_Rebalance(config)
+        self.assertPromoted(self.promote())
+        for config in configs:
+            self.assertEqual([], KLP_Verify(config))
+        # rows are moved to the partitions of their new active
+        cursor = connection.cursor()
+        cursor.execute('SELECT name, section FROM ONLY schools_studentgroup_inactive')
+        self.assertEqual([('1', 'C')], cursor.fetchall())
+        cursor.execute('SELECT student_id FROM ONLY schools_student_studentgrouprelation_other')
+        self.assertEqual([(self.students['3A'].id,)], cursor.fetchall())
+
+    def test_promote_without_section(self):
+        """
+        Classes without section (NULL in old rows) are matched like sections, the next class is not created again.
+        """
+        from django.db import connection
+        from schools.promotion import KLP_Promote_Chunk
+        cursor = connection.cursor()
+        cursor.execute('ALTER TABLE %s ALTER COLUMN section DROP NOT NULL' %(connection.ops.quote_name(StudentGroup._meta.db_table)))
+        institution = KLP_Test_Institution('no section')
+        groups = dict([(name, StudentGroup.objects.create(institution=institution, name=name, section=None, active=2, group_type='Class')) for name in ['1', '2', '3']])
+        students = dict([(name, KLP_Test_Student(groups[name], self.current)) for name in ['1', '3']])
+        counts = KLP_Promote_Chunk([institution.id], self.current.id, self.next.id)
+        self.assertEqual({'groupsCreated':0, 'groupsActivated':0, 'studentsPromoted':1, 'studentsCompleted':1, 'groupsDeactivated':0}, counts)
+        self.assertEqual(groups['2'].id, Student_StudentGroupRelation.objects.get(student=students['1'], academic=self.next).student_group_id)
+        self.assertEqual(2, StudentGroup.objects.get(pk=groups['2'].pk).active)
+        # nothing is left to do on a second run
+        counts = KLP_Promote_Chunk([institution.id], self.current.id, self.next.id)
+        self.assertEqual({'groupsCreated':0, 'groupsActivated':0, 'studentsPromoted':0, 'studentsCompleted':0, 'groupsDeactivated':0}, counts)
+        self.assertEqual(3, StudentGroup.objects.filter(institution=institution).count())
+
+    def test_histories(self):
+        self.promote()
+        created = StudentGroup.objects.get(institution=self.institution, name='2', section='B')
+        self.assertEqual(['C'], [history.action for history in FullHistory.objects.actions_for_object(created)])
+        deactivated = StudentGroup.objects.get(pk=self.groups['1C'].pk)
+        actions = FullHistory.objects.actions_for_object(deactivated)
+        self.assertEqual(['C', 'U'], [history.action for history in actions])
+        self.assertEqual((2, 1), tuple(actions[1].data['active']))
+        FullHistory.objects.audit(deactivated)
+        relation = Student_StudentGroupRelation.objects.get(student=self.students['3A'], academic=self.current)
+        self.assertEqual(['C', 'U'], [history.action for history in FullHistory.objects.actions_for_object(relation)])
+
+
+class MappingTest(TestCase):
+    def test_map_assessment(self):
+        from schools.mapping import KLP_Map_Assessment, KLP_Group_Ids
+        end_session()
+        institution = KLP_Test_Institution()
+        groups = [StudentGroup.objects.create(institution=institution, name=name, section='A', active=2) for name in ['1', '2']]
+        assessment = Assessment.objects.create(programme=Programme.objects.create(name='programme'), name='assessment')
+        Assessment_StudentGroup_Association.objects.create(assessment=assessment, student_group=groups[0], active=2)
+        groupIds = [group.id for group in groups]
+        self.assertEqual({'mapped':1, 'permissions':0}, KLP_Map_Assessment(assessment, KLP_Group_Ids(groupIds)))
+        association = Assessment_StudentGroup_Association.objects.get(assessment=assessment, student_group=groups[1])
+        self.assertEqual(2, association.active)
+        self.assertEqual(['C'], [history.action for history in FullHistory.objects.actions_for_object(association)])
+        # mapped groups are not mapped again
+        self.assertEqual({'mapped':0, 'permissions':0}, KLP_Map_Assessment(assessment, KLP_Group_Ids(groupIds)))
+
+
+class PageDataEntryTest(TestCase):
+    def setUp(self):
+        end_session()
+        self.user = User.objects.create_superuser('entry', 'entry@klp.org.in', 'entry')
+        # the year current_academic selects
+        today = datetime.date.today()
+        year = today.month <= 8 and today.year - 1 or today.year
+        academic = Academic_Year.objects.create(name='%s-%s' %(year, year + 1))
+        self.group = StudentGroup.objects.create(institution=KLP_Test_Institution(), name='1', section='A', active=2)
+        self.student = KLP_Test_Student(self.group, academic)
+        self.assessment = Assessment.objects.create(programme=Programme.objects.create(name='programme'), name='assessment')
+        self.question = Question.objects.create(assessment=self.assessment, name='q1', order=1)
+
+    def entry(self, answers):
+        from klprestApi.AnswerApi import KLP_Page_DataEntry
+        request = HttpRequest()
+        request.user = self.user
+        request.POST = {'assessmentId':str(self.assessment.id), 'student_groupId':str(self.group.id), 'answers':simplejson.dumps(answers)}
+        response = KLP_Page_DataEntry(request)
+        self.assertEqual(200, response.status_code)
+        return simplejson.loads(response.content)['result']
+
+    def test_numeric_values(self):
+        cell = 'student_%s_%s' %(self.student.id, self.question.id)
+        self.assertEqual({cell:'created'}, self.entry({str(self.student.id):{str(self.question.id):7}}))
+        self.assertEqual(7, float(Answer.objects.get(student=self.student, question=self.question).answerScore))
+        self.assertEqual({cell:'updated'}, self.entry({str(self.student.id):{str(self.question.id):7.5}}))
+        self.assertEqual(7.5, float(Answer.objects.get(student=self.student, question=self.question).answerScore))
+
+    def test_malformed_cells(self):
+        answers = {str(self.student.id):{'q':'5', str(self.question.id):[5]}, 'x':{str(self.question.id):'5'}, '12':'5'}
+        self.assertEqual({'student_%s_q' %(self.student.id):'invalid', 'student_%s_%s' %(self.student.id, self.question.id):'invalid', 'student_x_%s' %(self.question.id):'invalid', 'student_12':'invalid'}, self.entry(answers))
+        self.assertEqual(0, Answer.objects.filter(student=self.student).count())
+
+    def test_values_out_of_range(self):
+        grade = Question.objects.create(assessment=self.assessment, name='q2', order=2, questionType=2)
+        for value in ['nan', 'inf', '1e9', '123456', '1000', '1.234']:
+            self.assertEqual({'student_%s_%s' %(self.student.id, self.question.id):'invalid'}, self.entry({str(self.student.id):{str(self.question.id):value}}))
+        self.assertEqual({'student_%s_%s' %(self.student.id, grade.id):'invalid'}, self.entry({str(self.student.id):{str(grade.id):'A' * 31}}))
+        self.assertEqual(0, Answer.objects.filter(student=self.student).count())
+        # the other cells of the page are saved
+        result = self.entry({str(self.student.id):{str(self.question.id):'999.99', str(grade.id):'1e9'}})
+        self.assertEqual('created', result['student_%s_%s' %(self.student.id, self.question.id)])
+
+    def test_malformed_json(self):
+        from klprestApi.AnswerApi import KLP_Page_DataEntry
+        request = HttpRequest()
+        request.user = self.user
+        request.POST = {'assessmentId':str(self.assessment.id), 'student_groupId':str(self.group.id), 'answers':'{"12":'}
+        response = KLP_Page_DataEntry(request)
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(simplejson.loads(response.content)['isSuccess'])
+
+    def validate(self, fields):
+        from klprestApi.AnswerApi import KLP_Batch_DataValidation
+        request = HttpRequest()
+        request.user = self.user
+        request.POST = {'validateFields':fields}
+        return KLP_Batch_DataValidation(request)
+
+    def test_batch_validation(self):
+        Answer.objects.create(question=self.question, student=self.student, doubleEntry=1, answerScore=7, user1=self.user)
+        cell = 'student_%s_%s' %(self.student.id, self.question.id)
+        fields = {cell:7, 'student_x_1':'7', 'student_1':'7', 'other':'7'}
+        response = self.validate(simplejson.dumps(fields))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({cell:True, 'student_x_1':False, 'student_1':False, 'other':False}, simplejson.loads(response.content))
+        self.assertEqual({cell:False}, simplejson.loads(self.validate(simplejson.dumps({cell:[7]})).content))
+        self.assertEqual({cell:False}, simplejson.loads(self.validate(simplejson.dumps({cell:None})).content))
+        self.assertEqual(400, self.validate('{"student_1_1":').status_code)
+        self.assertEqual(400, self.validate('[1]').status_code)
+
+
+class JobTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('jobs', 'jobs@klp.org.in', 'jobs')
+
+    def test_claim_order(self):
+        from schools.jobs import KLP_Queue_Job, KLP_Claim_Job
+        jobs = [KLP_Queue_Job('KLP_map', [], self.user) for i in range(2)]
+        self.assertEqual([job.id for job in jobs], [KLP_Claim_Job().id for job in jobs])
+        self.assertEqual(None, KLP_Claim_Job())
+        self.assertEqual([1, 1], [job.status for job in Background_Job.objects.filter(id__in=[job.id for job in jobs])])
+
+    def test_work(self):
+        from schools.jobs import KLP_Queue_Job, KLP_Work
+        failed = KLP_Queue_Job('KLP_map', [], self.user)
+        done = Background_Job.objects.create(command='validate', arguments='[]')
+        KLP_Work(once=True)
+        failed = Background_Job.objects.get(id=failed.id)
+        self.assertEqual(3, failed.status)
+        self.assertTrue('Pass FileName' in failed.progress)
+        self.assertTrue(failed.finishedDate)
+        done = Background_Job.objects.get(id=done.id)
+        self.assertEqual(2, done.status)
+        self.assertTrue('0 errors found' in done.progress)
+
+    def test_stale_jobs(self):
+        from schools.jobs import KLP_Queue_Job, KLP_Claim_Job, KLP_Fail_Stale_Jobs
+        running = KLP_Queue_Job('KLP_map', [], self.user)
+        queued = KLP_Queue_Job('KLP_map', [], self.user)
+        self.assertEqual(running.id, KLP_Claim_Job().id)
+        self.assertEqual(1, KLP_Fail_Stale_Jobs())
+        running = Background_Job.objects.get(id=running.id)
+        self.assertEqual(3, running.status)
+        self.assertTrue(running.finishedDate)
+        self.assertTrue('stopped' in running.progress)
+        self.assertEqual(0, Background_Job.objects.get(id=queued.id).status)
+        self.assertEqual(0, KLP_Fail_Stale_Jobs())
+
+    def test_status(self):
+        from klprestApi.JobApi import KLP_Job_Status
+        from django.contrib.auth.models import AnonymousUser
+        from django.http import Http404
+        from schools.jobs import KLP_Queue_Job
+        job = KLP_Queue_Job('KLP_map', [], self.user)
+        request = HttpRequest()
+        request.user = self.user
+        response = KLP_Job_Status(request, str(job.id))
+        self.assertEqual('Queued', simplejson.loads(response.content)['status'])
+        request.user = AnonymousUser()
+        self.assertEqual(403, KLP_Job_Status(request, str(job.id)).status_code)
+        self.assertRaises(Http404, KLP_Job_Status, request, str(job.id + 1))
+
+
+class AuditTrialTest(TestCase):
+    """
+    Three histories of the user are in the archive of the last month and
+    three in the database, pages of two histories cross the boundary.
+    """
+    def setUp(self):
+        import tempfile
+        from django.conf import settings
+        from django.test.client import Client
+        from fullhistory import fullhistory
+        from fullhistory.partitions import month_start, add_months, create_partition, install_routing, drop_history_references, move_rows, archive_partition
+        end_session()
+        self.user = User.objects.create_superuser('audit', 'audit@klp.org.in', 'audit')
+        self.directory = tempfile.mkdtemp()
+        self.oldDirectory = getattr(settings, 'FULLHISTORY_ARCHIVE_DIR', '')
+        settings.FULLHISTORY_ARCHIVE_DIR = self.directory
+        request = HttpRequest()
+        request.path = '/test/'
+        request.user = self.user
+        lastMonth = add_months(month_start(datetime.datetime.now()), -1)
+        fullhistory.FullHistoryMiddleware().process_request(request)
+        years = [Academic_Year.objects.create(name='19%02d-19%02d' %(year, year + 1)) for year in range(6)]
+        end_session()
+        for year in years[:3]:
+            history = FullHistory.objects.actions_for_object(year)[0]
+            FullHistory.objects.filter(id=history.id).update(action_time=lastMonth + datetime.timedelta(days=1, seconds=history.id))
+        drop_history_references()
+        create_partition(lastMonth)
+        install_routing()
+        move_rows(lastMonth)
+        archive_partition(lastMonth)
+        self.ids = [FullHistory.objects.actions_for_object(year)[0].id for year in years[3:]]
+        self.filters = {'selUser':self.user.id, 'startDate':lastMonth.strftime('%d-%m-%Y'), 'endDate':datetime.date.today().strftime('%d-%m-%Y')}
+        self.client = Client()
+        self.client.login(username='audit', password='audit')
+
+    def tearDown(self):
+        import shutil
+        from django.conf import settings
+        settings.FULLHISTORY_ARCHIVE_DIR = self.oldDirectory
+        shutil.rmtree(self.directory)
+        end_session()
+
+    def page(self, params):
+        from django.http import QueryDict
+        response = self.client.get('/audit/trial/', dict(self.filters, **params))
+        self.assertEqual(200, response.status_code)
+        nextParams = previousParams = None
+        if 'nextUrl' in response.context:
+            nextParams = dict(QueryDict(response.context['nextUrl'][1:]).items())
+        if 'previousUrl' in response.context:
+            previousParams = dict(QueryDict(response.context['previousUrl'][1:]).items())
+        return [(history.object_id, history.id in self.ids) for history in response.context['fullHistoryList']], previousParams, nextParams
+
+    def test_pages(self):
+        import sys
+        from django.core.urlresolvers import resolve
+        # the module of the view as imported by the urls
+        auditTrial = sys.modules[resolve('/audit/trial/')[0].__module__]
+        oldSize = auditTrial.AUDIT_PAGE_SIZE
+        auditTrial.AUDIT_PAGE_SIZE = 2
+        try:
+            years = list(Academic_Year.objects.filter(name__startswith='19').order_by('id').values_list('id', flat=True))
+            rows, previousParams, nextParams = self.page({})
+            self.assertEqual([(years[0], False), (years[1], False)], rows)
+            self.assertEqual(None, previousParams)
+            # the second page has the last archived history and the first one of the database
+            rows, previousParams, nextParams = self.page(nextParams)
+            self.assertEqual([(years[2], False), (years[3], True)], rows)
+            rows, previousParams, lastParams = self.page(nextParams)
+            self.assertEqual([(years[4], True), (years[5], True)], rows)
+            self.assertEqual(None, lastParams)
+            # back across the boundary
+            rows, previousParams, nextParams = self.page(previousParams)
+            self.assertEqual([(years[2], False), (years[3], True)], rows)
+            rows, previousParams, nextParams = self.page(previousParams)
+            self.assertEqual([(years[0], False), (years[1], False)], rows)
+            self.assertEqual(None, previousParams)
+        finally:
+            auditTrial.AUDIT_PAGE_SIZE = oldSize
+
+    def test_csv(self):
+        import csv
+        from cStringIO import StringIO
+        response = self.client.get('/audit/trial/', dict(self.filters, format='csv'))
+        self.assertEqual('text/csv', response['Content-Type'])
+        lines = list(csv.reader(StringIO(response.content)))
+        self.assertEqual('Id', lines[0][0])
+        years = list(Academic_Year.objects.filter(name__startswith='19').order_by('id').values_list('id', flat=True))
+        self.assertEqual([str(year) for year in years], [line[2] for line in lines[1:]])
+
+
+class CacheVersionTest(TestCase):
+    def setUp(self):
+        from django.conf import settings
+        self.oldTimeout = getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 0)
+        settings.PERMISSION_CACHE_TIMEOUT = 60
+        self.user = User.objects.create_user('cache', 'cache@klp.org.in', 'cache')
+        self.institution = KLP_Test_Institution()
+        self.assessment = Assessment.objects.create(programme=Programme.objects.create(name='programme'), name='assessment')
+        self.permission = UserAssessmentPermissions.objects.create(user=self.user, instituion=self.institution, assessment=self.assessment, access=True)
+
+    def tearDown(self):
+        from django.conf import settings
+        settings.PERMISSION_CACHE_TIMEOUT = self.oldTimeout
+
+    def test_revoke(self):
+        from schools.permissions import KLP_Perm_Version, KLP_Assessment_Institutions, KLP_In_Id_Set, KLP_Revoke_User_Permissions
+        self.assertTrue(KLP_In_Id_Set(KLP_Assessment_Institutions(self.user.id, self.assessment.id), self.institution.id))
+        version = KLP_Perm_Version(self.user.id)
+        self.assertEqual(1, KLP_Revoke_User_Permissions('assessments', self.user.id, [self.permission.id]))
+        # tree nodes of the user are cached with the permission version
+        self.assertNotEqual(version, KLP_Perm_Version(self.user.id))
+        self.assertFalse(KLP_In_Id_Set(KLP_Assessment_Institutions(self.user.id, self.assessment.id), self.institution.id))
+
+    def test_bulk_writes(self):
+        from schools.bulk import bulk_update
+        from schools.permissions import KLP_Perm_Version
+        from schools.receivers import KLP_Tree_Version
+        group = StudentGroup.objects.create(institution=self.institution, name='1', section='A', active=2)
+        version = KLP_Tree_Version()
+        group.active = 1
+        bulk_update([group], ['active'])
+        self.assertNotEqual(version, KLP_Tree_Version())
+        version = KLP_Perm_Version(self.user.id)
+        self.permission.access = False
+        bulk_update([self.permission], ['access'])
+        self.assertNotEqual(version, KLP_Perm_Version(self.user.id))
+
+
+class PermissionGrantTest(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(name, '%s@klp.org.in' %(name), name) for name in ['grant1', 'grant2']]
+        self.institutions = [KLP_Test_Institution(name) for name in ['school1', 'school2']]
+        group = StudentGroup.objects.create(institution=self.institutions[0], name='1', section='A', active=2)
+        programme = Programme.objects.create(name='programme')
+        self.assessments = dict([(name, Assessment.objects.create(programme=programme, name=name)) for name in ['held', 'mapped', 'unmapped', 'other']])
+        for name, active in [('held', 2), ('mapped', 2), ('unmapped', 1)]:
+            Assessment_StudentGroup_Association.objects.create(assessment=self.assessments[name], student_group=group, active=active)
+        # only the first user has the held assessment in the first institution
+        UserAssessmentPermissions.objects.create(user=self.users[0], instituion=self.institutions[0], assessment=self.assessments['held'], access=True)
+
+    def ids(self, objs):
+        return [str(obj.id) for obj in objs]
+
+    def institution_perms(self):
+        from django.db import connection
+        from schools.permissions import PERM_TABLE
+        cursor = connection.cursor()
+        cursor.execute('SELECT user_id, obj_id, %s FROM %s WHERE user_id = ANY(%%s) ORDER BY user_id, obj_id' %(connection.ops.quote_name('Acess'), connection.ops.quote_name(PERM_TABLE)), [[user.id for user in self.users]])
+        return [tuple(row) for row in cursor.fetchall()]
+
+    def assessment_perms(self):
+        return sorted(UserAssessmentPermissions.objects.filter(user__in=self.users).values_list('user', 'instituion', 'assessment', 'access'))
+
+    def test_institution_permissions(self):
+        from schools.permissions import KLP_Grant_Permissions, KLP_Grant_Institution_Perms
+        assigned = KLP_Grant_Permissions(self.ids(self.institutions), self.ids(self.users), ['Acess'], 'permissions', None, 'None')
+        self.assertEqual(sorted([institution.id for institution in self.institutions]), sorted(assigned))
+        rows = [(user.id, institution.id, True) for user in self.users for institution in self.institutions]
+        self.assertEqual(rows, self.institution_perms())
+        # without assessmentPerm no assessment is granted
+        self.assertEqual([(self.users[0].id, self.institutions[0].id, self.assessments['held'].id, True)], self.assessment_perms())
+        # a second run writes nothing new
+        self.assertEqual(0, KLP_Grant_Institution_Perms((self.ids(self.users), self.ids(self.institutions), None), ['Acess']))
+        KLP_Grant_Permissions(self.ids(self.institutions), self.ids(self.users), ['Acess'], 'permissions', None, 'None')
+        self.assertEqual(rows, self.institution_perms())
+
+    def test_mapped_assessments(self):
+        from schools.permissions import KLP_Grant_Permissions, KLP_Grant_Assessment_Perms
+        assigned = KLP_Grant_Permissions(self.ids(self.institutions), self.ids(self.users), ['Acess'], 'permissions', str(self.assessments['held'].id), 'on')
+        # only the pair which already holds the assessment is assigned
+        self.assertEqual([self.institutions[0].id], assigned)
+        self.assertEqual([(self.users[0].id, self.institutions[0].id, True)], self.institution_perms())
+        # and gets the assessments actively mapped to the institution
+        perms = sorted([(self.users[0].id, self.institutions[0].id, self.assessments[name].id, True) for name in ['held', 'mapped']])
+        self.assertEqual(perms, self.assessment_perms())
+        self.assertEqual(0, KLP_Grant_Assessment_Perms((self.ids(self.users), self.ids(self.institutions), self.assessments['held'].id)))
+        KLP_Grant_Permissions(self.ids(self.institutions), self.ids(self.users), ['Acess'], 'permissions', str(self.assessments['held'].id), 'on')
+        self.assertEqual([(self.users[0].id, self.institutions[0].id, True)], self.institution_perms())
+        self.assertEqual(perms, self.assessment_perms())
+
+    def test_assessment_permissions(self):
+        from schools.permissions import KLP_Grant_Permissions, KLP_Grant_Assessment_Perms
+        other = self.assessments['other']
+        UserAssessmentPermissions.objects.create(user=self.users[1], instituion=self.institutions[1], assessment=other, access=False)
+        assigned = KLP_Grant_Permissions(self.ids(self.institutions), self.ids(self.users), ['Acess'], 'assessments', str(other.id), 'None')
+        self.assertEqual(sorted([institution.id for institution in self.institutions]), sorted(assigned))
+        perms = sorted([(user.id, institution.id, other.id, True) for user in self.users for institution in self.institutions] + [(self.users[0].id, self.institutions[0].id, self.assessments['held'].id, True)])
+        self.assertEqual(perms, self.assessment_perms())
+        # assessment permissions do not set institution permissions
+        self.assertEqual([], self.institution_perms())
+        self.assertEqual(0, KLP_Grant_Assessment_Perms((self.ids(self.users), self.ids(self.institutions), None), other.id))
+        KLP_Grant_Permissions(self.ids(self.institutions), self.ids(self.users), ['Acess'], 'assessments', str(other.id), 'None')
+        self.assertEqual(perms, self.assessment_perms())
+
+
+class CsvReportTest(TestCase):
+    def setUp(self):
+        import tempfile
+        self.oldDirectory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        import shutil
+        os.chdir(self.oldDirectory)
+        shutil.rmtree(self.directory)
+
+    def failedRun(self, arguments):
+        """ Writes a row and a checkpoint, then a row after the checkpoint, and stops without finishing """
+        from cStringIO import StringIO
+        from schools.reports import KLP_Csv_Report
+        report = KLP_Csv_Report('report', ['report'], StringIO(), arguments)
+        report.writerow(['header'])
+        report.checkpoint({'done':1})
+        report.writerow(['lost'])
+        for csvFile in report.files.values():
+            csvFile.close()
+
+    def content(self):
+        return open('logFiles/report.csv').read().split()
+
+    def test_resume(self):
+        from cStringIO import StringIO
+        from schools.reports import KLP_Csv_Report
+        self.failedRun(['01/01/2011', '31/01/2011', 5])
+        report = KLP_Csv_Report('report', ['report'], StringIO(), ['01/01/2011', '31/01/2011', 5])
+        self.assertTrue(report.resumed())
+        self.assertEqual({'done':1}, report.state)
+        report.writerow(['row'])
+        report.finish()
+        self.assertEqual(['header', 'row'], self.content())
+        self.assertFalse(os.path.exists('logFiles/report.checkpoint'))
+
+    def test_other_arguments(self):
+        from cStringIO import StringIO
+        from schools.reports import KLP_Csv_Report
+        self.failedRun(['01/01/2011', '31/01/2011', 5])
+        report = KLP_Csv_Report('report', ['report'], StringIO(), ['01/02/2011', '28/02/2011', 5])
+        self.assertFalse(report.resumed())
+        report.writerow(['header'])
+        report.finish()
+        self.assertEqual(['header'], self.content())
+
+
+class RollupTest(TestCase):
+    def test_unrecorded_changes(self):
+        """
+        Histories saved before the changes table are not counted until their changes are recorded.
+        """
+        from django.core.management import call_command
+        from cStringIO import StringIO
+        from fullhistory.models import FullHistoryChange
+        from schools.rollups import KLP_Update_Rollups, KLP_Rollup_Watermark, ROLLUP_LAG
+        end_session()
+        year = Academic_Year.objects.create(name='1990-1991')
+        history = FullHistory.objects.actions_for_object(year)[0]
+        FullHistory.objects.filter(id=history.id).update(action_time=datetime.datetime.now() - 2 * ROLLUP_LAG)
+        FullHistoryChange.objects.filter(history=history).delete()
+        watermark = KLP_Rollup_Watermark()
+        self.assertRaises(Exception, KLP_Update_Rollups)
+        self.assertEqual(watermark, KLP_Rollup_Watermark())
+        call_command('KLP_fullhistoryChanges', stdout=StringIO())
+        KLP_Update_Rollups()
+        self.assertTrue(KLP_Rollup_Watermark() >= history.id)
@@ -35,4 +35,5 @@ urlpatterns = patterns('',
     url(r'', include('production.klprestApi.KLP_AuditTrial')),
     url(r'', include('production.klprestApi.AllidsActivate')),
     url(r'', include('production.klprestApi.KLP_Common')),
+    url(r'', include('production.klprestApi.JobApi')),
 )